@@ -143,24 +143,28 @@ if nshot in (34570, 34571):
          ]
 
 
-nb = dpsd_run.DPSD(setup_d, t_ranges=t_nb)
-rf = dpsd_run.DPSD(setup_d, t_ranges=t_rf)
+# One run over both phases, the spectra are slices of the spectrogram
+t_all = np.append(np.ravel(t_nb), np.ravel(t_rf))
+setup_d['setup']['Spectrogram classes'] = 'neut1'
+dp = dpsd_run.DPSD(setup_d, t_ranges=[np.min(t_all), np.max(t_all)])
+nb = dp.spgram['neut1'].spectrum(t_nb)
+rf = dp.spgram['neut1'].spectrum(t_rf)
 
 plt.figure('DPSD compare', figsize=(12, 5))
 plt.subplot(1, 2, 1)
-plt.plot(nb.phs['neut1'], 'b-', label='NBI')
-plt.plot(rf.phs['neut1'], 'r-', label='NBI&RF')
-fac = np.mean(rf.phs['neut1'][50:150])/np.mean(nb.phs['neut1'][50:150])
-plt.plot(fac*nb.phs['neut1'], 'b--', label='%5.2fxNBI' %fac)
+plt.plot(nb, 'b-', label='NBI')
+plt.plot(rf, 'r-', label='NBI&RF')
+fac = np.mean(rf[50:150])/np.mean(nb[50:150])
+plt.plot(fac*nb, 'b--', label='%5.2fxNBI' %fac)
 plt.xlim([0, 400])
 plt.ylim([0, 3000])
 plt.legend()
 
 plt.subplot(1, 2, 2)
-plt.semilogy(nb.phs['neut1'], 'b-', label='NBI')
-plt.semilogy(rf.phs['neut1'], 'r-', label='NBI&RF')
-fac = np.mean(rf.phs['neut1'][50:150])/np.mean(nb.phs['neut1'][50:150])
-plt.semilogy(fac*nb.phs['neut1'], 'b--', label='%5.2fxNBI' %fac)
+plt.semilogy(nb, 'b-', label='NBI')
+plt.semilogy(rf, 'r-', label='NBI&RF')
+fac = np.mean(rf[50:150])/np.mean(nb[50:150])
+plt.semilogy(fac*nb, 'b--', label='%5.2fxNBI' %fac)
 plt.xlim([0, 400])
 plt.ylim([1, 3000])
 plt.legend()
@@ -4,16 +4,16 @@ __author__  = 'Giovanni Tardini (Tel. +49 89 3299-1898)'
 __version__ = '0.0.1'
 __date__    = '29.03.2022'
 
-import os, sys, logging, webbrowser, json
+import os, sys, logging, webbrowser, json, threading
 
 try:
-    from PyQt5.QtWidgets import QMainWindow, QWidget, QApplication, QGridLayout, QMenu, QAction, QLabel, QPushButton, QLineEdit, QCheckBox, QSpinBox, QDoubleSpinBox, QFileDialog, QRadioButton, QButtonGroup, QTabWidget, QVBoxLayout
+    from PyQt5.QtWidgets import QMainWindow, QWidget, QApplication, QGridLayout, QMenu, QAction, QLabel, QPushButton, QLineEdit, QCheckBox, QSpinBox, QDoubleSpinBox, QFileDialog, QRadioButton, QButtonGroup, QTabWidget, QVBoxLayout, QProgressBar
     from PyQt5.QtGui import QPixmap, QIcon
-    from PyQt5.QtCore import Qt, QRect, QSize, QLocale
+    from PyQt5.QtCore import Qt, QRect, QSize, QLocale, QThread, pyqtSignal
     qt5 = True
 except:
-    from PyQt4.QtCore import Qt, QRect, QSize, QLocale
-    from PyQt4.QtGui import QPixmap, QIcon, QMainWindow, QWidget, QApplication, QGridLayout, QMenu, QAction, QLabel, QPushButton, QLineEdit, QCheckBox, QSpinBox, QDoubleSpinBox, QFileDialog, QRadioButton, QButtonGroup, QTabWidget, QVBoxLayout
+    from PyQt4.QtCore import Qt, QRect, QSize, QLocale, QThread, pyqtSignal
+    from PyQt4.QtGui import QPixmap, QIcon, QMainWindow, QWidget, QApplication, QGridLayout, QMenu, QAction, QLabel, QPushButton, QLineEdit, QCheckBox, QSpinBox, QDoubleSpinBox, QFileDialog, QRadioButton, QButtonGroup, QTabWidget, QVBoxLayout, QProgressBar
     qt5 = False
 
 import numpy as np
@@ -37,6 +37,31 @@ logger.setLevel(logging.INFO)
 dpsd_dir = os.path.dirname(os.path.realpath(__file__))
 
 
+class DPSD_WORKER(QThread):
+# Runs dpsd_run.DPSD off the Qt main thread, results are streamed shot by shot
+
+    progress = pyqtSignal(str, float, float)
+    shot_done = pyqtSignal(object)
+
+
+    def __init__(self, dpsd_dic):
+
+        if sys.version_info[0] == 3:
+            super().__init__()
+        else:
+            super(QThread, self).__init__()
+        self.dpsd_dic = dpsd_dic
+        self.cancel = threading.Event()
+
+
+    def run(self):
+
+        try:
+            dpsd_run.DPSD(self.dpsd_dic, progress=self.progress.emit, cancel=self.cancel, on_shot=self.shot_done.emit)
+        except Exception as err:
+            logger.exception('DPSD run failed: %s', err)
+
+
 class DPSD(QMainWindow):
 
 
@@ -156,6 +181,16 @@ class DPSD(QMainWindow):
             but.clicked.connect(fmap[lbl])
             tbar_grid.addWidget(but, 0, jpos)
             jpos += 1
+        self.stop_but = QPushButton('Stop')
+        self.stop_but.setEnabled(False)
+        self.stop_but.clicked.connect(self.stop)
+        tbar_grid.addWidget(self.stop_but, 0, jpos)
+        jpos += 1
+        self.progress = QProgressBar()
+        self.progress.setFormat('Idle')
+        self.progress.setValue(0)
+        tbar_grid.addWidget(self.progress, 0, jpos, 1, 3)
+        jpos += 3
         tbar_grid.addWidget(dum_lbl,  0, jpos, 1, 10)
 
 # User options
@@ -171,7 +206,8 @@ class DPSD(QMainWindow):
 
 # Entry widgets
 
-        self.rblists = {'Shotfile exp':['AUGD', os.getenv('USER')]}
+        self.rblists = {'Shotfile exp':['AUGD', os.getenv('USER')], 'Output backend': ['shotfile', 'npz', 'hdf5'], \
+            'Pulse retention': ['all', 'reservoir', 'none'], 'Preview mode': ['k-th', 'stratified']}
 
 #----------
 # I/O files
@@ -180,7 +216,7 @@ class DPSD(QMainWindow):
         jrow = 0
         node = 'io'
 
-        for key in ('HA*.dat file', 'Shots'):
+        for key in ('HA*.dat file', 'Shots', 'Output dir'):
             lbl = QLabel(key)
             self.gui[node][key] = QLineEdit(self.setup_init[node][key])
             input_layout.addWidget(lbl, jrow, 0)
@@ -188,12 +224,11 @@ class DPSD(QMainWindow):
             jrow += 1
 
         key = 'Write shotfiles'
-        if 'aug_sfutils' in sys.modules:
-            self.gui[node][key] = QCheckBox(key)
-            input_layout.addWidget(self.gui[node][key], jrow, 0, 1, 2)
-            if self.setup_init[node][key]:
-                self.gui[node][key].setChecked(True)
-            jrow += 1
+        self.gui[node][key] = QCheckBox(key)
+        input_layout.addWidget(self.gui[node][key], jrow, 0, 1, 2)
+        if self.setup_init[node][key]:
+            self.gui[node][key].setChecked(True)
+        jrow += 1
 
         key = 'Force SF write'
         if 'aug_sfutils' in sys.modules:
@@ -205,8 +240,9 @@ class DPSD(QMainWindow):
 
 # Radiobutton
 
-        key = 'Shotfile exp'
-        if 'aug_sfutils' in sys.modules:
+        for key in ('Shotfile exp', 'Output backend', 'Pulse retention', 'Preview mode'):
+            if key == 'Shotfile exp' and 'aug_sfutils' not in sys.modules:
+                continue
             rblist = self.rblists[key]
             self.gui[node][key] = QButtonGroup(self)
             lbl = QLabel(key)
@@ -221,6 +257,15 @@ class DPSD(QMainWindow):
                 self.gui[node][key].addButton(but)
                 self.gui[node][key].setId(but, jcol)
             jrow += 1
+            if key == 'Pulse retention':
+                key = 'Reservoir size'
+                lbl = QLabel(key)
+                self.gui[node][key] = QSpinBox()
+                self.gui[node][key].setRange(0, int(1e7))
+                self.gui[node][key].setValue(self.setup_init[node][key])
+                input_layout.addWidget(lbl, jrow, 0)
+                input_layout.addWidget(self.gui[node][key], jrow, 1)
+                jrow += 1
 
         input_layout.setRowStretch(input_layout.rowCount(), 1)
 
@@ -228,17 +273,17 @@ class DPSD(QMainWindow):
 # Setup
 #------
 
-        entries = ['Time step', 'Start time', 'End time', '#samples for analysis']
+        entries = ['Time step', 'Start time', 'End time', '#samples for analysis', 'Finest time step', 'Preview fraction', 'Spectrogram classes']
         self.new_tab(setup_layout, 'setup', entries=entries)
 
 #-----
 # Peak
 #-----
 
-        cb = ['Subtract baseline']
+        cb = ['Subtract baseline', 'Prefix integrals', 'Integer samples', 'Pile-up decomposition']
         entries = ['Baseline start', 'Baseline end', 'Threshold', \
             'Front', 'Tail', 'Saturation upper limit', 'Saturation lower limit', \
-            'Long gate', 'Short gate', 'Maximum difference']
+            'Long gate', 'Short gate', 'Maximum difference', 'Max pulses per window', 'Pile-up min fraction']
         self.new_tab(peak_layout, 'peak', entries, checkbuts=cb)
 
 #-----------
@@ -249,7 +294,7 @@ class DPSD(QMainWindow):
             'Lower PH-limit for DD', 'Upper PH-limit for DD', \
             'Lower PH-limit for DT', 'Upper PH-limit for DT', \
             'Slope of 1st sep.line', 'Slope of 2nd sep.line', 'Offset of 1st sep.line', \
-            'Bin line1 -> line2']
+            'Bin line1 -> line2', 'Classifier', 'Separation points']
         self.new_tab(sep_layout, 'separation', entries)
 
 #---------------
@@ -298,7 +343,7 @@ class DPSD(QMainWindow):
             elif isinstance(val, float):
                 self.gui[node][key] = QDoubleSpinBox()
                 self.gui[node][key].setRange(-1000., 1000.)
-                self.gui[node][key].setDecimals(4)
+                self.gui[node][key].setDecimals(6)
                 self.gui[node][key].setValue(val)
             layout.addWidget(qlbl         , jrow, 0)
             layout.addWidget(self.gui[node][key], jrow, 1)
@@ -388,8 +433,45 @@ class DPSD(QMainWindow):
 
     def run(self):
 
+        if hasattr(self, 'worker') and self.worker.isRunning():
+            logger.error('DPSD is running already, stop it first')
+            return
         dpsd_dic = self.gui2json()
-        self.dp = dpsd_run.DPSD(dpsd_dic)
+        self.worker = DPSD_WORKER(dpsd_dic)
+        self.worker.progress.connect(self.show_progress)
+        self.worker.shot_done.connect(self.new_result)
+        self.worker.finished.connect(self.run_finished)
+        self.stop_but.setEnabled(True)
+        self.worker.start()
+
+
+    def stop(self):
+
+        if hasattr(self, 'worker'):
+            self.worker.cancel.set()
+
+
+    def show_progress(self, stage, done, total):
+
+        self.progress.setMaximum(100)
+        self.progress.setValue(int(100*done/total) if total > 0 else 100)
+        self.progress.setFormat('%s %%p%%' %stage)
+
+
+    def new_result(self, dp):
+
+        self.dp = dp
+        if hasattr(dp, 'nshot'):
+            logger.info('Results for #%d available', dp.nshot)
+
+
+    def run_finished(self):
+
+        self.stop_but.setEnabled(False)
+        if self.worker.cancel.is_set():
+            self.progress.setFormat('Cancelled')
+        else:
+            self.progress.setFormat('Done')
         logger.info('Done calculation')
 
 
@@ -405,12 +487,26 @@ class DPSD(QMainWindow):
         fig3 = plot_dpsd.fig_cnt(self.dp)
         fig4 = plot_dpsd.fig_pmg(self.dp)
         fig5 = plot_dpsd.fig_win(self.dp)
+        fig6 = plot_dpsd.fig_pulse_stats(self.dp)
 
         self.wid.addPlot('PH-PS separation'     , fig1)
         self.wid.addPlot('Pulse Height spectra', fig2)
         self.wid.addPlot('Count rates'          , fig3)
         self.wid.addPlot('PM gain'              , fig4)
         self.wid.addPlot('Window lengths', fig5)
+        self.wid.addPlot('Pulse shapes', fig6)
+
+        def sep_changed(dp):
+            plot_dpsd.update_phs(fig2, dp)
+            plot_dpsd.update_cnt(fig3, dp)
+            for key, val in dp.setup['separation'].items():
+                widget = self.gui['separation'].get(key)
+                if isinstance(widget, (QSpinBox, QDoubleSpinBox)):
+                    widget.setValue(val)
+                elif isinstance(widget, QLineEdit): # e.g. the dragged 'Separation points'
+                    widget.setText(str(val))
+
+        self.sep_editor = plot_dpsd.SEP_EDITOR(fig1, self.dp, on_change=sep_changed)
 
         self.wid.show()
 
@@ -421,6 +517,9 @@ class DPSD(QMainWindow):
             logger.error('Run code before plotting')
             return
 
+        if len(self.dp.pulse_index) == 0:
+            logger.error('No pulses retained, set "Pulse retention" to all or reservoir')
+            return
         self.pul = plot_pulses.plotWindow(self.dp)
         self.pul.show()
  
@@ -430,7 +529,7 @@ class DPSD(QMainWindow):
         if hasattr(self, 'dp'):
             dic = self.get_gui_tab('io')
             if self.dp.status:
-                self.dp.sfwrite(exp=dic['SFexp'], force=dic['SFforce'])
+                self.dp.sfwrite(exp=dic['Shotfile exp'], force=dic['Force SF write'])
         else:
             logger.error('Run DPSD first, then write Shotfile')
 
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+import os, sys, json, struct, logging, zlib, lzma, bz2
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import read_ha
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDarc')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+# Container: magic, compressed chunks, JSON chunk index, uint64 index offset, magic
+magic = b'HAC1'
+
+codecs = {
+    'zlib': (lambda b, level: zlib.compress(b, level), zlib.decompress),
+    'lzma': (lambda b, level: lzma.compress(b, preset=level), lzma.decompress),
+    'bz2' : (lambda b, level: bz2.compress(b, max(level, 1)), bz2.decompress)}
+try:
+    import zstandard
+    codecs['zstd'] = (lambda b, level: zstandard.ZstdCompressor(level=level).compress(b), \
+        lambda b: zstandard.ZstdDecompressor().decompress(b))
+except ImportError:
+    pass
+try:
+    import lz4.frame
+    codecs['lz4'] = (lambda b, level: lz4.frame.compress(b, compression_level=level), lz4.frame.decompress)
+except ImportError:
+    pass
+
+
+def encode(data, codec='zlib', level=1):
+# Delta along the samples, then byte-shuffle (all low bytes, then all high bytes)
+
+    delta = np.diff(data, prepend=np.uint16(0))
+    shuffled = np.ascontiguousarray(delta.view(np.uint8).reshape(-1, 2).T)
+    return codecs[codec][0](shuffled.tobytes(), level)
+
+
+def decode(blob, n_words, codec='zlib'):
+
+    shuffled = np.frombuffer(codecs[codec][1](blob), dtype=np.uint8).reshape(2, n_words)
+    delta = np.ascontiguousarray(shuffled.T).view(np.uint16).ravel()
+    return np.cumsum(delta, dtype=np.uint16)
+
+
+def convert(fin, fout=None, chunk_words=1<<20, codec='zlib', level=1):
+# HA_*.dat -> HA_*.hac, chunks split at window boundaries
+
+    if fout is None:
+        fout = os.path.splitext(fin)[0] + '.hac'
+    data = np.fromfile(fin, dtype=np.uint16)
+    boundaries, tdiff = read_ha.scan_header(data)
+    ticks = np.cumsum(tdiff, dtype=np.int64)
+    fmd5 = fin + '.md5'
+    md5 = open(fmd5).read().strip() if os.path.isfile(fmd5) else None
+
+# First boundary of each chunk
+    jbnd = [0]
+    while len(boundaries) > 0:
+        jnext = np.searchsorted(boundaries, boundaries[jbnd[-1]] + chunk_words)
+        if jnext >= len(boundaries):
+            break
+        jbnd.append(jnext)
+    starts = [0] + [int(boundaries[j]) for j in jbnd[1:]]
+    ends = starts[1:] + [len(data)]
+    jbnd_end = jbnd[1:] + [len(boundaries)]
+
+    chunks = []
+    with open(fout + '.tmp', 'wb') as f:
+        f.write(magic)
+        for w0, w1, jb0, jb1 in zip(starts, ends, jbnd, jbnd_end):
+            blob = encode(data[w0: w1], codec=codec, level=level)
+            chunks.append({'offset': f.tell(), 'nbytes': len(blob), 'word0': w0, 'n_words': w1 - w0, \
+                'n_pulses': int(jb1 - jb0), 'ticks0': int(ticks[jb0] - tdiff[jb0]) if jb1 > jb0 else 0, \
+                't_start': 1e-8*float(ticks[jb0]) if jb1 > jb0 else None, \
+                't_end': 1e-8*float(ticks[jb1-1]) if jb1 > jb0 else None})
+            f.write(blob)
+        index_offset = f.tell()
+        index_d = {'version': 1, 'codec': codec, 'filter': 'delta+shuffle', 'n_words': len(data), \
+            'source': os.path.basename(fin), 'md5': md5, 'chunks': chunks}
+        f.write(json.dumps(index_d).encode())
+        f.write(struct.pack('<Q', index_offset))
+        f.write(magic)
+    os.replace(fout + '.tmp', fout)
+    logger.info('%s: %d chunks, compression ratio %5.2f', fout, len(chunks), 2.*len(data)/os.path.getsize(fout))
+    return fout
+
+
+class HA_ARCHIVE:
+
+
+    def __init__(self, fin):
+
+        self.fin = fin
+        with open(fin, 'rb') as f:
+            if f.read(4) != magic:
+                raise ValueError('%s is not a HA archive' %fin)
+            f.seek(-12, os.SEEK_END)
+            index_offset, = struct.unpack('<Q', f.read(8))
+            end = f.tell() - 8
+            f.seek(index_offset)
+            self.index = json.loads(f.read(end - index_offset).decode())
+        self.chunks = self.index['chunks']
+        self.md5 = self.index['md5']
+
+
+    def select(self, t_range=None):
+
+        if t_range is None:
+            return 0, len(self.chunks)
+        jsel = [j for j, c in enumerate(self.chunks) if c['n_pulses'] > 0 and \
+            c['t_end'] >= t_range[0] and c['t_start'] <= t_range[1]]
+        if not jsel:
+            return 0, 0
+        return jsel[0], jsel[-1] + 1
+
+
+    def read_chunk(self, jchunk):
+
+        c = self.chunks[jchunk]
+        with open(self.fin, 'rb') as f:
+            f.seek(c['offset'])
+            blob = f.read(c['nbytes'])
+        return decode(blob, c['n_words'], codec=self.index['codec'])
+
+
+    def read(self, t_range=None, n_threads=4):
+# Returns the raw uint16 words of the chunks overlapping t_range [s] and
+# the time [1e-8 s] before the first window read
+
+        j0, j1 = self.select(t_range)
+        if j1 == j0:
+            return np.zeros(0, dtype=np.uint16), 0
+        logger.info('Decompressing %d of %d chunks', j1 - j0, len(self.chunks))
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            parts = list(pool.map(self.read_chunk, range(j0, j1)))
+        return np.concatenate(parts), self.chunks[j0]['ticks0']
+
+
+if __name__ == '__main__':
+
+    for fin in sys.argv[1:]:
+        convert(fin)
@@ -0,0 +1,80 @@
+import numpy as np
+
+# Classification state of all events in one uint16 bitfield
+
+bits = {'sat': 0, 'led': 1, 'pileup': 2, 'phys': 3, 'neut1': 4, 'gamma1': 5, \
+    'DD': 6, 'DT': 7, 'adc_fixed': 8, 'sat_low': 9}
+
+
+def bitmask(specs):
+
+    mask = 0
+    for spec in specs:
+        mask |= (1 << bits[spec])
+    return np.uint16(mask)
+
+
+class FLAGS:
+# Also a drop-in for the former dict of boolean arrays: flg['neut1'] returns a
+# boolean array, flg['led'] = mask sets the bit
+
+
+    def __init__(self, n_events):
+
+        self.bits = np.zeros(n_events, dtype=np.uint16)
+
+
+    def __getitem__(self, spec):
+
+        return (self.bits & bitmask([spec])) != 0
+
+
+    def __setitem__(self, spec, mask):
+
+        bit = bitmask([spec])
+        self.bits &= ~bit
+        self.bits |= np.asarray(mask, dtype=bool).astype(np.uint16) << np.uint16(bits[spec])
+
+
+    def __contains__(self, spec):
+
+        return spec in bits
+
+
+    def keys(self):
+
+        return bits.keys()
+
+
+    def items(self):
+
+        return ((spec, self[spec]) for spec in bits)
+
+
+    def select(self, all_of=(), none_of=(), any_of=()):
+# Events with all bits of all_of, none of none_of and (if given) at least one of any_of
+
+        m_all = bitmask(all_of)
+        sel = (self.bits & (m_all | bitmask(none_of))) == m_all
+        if any_of:
+            sel &= (self.bits & bitmask(any_of)) != 0
+        return sel
+
+
+    def count(self, all_of=(), none_of=(), any_of=()):
+
+        return int(np.count_nonzero(self.select(all_of, none_of, any_of)))
+
+
+    def where(self, all_of=(), none_of=(), any_of=()):
+
+        return np.flatnonzero(self.select(all_of, none_of, any_of))
+
+
+    def event_type(self):
+# 0 neutron, 1 gamma, 2 pile-up, 3 LED (later ones override), -1 else
+
+        etype = np.full(len(self.bits), -1, dtype=np.int8)
+        for jtype, spec in enumerate(('neut1', 'gamma1', 'pileup', 'led')):
+            etype[self[spec]] = jtype
+        return etype
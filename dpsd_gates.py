@@ -0,0 +1,133 @@
+import logging
+import numpy as np
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDgates')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+fwhm = 2.*np.sqrt(2.*np.log(2.))
+
+
+def prefix_sum(pulses, baseline=None):
+# csum[j, k] = sum(pulses[j, :k] - baseline[j]), one extra leading column of zeros;
+# for integer pulses the baseline is subtracted as k*baseline after summing
+
+    csum = np.zeros((pulses.shape[0], pulses.shape[1] + 1))
+    if baseline is None:
+        np.cumsum(pulses, axis=1, out=csum[:, 1:])
+    else:
+        csum[:, 1:] = np.cumsum(pulses, axis=1, dtype=np.int64)
+        csum -= baseline[:, None]*np.arange(pulses.shape[1] + 1)
+    return csum
+
+
+def trapz(csum, bnd_l, bnd_r):
+# Same as kernels.slice_trapz(pulses, bnd_l, bnd_r), from four lookups per pulse
+
+    jrow = np.arange(csum.shape[0])
+    n_col = csum.shape[1] - 1
+    j1 = bnd_l + 1
+    j2 = np.maximum(bnd_r - 1, j1)
+    jend = (bnd_r - 1) %n_col
+    b = csum[jrow, np.minimum(j2, n_col)] - csum[jrow, np.minimum(j1, n_col)]
+    b += 0.5*(csum[jrow, bnd_l + 1] - csum[jrow, bnd_l] + csum[jrow, jend + 1] - csum[jrow, jend])
+    return b
+
+
+def otsu(hist, centre):
+# Threshold maximising the between-class variance of a 1D histogram
+
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist*centre)
+    m1 = m0[-1] - m0
+    ok = (w0 > 0) & (w1 > 0)
+    var_b = np.zeros(len(hist))
+    var_b[ok] = w0[ok]*w1[ok]*(m0[ok]/w0[ok] - m1[ok]/w1[ok])**2
+    return np.argmax(var_b)
+
+
+def gauss_peak(hist, centre, n_iter=4):
+# Mean and sigma of the main peak of a histogram: weighted parabola fit to log(hist)
+# over +-2 sigma around the peak, started from the half-maximum width
+
+    jmax = np.argmax(hist)
+    above = hist >= 0.5*hist[jmax]
+    jl = jmax
+    while jl > 0 and above[jl - 1]:
+        jl -= 1
+    jr = jmax
+    while jr < len(hist) - 1 and above[jr + 1]:
+        jr += 1
+    dx = centre[1] - centre[0]
+    mean = centre[jmax]
+    sigma = max((jr - jl + 1)*dx/fwhm, dx)
+    for _ in range(n_iter):
+        sel = (np.abs(centre - mean) <= 2.*sigma) & (hist > 0)
+        if np.sum(sel) < 3:
+            break
+        x = centre[sel] - mean
+        c2, c1, _ = np.polyfit(x, np.log(hist[sel]), 2, w=np.sqrt(hist[sel]))
+        if c2 >= 0:
+            break
+        mean -= 0.5*c1/c2
+        sigma = np.sqrt(-0.5/c2)
+    return mean, sigma
+
+
+def fom(hist, centre, jcut=None):
+# Two populations split after bin jcut (default: the Otsu threshold): distance of
+# the peaks/(FWHM_1 + FWHM_2), peaks and widths from a Gaussian fit so that tails
+# and the population sizes do not enter. Counting noise still does: compare FOMs
+# only between scans of the same sample
+
+    if jcut is None:
+        jcut = otsu(hist, centre)
+    peak = []
+    for sl in (slice(0, jcut + 1), slice(jcut + 1, None)):
+        if np.sum(hist[sl]) == 0:
+            return np.nan, jcut
+        peak.append(gauss_peak(hist[sl], centre[sl]))
+    width = fwhm*(peak[0][1] + peak[1][1])
+    if width <= 0:
+        return np.nan, jcut
+    return (peak[1][0] - peak[0][0])/width, jcut
+
+
+def gate_scan(csum, maxpos, winlen, short_gates, long_gates, nyCh, mask=None):
+# Pulse-shape histogram and FOM for every (short, long) gate pair; each gate
+# integral is computed once and reused for all pairs
+
+    if mask is not None:
+        csum = csum[mask]
+        maxpos = maxpos[mask]
+        winlen = winlen[mask]
+    integral = {}
+    for gate in set(short_gates) | set(long_gates):
+        integral[gate] = trapz(csum, maxpos, np.minimum(maxpos + gate, winlen))
+    edges = np.linspace(-0.5, nyCh + 0.5, nyCh + 1)
+    centre = 0.5*(edges[1:] + edges[:-1])
+    table = {'Short gate': [], 'Long gate': [], 'fom': [], 'threshold': [], 'n_pulses': []}
+    ps_hist = []
+    for sgate in short_gates:
+        for lgate in long_gates:
+            if lgate <= sgate:
+                continue
+            ok = integral[lgate] > 0
+            ps = nyCh*integral[sgate][ok]/integral[lgate][ok]
+            hist = np.histogram(ps, bins=edges)[0]
+            fom_val, jcut = fom(hist, centre)
+            table['Short gate'].append(sgate)
+            table['Long gate'].append(lgate)
+            table['fom'].append(fom_val)
+            table['threshold'].append(centre[jcut])
+            table['n_pulses'].append(np.sum(ok))
+            ps_hist.append(hist)
+    table = {key: np.array(val) for key, val in table.items()}
+    table['ps_hist'] = np.array(ps_hist, dtype=np.int32).reshape(-1, nyCh)
+    table['ps_edges'] = edges
+    logger.info('Scanned %d gate pairs on %d pulses', len(table['fom']), csum.shape[0])
+    return table
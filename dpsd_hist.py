@@ -0,0 +1,202 @@
+import numpy as np
+
+
+def hist2d(jx, jy, nx, ny, mask=None):
+# Integer 2D histogram from precomputed bin indices (-1 = outside)
+
+    ok = (jx >= 0) & (jy >= 0)
+    if mask is not None:
+        ok &= mask
+    hist = np.bincount(jx[ok].astype(np.int64)*ny + jy[ok], minlength=nx*ny)
+    return hist.astype(np.int32).reshape(nx, ny)
+
+
+class HIST2D_PYRAMID:
+# 2D histogram plus successive 2x2 aggregations, level 0 is the full resolution
+
+
+    def __init__(self, hist, xrange, yrange, min_bins=32):
+
+        self.xrange = xrange
+        self.yrange = yrange
+        self.levels = [hist]
+        while min(hist.shape) > min_bins:
+            nx, ny = hist.shape
+            hist = np.pad(hist, ((0, nx %2), (0, ny %2)))
+            hist = hist.reshape(hist.shape[0]//2, 2, hist.shape[1]//2, 2).sum(axis=(1, 3))
+            self.levels.append(hist)
+
+
+    def level_for(self, xlim, ylim, npix_x, npix_y):
+# Coarsest level still having at least one bin per screen pixel
+
+        nx0, ny0 = self.levels[0].shape
+        bins_x = nx0*(xlim[1] - xlim[0])/(self.xrange[1] - self.xrange[0])
+        bins_y = ny0*(ylim[1] - ylim[0])/(self.yrange[1] - self.yrange[0])
+        ratio = min(bins_x/max(npix_x, 1), bins_y/max(npix_y, 1))
+        if ratio <= 1:
+            return 0
+        return min(int(np.log2(ratio)), len(self.levels) - 1)
+
+
+    def density(self, level, xlim=None, ylim=None):
+# Counts per full-resolution bin of the visible part, and its extent
+
+        hist = self.levels[level]
+        nx, ny = hist.shape
+        dx = (self.xrange[1] - self.xrange[0])*2**level/self.levels[0].shape[0]
+        dy = (self.yrange[1] - self.yrange[0])*2**level/self.levels[0].shape[1]
+        jx0, jx1, jy0, jy1 = 0, nx, 0, ny
+        if xlim is not None:
+            jx0 = int(np.clip(np.floor((xlim[0] - self.xrange[0])/dx), 0, nx - 1))
+            jx1 = int(np.clip(np.ceil ((xlim[1] - self.xrange[0])/dx), jx0 + 1, nx))
+        if ylim is not None:
+            jy0 = int(np.clip(np.floor((ylim[0] - self.yrange[0])/dy), 0, ny - 1))
+            jy1 = int(np.clip(np.ceil ((ylim[1] - self.yrange[0])/dy), jy0 + 1, ny))
+        dens = hist[jx0: jx1, jy0: jy1]/float(4**level)
+        extent = [self.xrange[0] + jx0*dx, self.xrange[0] + jx1*dx, self.yrange[0] + jy0*dy, self.yrange[0] + jy1*dy]
+        return dens, extent
+
+
+class RATE_PYRAMID:
+# Counts per class at the finest time step plus successive aggregations by factor.
+# trace() picks the level matching the visible range and min/max decimates it to pixels
+
+
+    def __init__(self, jbin, masks, t0, dt, n_bins, factor=10, min_bins=100, weight=None):
+# weight: events represented by each counted event (preview subsampling), the counts
+# are then float32 sums of the weights
+
+        self.t0 = t0
+        self.factor = factor
+        self.dt = [dt]
+        self.levels = [{}]
+        ok = (jbin >= 0)
+        for spec, mask in masks.items():
+            sel = ok & mask
+            if weight is None:
+                cnt = np.bincount(jbin[sel], minlength=n_bins)
+                self.levels[0][spec] = cnt.astype(np.min_scalar_type(max(np.max(cnt), 1)))
+            else:
+                self.levels[0][spec] = np.bincount(jbin[sel], weights=weight[sel], minlength=n_bins).astype(np.float32)
+        while n_bins > min_bins:
+            n_bins = -(-n_bins//factor)
+            level = {}
+            for spec, cnt in self.levels[-1].items():
+                dtype = np.int32 if weight is None else np.float32
+                cnt = np.pad(cnt.astype(dtype), (0, n_bins*factor - len(cnt)))
+                level[spec] = cnt.reshape(n_bins, factor).sum(axis=1, dtype=dtype)
+            self.levels.append(level)
+            self.dt.append(self.dt[-1]*factor)
+
+
+    def level_for(self, tlim, npix):
+# Coarsest level with at least one bin per pixel
+
+        for jlev in range(len(self.levels)-1, -1, -1):
+            if (tlim[1] - tlim[0])/self.dt[jlev] >= npix:
+                return jlev
+        return 0
+
+
+    def trace(self, spec, tlim, npix):
+# Rate [1/s] in the visible range: (time, rate) for a zig-zag min/max line
+
+        jlev = self.level_for(tlim, npix)
+        dt = self.dt[jlev]
+        cnt = self.levels[jlev][spec]
+        j0 = int(np.clip(np.floor((tlim[0] - self.t0)/dt), 0, len(cnt) - 1))
+        j1 = int(np.clip(np.ceil ((tlim[1] - self.t0)/dt), j0 + 1, len(cnt)))
+        rate = cnt[j0: j1]/dt
+        if j1 - j0 <= npix:
+            tbin = self.t0 + dt*(j0 + 0.5 + np.arange(j1 - j0))
+            return tbin, rate
+        jbuck = np.unique(np.linspace(0, j1 - j0, npix + 1).astype(np.int64)[:-1])
+        tbuck = self.t0 + dt*(j0 + jbuck + 0.5)
+        t = np.repeat(tbuck, 2)
+        y = np.empty(2*len(jbuck))
+        y[0::2] = np.minimum.reduceat(rate, jbuck)
+        y[1::2] = np.maximum.reduceat(rate, jbuck)
+        return t, y
+
+
+def spectrogram(jt, jph, n_t, n_ph, t_edges, mask=None, weight=None):
+# Sparse time x PH histogram from precomputed bin indices (-1 = outside);
+# with weights (preview mode) the counts are the float32 sums of the weights
+
+    ok = (jt >= 0) & (jph >= 0)
+    if mask is not None:
+        ok &= mask
+    if weight is None:
+        key, counts = np.unique(jt[ok].astype(np.int64)*n_ph + jph[ok], return_counts=True)
+        counts = counts.astype(np.min_scalar_type(max(np.max(counts, initial=0), 1)))
+    else:
+        key, jkey = np.unique(jt[ok].astype(np.int64)*n_ph + jph[ok], return_inverse=True)
+        counts = np.bincount(jkey, weights=weight[ok], minlength=len(key)).astype(np.float32)
+    indptr = np.searchsorted(key//n_ph, np.arange(n_t + 1))
+    jph_nz = (key %n_ph).astype(np.uint16 if n_ph <= 65536 else np.int32)
+    return SPECTROGRAM(indptr, jph_nz, counts, t_edges, n_ph)
+
+
+def load_spectrograms(arrays, n_ph):
+# {'<spec>_indptr': ..., '<spec>_jph': ..., ...} as saved by DPSD.results()
+
+    specs = [key[:-len('_indptr')] for key in arrays if key.endswith('_indptr')]
+    return {spec: SPECTROGRAM(*[np.asarray(arrays['%s_%s' %(spec, key)]) for key in ('indptr', 'jph', 'counts', 't_edges')], n_ph) \
+        for spec in specs}
+
+
+class SPECTROGRAM:
+# Non-empty bins stored row by row (one row per time bin, CSR layout):
+# the entries of time bin j are indptr[j]: indptr[j+1] of jph and counts
+
+
+    def __init__(self, indptr, jph, counts, t_edges, n_ph):
+
+        self.indptr = indptr
+        self.jph = jph
+        self.counts = counts
+        self.t_edges = t_edges
+        self.n_ph = n_ph
+
+
+    def arrays(self):
+
+        return {'indptr': self.indptr, 'jph': self.jph, 'counts': self.counts, 't_edges': self.t_edges}
+
+
+    def rows(self, t_range):
+# Time bins with the centre inside t_range
+
+        tbin = 0.5*(self.t_edges[1:] + self.t_edges[:-1])
+        return np.searchsorted(tbin, t_range[0], side='left'), np.searchsorted(tbin, t_range[1], side='right')
+
+
+    def spectrum(self, t_ranges, rate=True):
+# PH spectrum summed over one [t0, t1] or several [[t0, t1], ...] time windows,
+# divided by the duration of the summed time bins if rate
+
+        if np.ndim(t_ranges) == 1:
+            t_ranges = [t_ranges]
+        spec = np.zeros(self.n_ph)
+        duration = 0.
+        for t_range in t_ranges:
+            j0, j1 = self.rows(t_range)
+            jnz = slice(self.indptr[j0], self.indptr[j1])
+            spec += np.bincount(self.jph[jnz], weights=self.counts[jnz], minlength=self.n_ph)
+            duration += self.t_edges[j1] - self.t_edges[j0]
+        if rate:
+            return spec/max(duration, 1e-12)
+        return spec
+
+
+    def lightcurve(self, ph_range, rate=True):
+# Counts (or rate) per time bin of the PH bins ph_range[0] ... ph_range[1]
+
+        n_t = len(self.indptr) - 1
+        jrow = np.repeat(np.arange(n_t), np.diff(self.indptr))
+        sel = (self.jph >= ph_range[0]) & (self.jph <= ph_range[1])
+        cnt = np.bincount(jrow[sel], weights=self.counts[sel], minlength=n_t)
+        if rate:
+            return cnt/np.diff(self.t_edges)
+        return cnt
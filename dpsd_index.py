@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import os, sys, re, json, time, logging
+import numpy as np
+import read_ha
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDidx')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+
+class HA_INDEX:
+# Local JSON index of all HA files (HA_*.dat, or their HA_*.hac archives) of the NSP tree.
+# Only directories whose mtime changed since the last scan are listed again; in the
+# others, files without md5 or modified within the last `recent` seconds are re-stat'd
+
+
+    def __init__(self, f_index, raw_dir=read_ha.raw_dir, recent=3600.):
+
+        self.f_index = f_index
+        self.raw_dir = raw_dir
+        self.recent = recent
+        self.dirs  = {}
+        self.files = {}
+        self.children = {}
+        self.pending = {}
+        self.visited = set()
+        if os.path.isfile(f_index):
+            with open(f_index) as fjson:
+                index_d = json.load(fjson)
+            self.raw_dir = index_d['raw_dir']
+            self.dirs = index_d['dirs']
+            self.files = {int(nshot): entry for nshot, entry in index_d['files'].items()}
+
+
+    def save(self):
+
+        index_d = {'raw_dir': self.raw_dir, 'dirs': self.dirs, \
+            'files': {str(nshot): entry for nshot, entry in sorted(self.files.items())}}
+        ftmp = self.f_index + '.tmp'
+        with open(ftmp, 'w') as fjson:
+            json.dump(index_d, fjson)
+        os.replace(ftmp, self.f_index)
+
+
+    def index_file(self, nshot, path, stat, headers=False):
+# Returns 1 if the entry is new or changed
+
+        old = self.files.get(nshot)
+        same = (old is not None and old['path'] == path and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime)
+        if path.endswith('.hac'): # md5 in the archive index, fixed once the archive is written
+            if same:
+                return 0
+            md5 = has_md5(path)
+        else:
+            md5 = os.path.isfile(path + '.md5')
+            if same and old['md5'] == md5:
+                return 0
+        self.files[nshot] = {'shot': nshot, 'path': path, 'size': stat.st_size, \
+            'mtime': stat.st_mtime, 'md5': md5}
+        if headers:
+            self.files[nshot].update(header_info(path))
+        return 1
+
+
+    def scan_dir(self, path, headers=False):
+
+        n_new = 0
+        found = {}
+        for entry in os.scandir(path):
+            if entry.is_dir() and entry.name.isdigit():
+                n_new += self.update_dir(entry.path, headers=headers)
+                continue
+            m = re.match(r'HA_(\d+)\.(dat|hac)$', entry.name)
+            if m is None:
+                continue
+            nshot = int(m.group(1))
+            if m.group(2) == 'dat' or nshot not in found: # HA_*.dat first, as read_ha.ha_file
+                found[nshot] = entry
+        seen = set(found)
+        for nshot, entry in found.items():
+            n_new += self.index_file(nshot, entry.path, entry.stat(), headers=headers)
+        for nshot in [nshot for nshot, entry in self.files.items() if os.path.dirname(entry['path']) == path]:
+            if nshot not in seen:
+                del self.files[nshot]
+        return n_new
+
+
+    def restat(self, path, headers=False):
+# Files of an unchanged directory that may still have been growing when indexed
+
+        n_new = 0
+        for nshot in self.pending.get(path, []):
+            fin = self.files[nshot]['path']
+            try:
+                stat = os.stat(fin)
+            except FileNotFoundError:
+                del self.files[nshot]
+                continue
+            n_new += self.index_file(nshot, fin, stat, headers=headers)
+        return n_new
+
+
+    def update_dir(self, path, headers=False):
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError: # removed, pruned at the end of update()
+            return 0
+        self.visited.add(path)
+        if self.dirs.get(path) == mtime: # unchanged listing, but known subdirs and growing files may have changed
+            n_new = self.restat(path, headers=headers)
+            for subdir in self.children.get(path, []):
+                n_new += self.update_dir(subdir, headers=headers)
+            return n_new
+        n_new = self.scan_dir(path, headers=headers)
+        self.dirs[path] = mtime
+        return n_new
+
+
+    def update(self, headers=False):
+# headers=True also reads the event count and time span of new files (slow)
+
+        self.children = {}
+        for path in self.dirs:
+            self.children.setdefault(os.path.dirname(path), []).append(path)
+        self.pending = {}
+        t_recent = time.time() - self.recent
+        for nshot, entry in self.files.items():
+            if not entry['md5'] or entry['mtime'] > t_recent:
+                self.pending.setdefault(os.path.dirname(entry['path']), []).append(nshot)
+        self.visited = set()
+        n_new = 0
+        for entry in os.scandir(self.raw_dir):
+            if entry.is_dir() and entry.name.isdigit():
+                n_new += self.update_dir(entry.path, headers=headers)
+# Directories not reached any more have been removed, with their files
+        n_dirs = len(self.dirs)
+        self.dirs = {path: mtime for path, mtime in self.dirs.items() if path in self.visited}
+        self.files = {nshot: entry for nshot, entry in self.files.items() if os.path.dirname(entry['path']) in self.visited}
+        logger.info('Indexed %d HA files, %d new or changed, %d directories removed', len(self.files), n_new, n_dirs - len(self.dirs))
+        self.save()
+
+
+    def path(self, nshot):
+
+        entry = self.files.get(nshot)
+        if entry is None:
+            return None
+        return entry['path']
+
+
+    def query(self, shots=None, newer=None, larger=None, md5=None):
+# shots: (first, last) inclusive; newer: mtime [s since epoch]; larger: size [bytes]
+
+        sel = []
+        for nshot, entry in sorted(self.files.items()):
+            if shots is not None and not (shots[0] <= nshot <= shots[1]):
+                continue
+            if newer is not None and entry['mtime'] <= newer:
+                continue
+            if larger is not None and entry['size'] <= larger:
+                continue
+            if md5 is not None and entry['md5'] != md5:
+                continue
+            sel.append(entry)
+        return sel
+
+
+    def plan(self, n_shots, n_workers):
+# Split shots into n_workers lists of similar total file size, skipping missing shots
+
+        entries = [self.files[nshot] for nshot in n_shots if nshot in self.files]
+        load = np.zeros(n_workers)
+        lists = [[] for j in range(n_workers)]
+        for entry in sorted(entries, key=lambda e: -e['size']):
+            jw = np.argmin(load)
+            lists[jw].append(entry['shot'])
+            load[jw] += entry['size']
+        return [sorted(shots) for shots in lists]
+
+
+def has_md5(fin):
+
+    try:
+        return read_ha.has_md5(fin)
+    except (OSError, ValueError) as err:
+        logger.warning('Cannot read %s: %s', fin, err)
+        return False
+
+
+def header_info(fin):
+
+    if fin.endswith('.hac'): # from the chunk index, nothing to decompress
+        import dpsd_archive
+        chunks = [c for c in dpsd_archive.HA_ARCHIVE(fin).chunks if c['n_pulses'] > 0]
+        if not chunks:
+            return {'n_events': 0, 't_start': None, 't_end': None}
+        return {'n_events': sum(c['n_pulses'] for c in chunks), 't_start': chunks[0]['t_start'], 't_end': chunks[-1]['t_end']}
+    data = np.fromfile(fin, dtype=np.uint16)
+    boundaries, tdiff = read_ha.scan_header(data)
+    if len(tdiff) == 0:
+        return {'n_events': 0, 't_start': None, 't_end': None}
+    t_events = 1e-8*np.cumsum(tdiff, dtype=np.float64)
+    return {'n_events': len(tdiff), 't_start': float(t_events[0]), 't_end': float(t_events[-1])}
+
+
+if __name__ == '__main__':
+
+    f_index = sys.argv[1] if len(sys.argv) > 1 else '%s/.dpsd_index.json' %os.path.expanduser('~')
+    index = HA_INDEX(f_index)
+    index.update(headers=('--headers' in sys.argv))
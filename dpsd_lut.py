@@ -0,0 +1,111 @@
+import numpy as np
+
+# Separation geometries compiled into a (PH bin, PS bin) -> class code table,
+# so that classifying the events is a single gather of lut[jbin_ph, jbin_ps]
+
+NEUT  = 1
+GAMMA = 2
+DD    = 4
+DT    = 8
+
+
+def bin_centres(n_bins):
+# Centres of the n_bins bins spanning [-0.5, n_bins + 0.5], as used for PH and PS
+
+    return -0.5 + (np.arange(n_bins) + 0.5)*(n_bins + 1.)/n_bins
+
+
+def parse_points(txt):
+# 'ph1, ps1; ph2, ps2; ...' -> (n, 2) array
+
+    pts = [[float(x) for x in pair.split(',')] for pair in txt.split(';') if pair.strip()]
+    return np.array(pts, dtype=np.float64).reshape(-1, 2)
+
+
+def format_points(pts):
+
+    return '; '.join('%g, %g' %(x, y) for x, y in pts)
+
+
+def free_form(sep_d):
+# True for the geometries given by 'Separation points'
+
+    return sep_d.get('Classifier', 'lines').strip().lower() in ('curve', 'polygon')
+
+
+def neutron_lines(sep_d, x, y):
+# The two-line cut of DPSD.classify, at the bin centres
+
+    knot = sep_d['Bin line1 -> line2']
+    offset2 = sep_d['Offset of 1st sep.line'] + sep_d['Slope of 1st sep.line']*knot
+    line = np.where(x <= knot, sep_d['Offset of 1st sep.line'] + sep_d['Slope of 1st sep.line']*x, \
+        offset2 + sep_d['Slope of 2nd sep.line']*(x - knot))
+    return y[None, :] <= line[:, None]
+
+
+def neutron_curve(pts, x, y):
+# Neutrons below a piecewise linear PS(PH), constant beyond the end points
+
+    jsort = np.argsort(pts[:, 0])
+    line = np.interp(x, pts[jsort, 0], pts[jsort, 1])
+    return y[None, :] <= line[:, None]
+
+
+def neutron_polygon(pts, x, y):
+# Even-odd fill: for each PH column, count the polygon edges crossed below each PS centre
+
+    x0, y0 = pts[:, 0], pts[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    nx, ny = len(x), len(y)
+    cross = ((x0[None, :] <= x[:, None]) != (x1[None, :] <= x[:, None]))
+    jx, jedge = np.where(cross)
+    frac = (x[jx] - x0[jedge])/(x1[jedge] - x0[jedge])
+    y_cross = y0[jedge] + frac*(y1[jedge] - y0[jedge])
+    jy = np.searchsorted(y, y_cross, side='left')
+    parity = np.zeros(nx*(ny + 1), dtype=np.int32)
+    np.add.at(parity, jx*(ny + 1) + jy, 1)
+    return (np.cumsum(parity.reshape(nx, ny + 1), axis=1)[:, :ny] %2) == 1
+
+
+def build(sep_d):
+# sep_d['Classifier']: 'lines' (the two-line cut), 'curve' or 'polygon' through 'Separation points'
+
+    nx = sep_d['#bins Pulse Height']
+    ny = sep_d['#bins Pulse Shape']
+    x = bin_centres(nx)
+    y = bin_centres(ny)
+    geom = sep_d.get('Classifier', 'lines').strip().lower()
+    if geom == 'polygon':
+        neut = neutron_polygon(parse_points(sep_d['Separation points']), x, y)
+    elif geom == 'curve':
+        neut = neutron_curve(parse_points(sep_d['Separation points']), x, y)
+    else:
+        neut = neutron_lines(sep_d, x, y)
+    lut = np.where(neut, NEUT, GAMMA).astype(np.uint8)
+    for code, spec in ((DD, 'DD'), (DT, 'DT')):
+        ph_ok = (x >= sep_d['Lower PH-limit for %s' %spec]) & (x <= sep_d['Upper PH-limit for %s' %spec])
+        lut[neut & ph_ok[:, None]] |= code
+    return lut
+
+
+def edge_bins(jbin, val, n_bins):
+# Bin index of val, events outside [-0.5, n_bins + 0.5] in the nearest edge bin;
+# -1 only for NaN
+
+    jedge = np.where(val > 0.5*n_bins, n_bins - 1, 0)
+    return np.where((jbin < 0) & ~np.isnan(val), jedge, jbin)
+
+
+def lookup(lut, jbin_ph, jbin_ps, ph=None, ps=None):
+# Class code per event. With the PH and PS values, events outside the table are
+# classified by its edge bins, as the two-line cut would do; otherwise, and for NaN, 0
+
+    nx, ny = lut.shape
+    if ph is not None:
+        jbin_ph = edge_bins(jbin_ph, ph, nx)
+    if ps is not None:
+        jbin_ps = edge_bins(jbin_ps, ps, ny)
+    flat = np.append(lut.ravel(), np.uint8(0))
+    ind = jbin_ph.astype(np.int64)*ny + jbin_ps
+    ind[(jbin_ph < 0) | (jbin_ps < 0)] = nx*ny
+    return flat[ind]
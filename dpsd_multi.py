@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import os, json, copy, logging, argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import dpsd_run, dpsd_output
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDmulti')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+dpsd_dir = os.path.dirname(os.path.realpath(__file__))
+
+cnt_list = ('neut1', 'gamma1', 'led', 'pileup', 'sat', 'phys', 'DD', 'DT')
+
+# Channels are given in the settings as overrides of the common sections, e.g.
+# "channels": {"1": {"io": {"HA pattern": "/data/acq/1/%(shot)d/HA_%(shot)d.dat"}},
+#              "2": {"io": {"HA pattern": "/data/acq/2/%(shot)d/HA_%(shot)d.dat"}, "led": {"LED reference bin": 3400}}}
+
+
+def channel_setups(setup_d):
+
+    base = {sec: val for sec, val in setup_d.items() if sec != 'channels'}
+    setups = {}
+    for name, over in setup_d.get('channels', {}).items():
+        setup = copy.deepcopy(base)
+        for sec, val in over.items():
+            setup[sec].update(val)
+        setups[name] = setup
+    return setups
+
+
+def aligned_counts(dp, tstep):
+# Counts in absolute time bins [k*tstep, (k+1)*tstep), identical for all channels
+
+    kbin = np.floor(dp.time.astype(np.float64)/tstep).astype(np.int64)
+    k0 = int(kbin[0])
+    n_bins = int(kbin[-1]) - k0 + 1
+    cnt = {}
+    var = {}
+    for spec in cnt_list:
+        jbin = kbin[dp.flg[spec]] - k0
+        if dp.weight is None:
+            cnt[spec] = np.bincount(jbin, minlength=n_bins).astype(np.float64)
+            var[spec] = cnt[spec]
+        else:
+            wgt = dp.weight[dp.flg[spec]]
+            cnt[spec] = np.bincount(jbin, weights=wgt, minlength=n_bins)
+            var[spec] = np.bincount(jbin, weights=wgt**2, minlength=n_bins)
+    return k0, cnt, var
+
+
+def run_channel(name, setup, nshot=None):
+# Worker: one DPSD run, returns the results of the channel and its aligned counts
+
+    io_d = setup['io']
+    io_d.update({'Write shotfiles': False, 'Prefetch': False, 'Pulse retention': 'none'})
+    if nshot is not None:
+        pattern = io_d.get('HA pattern', '').strip()
+        if pattern:
+            io_d['HA*.dat file'] = pattern %{'shot': nshot, 'channel': name}
+        else:
+            io_d.update({'Shots': nshot, 'HA*.dat file': ''})
+    dp = dpsd_run.DPSD(setup)
+    if not dp.status:
+        return None
+    res = dp.results()
+    res['channel'] = name
+    if nshot is not None:
+        res['nshot'] = nshot
+    k0, cnt, var = aligned_counts(dp, setup['setup']['Time step'])
+    return res, k0, cnt, var
+
+
+class MULTI_DPSD:
+# All channels of a shot (or of the per-channel HA files) analysed concurrently,
+# count rates on a common time grid
+
+
+    def __init__(self, setup_d, nshot=None, n_workers=None):
+
+        self.setup = setup_d
+        self.nshot = nshot
+        setups = channel_setups(setup_d)
+        if not setups:
+            logger.error('No channels in the settings')
+            self.status = False
+            return
+        tsteps = set(setup['setup']['Time step'] for setup in setups.values())
+        if len(tsteps) > 1:
+            logger.error('Channels need a common Time step, got %s', sorted(tsteps))
+            self.status = False
+            return
+        self.tstep = tsteps.pop()
+        self.channels = {}
+        aligned = {}
+        with ProcessPoolExecutor(max_workers=n_workers or len(setups)) as pool:
+            futures = {name: pool.submit(run_channel, name, setup, nshot) for name, setup in setups.items()}
+            for name, fut in futures.items():
+                try:
+                    out = fut.result()
+                except Exception as err:
+                    logger.exception('Channel %s failed: %s', name, err)
+                    continue
+                if out is None:
+                    logger.error('No result for channel %s', name)
+                    continue
+                self.channels[name] = out[0]
+                aligned[name] = out[1:]
+        self.status = len(self.channels) > 0
+        if self.status:
+            self.align(aligned)
+
+
+    def align(self, aligned):
+
+        k_min = min(k0 for k0, _, _ in aligned.values())
+        k_max = max(k0 + len(cnt['phys']) for k0, cnt, _ in aligned.values())
+        n_bins = k_max - k_min
+        self.time_cnt = self.tstep*(k_min + 0.5 + np.arange(n_bins))
+        self.cnt = {}
+        self.cnt_err = {}
+        for name, (k0, cnt, var) in aligned.items():
+            jsl = slice(k0 - k_min, k0 - k_min + len(cnt['phys']))
+            self.cnt[name] = {}
+            self.cnt_err[name] = {}
+            for spec in cnt_list:
+                rate = np.zeros(n_bins, dtype=np.float32)
+                err = np.zeros(n_bins, dtype=np.float32)
+                rate[jsl] = cnt[spec]/self.tstep
+                err[jsl] = np.sqrt(var[spec])/self.tstep
+                self.cnt[name][spec] = rate
+                self.cnt_err[name][spec] = err
+# Sum over the channels, errors in quadrature
+        self.cnt_total = {spec: np.sum([self.cnt[name][spec] for name in self.cnt], axis=0) for spec in cnt_list}
+        self.cnt_total_err = {spec: np.sqrt(np.sum([self.cnt_err[name][spec]**2 for name in self.cnt], axis=0)) for spec in cnt_list}
+
+
+    def results(self):
+# Combined output signals; the per-channel results are in self.channels
+
+        res = {'HAfile': '', 'nshot': self.nshot, 'channel': 'all', 'setup': copy.deepcopy(self.setup), \
+            'dt': self.tstep*len(self.time_cnt), 'time_cnt': self.time_cnt, \
+            'cnt': {'%s_%s' %(spec, name): self.cnt[name][spec] for name in self.cnt for spec in cnt_list}, \
+            'cnt_err': {'%s_%s' %(spec, name): self.cnt_err[name][spec] for name in self.cnt for spec in cnt_list}}
+        for spec in cnt_list:
+            res['cnt'][spec] = self.cnt_total[spec]
+            res['cnt_err'][spec] = self.cnt_total_err[spec]
+        return res
+
+
+    def write(self, backend=None):
+
+        if backend is None:
+            backend = dpsd_output.get_backend(self.setup['io'])
+        if isinstance(backend, dpsd_output.SF_BACKEND):
+            logger.error('Multi-channel output needs the npz or hdf5 backend')
+            return False
+        ok = all([backend.write(res) for res in self.channels.values()])
+        return backend.write(self.results()) and ok
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='DPSD for several digitizer channels')
+    parser.add_argument('shots', nargs='*', type=int, help='shot numbers, omit to use the HA*.dat file of each channel')
+    parser.add_argument('-s', '--settings', required=True, help='json settings with a "channels" section')
+    parser.add_argument('-n', '--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.settings) as fjson:
+        setup_d = json.load(fjson)
+    for nshot in (args.shots or [None]):
+        multi = MULTI_DPSD(setup_d, nshot=nshot, n_workers=args.workers)
+        if multi.status and setup_d['io'].get('Write shotfiles', False):
+            multi.write()
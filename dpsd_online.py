@@ -1,8 +1,7 @@
 #!/usr/bin/env python
 
-import sys, time, os, logging, json
-import dpsd_run
-import aug_sfutils as sf
+import os, logging, json
+import dpsd_service
 
 fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
 hnd = logging.StreamHandler()
@@ -16,25 +15,9 @@ f_json = '%s/settings/shot.json' %dpsd_dir
 with open(f_json) as fjson:
     setup_d = json.load(fjson)
 
-hour = 0
-while (hour < 19):
-    loctime = time.localtime(time.time())
-    hour = loctime[3]
-    logger.info('Waiting for next shot')
-    logger.info('ctrl+c to terminate the script')
-
-    lastshot = sf.wait4shot()
-    try:
-        nsp = sf.SFREAD(lastshot, 'NSP')
-        if nsp.status:
-            logger.warning('NSP shotfile for shot %d exists already, writing no new shotfile' %nshot)
-        else:
-            setup_d['io']['Shots'] = lastshot 
-            dpsd_run.DPSD(setup_d)
-            setup_d['io']['Shots'] = lastshot - 1
-            dpsd_run.DPSD(setup_d)
-    except:
-        logger.error('Problems writing shotfile for #%d' %nshot)
-
-    time.sleep(60)
+f_state = '%s/.dpsd_online.json' %os.path.expanduser('~')
 
+logger.info('Waiting for new HA files')
+trigger = dpsd_service.DIR_TRIGGER()
+service = dpsd_service.SHOT_SERVICE(setup_d, trigger, state_file=f_state)
+service.run(stop_hour=19)
@@ -0,0 +1,270 @@
+import os, sys, json, logging, tempfile, threading, queue, subprocess
+import numpy as np
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDout')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+sig1d = ['neut1', 'neut2', 'gamma1', 'gamma2', 'led', 'pileup']
+dpsd_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def label(res):
+
+    if res.get('nshot') is not None:
+        lbl = '%d' %res['nshot']
+    else:
+        lbl = os.path.splitext(os.path.basename(res['HAfile']))[0]
+    if res.get('channel') is not None:
+        lbl += '_ch%s' %res['channel']
+    return lbl
+
+
+def flatten(res):
+# Nested result dict -> flat {name: array}, e.g. cnt['neut1'] -> 'cnt_neut1'
+
+    flat = {}
+    for key, val in res.items():
+        if isinstance(val, dict):
+            if key == 'setup':
+                flat[key] = np.array(json.dumps(val))
+            else:
+                for spec, arr in val.items():
+                    flat['%s_%s' %(key, spec)] = np.asarray(arr)
+        elif val is not None:
+            flat[key] = np.asarray(val)
+    return flat
+
+
+def unflatten(flat):
+# Inverse of flatten for the keys of DPSD.results()
+
+    groups = ('cnt_err', 'phs_err', 'n_events', 'spgram', 'cnt', 'phs') # longest prefix first
+    res = {}
+    for name, arr in flat.items():
+        arr = np.asarray(arr)
+        if name == 'setup':
+            res[name] = json.loads(str(arr))
+            continue
+        for key in groups:
+            if name.startswith(key + '_'):
+                res.setdefault(key, {})[name[len(key) + 1:]] = arr
+                break
+        else:
+            res[name] = arr.item() if arr.ndim == 0 else arr
+    return res
+
+
+def load_npz(fin):
+
+    with np.load(fin) as f:
+        return unflatten({name: f[name] for name in f.files})
+
+
+def sf_write(exp, diag, nshot, fsig):
+# Runs in the child process started by SF_BACKEND.write, whose cwd holds the sfh
+
+    import aug_sfutils as sf
+
+    ww = sf.WW()
+    if not ww.Open(exp, diag, int(nshot)):
+        return False
+    with np.load(fsig) as sig:
+        status = ww.SetSignal('time', sig['time'])
+        for lbl in sig1d:
+            status &= ww.SetSignal(lbl, sig[lbl])
+    ww.Close()
+    return status
+
+
+class SF_BACKEND:
+# AUG shotfile, requires aug_sfutils
+
+
+    def __init__(self, exp='AUGD', force=False, fsfh='%s/NSP00000.sfh.temp' %dpsd_dir):
+
+        self.exp = exp
+        self.force = force
+        self.fsfh = fsfh
+
+
+    def exists(self, res):
+
+        if res.get('nshot') is None: # never written without a shot number
+            return False
+        import aug_sfutils as sf
+
+        return sf.SFREAD('NSP', res['nshot'], exp=self.exp).status
+
+
+    def write(self, res):
+
+        nshot = res.get('nshot')
+        if nshot is None:
+            logger.error('No shot number, cannot write shotfile for %s', res['HAfile'])
+            return False
+
+        diag = 'NSP'
+        if not self.force and self.exists(res):
+            logger.error('NSP shotfile for #%d exists already' %nshot)
+            return False
+
+# Private copy of the template, the shared one is never modified. The writer looks for
+# the sfh in the cwd: it runs in a child process, the cwd of this one is never changed
+        from aug_sfutils import sfhmod
+
+        nt = len(res['time_cnt'])
+        with tempfile.TemporaryDirectory(prefix='dpsd_sfh') as tmpdir:
+            sfh = sfhmod.SFHMOD(fin=self.fsfh)
+            for lbl in ['time'] + sig1d:
+                sfh.modtime(lbl, nt)
+            sfh.write(fout='%s/NSP00000.sfh' %tmpdir)
+            fsig = '%s/signals.npz' %tmpdir
+            np.savez(fsig, time=np.array(res['time_cnt'], dtype=np.float32), \
+                **{lbl: np.array(res['cnt'][lbl], dtype=np.float32) for lbl in sig1d})
+            proc = subprocess.run([sys.executable, os.path.realpath(__file__), self.exp, diag, str(nshot), fsig], cwd=tmpdir)
+        if proc.returncode != 0:
+            logger.error('Writing NSP shotfile for #%d failed', nshot)
+            return False
+        logger.info('Written NSP shotfile for #%d', nshot)
+        return True
+
+
+class NPZ_BACKEND:
+
+
+    def __init__(self, out_dir='.', force=False):
+
+        self.out_dir = out_dir
+        self.force = force
+
+
+    def fout(self, res):
+
+        return '%s/dpsd_%s.npz' %(self.out_dir, label(res))
+
+
+    def exists(self, res):
+
+        return os.path.isfile(self.fout(res))
+
+
+    def write(self, res):
+
+        fout = self.fout(res)
+        if self.exists(res) and not self.force:
+            logger.error('%s exists already', fout)
+            return False
+        os.makedirs(self.out_dir, exist_ok=True)
+        ftmp = fout + '.tmp.npz'
+        np.savez_compressed(ftmp, **flatten(res))
+        os.replace(ftmp, fout)
+        logger.info('Written %s', fout)
+        return True
+
+
+class HDF5_BACKEND:
+
+
+    def __init__(self, out_dir='.', force=False):
+
+        self.out_dir = out_dir
+        self.force = force
+
+
+    def fout(self, res):
+
+        return '%s/dpsd_%s.h5' %(self.out_dir, label(res))
+
+
+    def exists(self, res):
+
+        return os.path.isfile(self.fout(res))
+
+
+    def write(self, res):
+
+        import h5py
+
+        fout = self.fout(res)
+        if self.exists(res) and not self.force:
+            logger.error('%s exists already', fout)
+            return False
+        os.makedirs(self.out_dir, exist_ok=True)
+        ftmp = fout + '.tmp'
+        with h5py.File(ftmp, 'w') as f:
+            for key, val in res.items():
+                if key == 'setup':
+                    f.attrs[key] = json.dumps(val)
+                elif isinstance(val, dict):
+                    grp = f.create_group(key)
+                    for spec, arr in val.items():
+                        grp.create_dataset(spec, data=arr, compression='gzip')
+                elif np.ndim(val) > 0:
+                    f.create_dataset(key, data=val, compression='gzip')
+                elif val is not None:
+                    f.attrs[key] = val
+        os.replace(ftmp, fout)
+        logger.info('Written %s', fout)
+        return True
+
+
+backends = {'shotfile': SF_BACKEND, 'npz': NPZ_BACKEND, 'hdf5': HDF5_BACKEND}
+
+
+def get_backend(io_d):
+
+    name = io_d.get('Output backend', 'shotfile')
+    force = io_d.get('Force SF write', False)
+    if name == 'shotfile':
+        return SF_BACKEND(exp=io_d.get('Shotfile exp', 'AUGD'), force=force)
+    out_dir = io_d.get('Output dir', '').strip() or '.'
+    return backends[name](out_dir=out_dir, force=force)
+
+
+class ASYNC_WRITER:
+# Writes on a background thread, so that the next shot is computed meanwhile.
+# written[label] is the result of each write, complete after close()
+
+
+    def __init__(self, backend, maxsize=2):
+
+        self.backend = backend
+        self.written = {}
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+
+    def loop(self):
+
+        while True:
+            res = self.queue.get()
+            if res is None:
+                break
+            lbl = label(res)
+            try:
+                self.written[lbl] = bool(self.backend.write(res))
+            except Exception as err:
+                logger.exception('Writing %s failed: %s', lbl, err)
+                self.written[lbl] = False
+
+
+    def submit(self, res):
+
+        self.queue.put(res)
+
+
+    def close(self):
+
+        self.queue.put(None)
+        self.thread.join()
+
+
+if __name__ == '__main__':
+# Shotfile writer process: exp diag nshot signals.npz
+
+    sys.exit(0 if sf_write(*sys.argv[1:]) else 1)
@@ -0,0 +1,122 @@
+import os, shutil, logging, threading
+import numpy as np
+import dpsd_archive
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDpre')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+
+class PREFETCH:
+# Reads (or copies to a local scratch dir) the next HA files on an I/O thread
+# while the current one is processed. At most depth files beyond the one
+# in use are held, and at most max_bytes in total (one file is always allowed).
+# Of *.hac archives only the chunks within t_range are decompressed
+
+
+    def __init__(self, files, depth=1, max_bytes=4e9, scratch=None, t_range=None):
+
+        self.files = list(files)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.scratch = scratch
+        self.t_range = t_range
+        self.ready = {}
+        self.sizes = {}
+        self.inflight = 0
+        self.stop = False
+        self.cond = threading.Condition()
+        if scratch is not None:
+            os.makedirs(scratch, exist_ok=True)
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+
+    def nbytes(self, fin):
+# Memory (or scratch space) taken by fin once fetched
+
+        if not os.path.isfile(fin):
+            return 0
+        if self.scratch is None and fin.endswith('.hac'):
+            arch = dpsd_archive.HA_ARCHIVE(fin)
+            j0, j1 = arch.select(self.t_range)
+            return 2*sum(c['n_words'] for c in arch.chunks[j0: j1])
+        return os.path.getsize(fin)
+
+
+    def fetch(self, fin):
+# (local path, data, time offset of data [1e-8 s])
+
+        if not os.path.isfile(fin):
+            return None, None, 0
+        if self.scratch is None:
+            if fin.endswith('.hac'):
+                data, t_offset = dpsd_archive.HA_ARCHIVE(fin).read(t_range=self.t_range)
+                if len(data) == 0: # READ_HA reports it
+                    return fin, None, 0
+                return fin, data, t_offset
+            return fin, np.fromfile(fin, dtype=np.uint16), 0
+        fout = '%s/%d_%s' %(self.scratch, os.getpid(), os.path.basename(fin))
+        shutil.copyfile(fin, fout)
+        if os.path.isfile(fin + '.md5'):
+            shutil.copyfile(fin + '.md5', fout + '.md5')
+        return fout, None, 0
+
+
+    def loop(self):
+
+        for fin in self.files:
+            try:
+                size = self.nbytes(fin)
+            except (OSError, ValueError) as err:
+                logger.error('Cannot size %s: %s', fin, err)
+                size = 0
+            with self.cond:
+                self.cond.wait_for(lambda: self.stop or (len(self.sizes) <= self.depth and \
+                    (self.inflight + size <= self.max_bytes or self.inflight == 0)))
+                if self.stop:
+                    return
+                self.sizes[fin] = size
+                self.inflight += size
+            logger.debug('Prefetching %s', fin)
+            try:
+                item = self.fetch(fin)
+            except (OSError, ValueError) as err:
+                logger.error('Prefetch of %s failed: %s', fin, err)
+                item = (None, None, 0)
+            with self.cond:
+                self.ready[fin] = item
+                self.cond.notify_all()
+
+
+    def get(self, fin):
+# Returns (local path, data, time offset); data is None when staged to scratch
+
+        with self.cond:
+            self.cond.wait_for(lambda: fin in self.ready)
+            return self.ready[fin]
+
+
+    def release(self, fin):
+
+        with self.cond:
+            fout, data, t_offset = self.ready.pop(fin, (None, None, 0))
+            self.inflight -= self.sizes.pop(fin, 0)
+            self.cond.notify_all()
+        if self.scratch is not None and fout is not None:
+            for f in (fout, fout + '.md5'):
+                if os.path.isfile(f):
+                    os.remove(f)
+
+
+    def close(self):
+
+        with self.cond:
+            self.stop = True
+            self.cond.notify_all()
+        self.thread.join()
+        for fin in list(self.ready):
+            self.release(fin)
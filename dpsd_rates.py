@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import os, json, logging, argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import read_ha
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDrates')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+dpsd_dir = os.path.dirname(os.path.realpath(__file__))
+
+# Campaign overview of the total event rates, from the window headers only
+# (read_ha.RATES): no waveform decoding, the time is spent reading the files
+
+
+def rate_item(item, tstep, min_winlen=0, out_dir=None):
+
+    fin = item if isinstance(item, str) else read_ha.ha_file(item)
+    rates = read_ha.RATES(fin, tstep=tstep, min_winlen=min_winlen)
+    if not rates.status:
+        return None
+    hwin = rates.hwin
+    summ = {'nshot': None if isinstance(item, str) else item, 'HAfile': fin, \
+        't_start': rates.t_start, 't_end': rates.t_end, 'n_windows': rates.n_windows, \
+        'n_valid': int(np.sum(hwin)), 'n_odd': rates.n_odd, 'n_neg': rates.n_neg, \
+        'mean_rate': rates.n_windows/max(rates.t_end - rates.t_start, tstep), \
+        'peak_rate': float(np.max(rates.cnt['total'])), \
+        'mean_winlen': float(np.sum(np.arange(len(hwin))*hwin)/max(np.sum(hwin), 1))}
+    if out_dir is not None:
+        lbl = os.path.splitext(os.path.basename(fin))[0]
+        np.savez_compressed('%s/rates_%s.npz' %(out_dir, lbl), time_cnt=rates.time_cnt, \
+            cnt_total=rates.cnt['total'], cnt_valid=rates.cnt['valid'], hwin=hwin)
+    return summ
+
+
+def campaign(items, tstep=1e-3, min_winlen=0, out_dir=None, n_workers=None):
+# One process per file; returns the summaries sorted as items
+
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    summaries = []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [(item, pool.submit(rate_item, item, tstep, min_winlen, out_dir)) for item in items]
+        for item, fut in futures:
+            try:
+                summ = fut.result()
+            except Exception as err:
+                logger.exception('Rates for %s failed: %s', item, err)
+                continue
+            if summ is not None:
+                summaries.append(summ)
+    return summaries
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='DPSD event rates from the HA headers only')
+    parser.add_argument('items', nargs='+', help='shot numbers, shot ranges first:last, or HA*.dat files')
+    parser.add_argument('-t', '--tstep', type=float, default=1e-3)
+    parser.add_argument('-o', '--out-dir', default=None)
+    parser.add_argument('-n', '--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    items = []
+    for item in args.items:
+        if ':' in item:
+            first, last = item.split(':')
+            items += list(range(int(first), int(last) + 1))
+        elif item.isdigit():
+            items.append(int(item))
+        else:
+            items.append(item)
+    summaries = campaign(items, tstep=args.tstep, out_dir=args.out_dir, n_workers=args.workers)
+    for summ in summaries:
+        logger.info('%s: %d windows, mean rate %10.3e 1/s, peak %10.3e 1/s', summ['nshot'] or summ['HAfile'], \
+            summ['n_windows'], summ['mean_rate'], summ['peak_rate'])
+    if args.out_dir is not None:
+        with open('%s/rates_summary.json' %args.out_dir, 'w') as fjson:
+            json.dump(summaries, fjson, indent=1)
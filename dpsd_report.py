@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import os, json, copy, logging, argparse
+os.environ['MPLBACKEND'] = 'Agg' # set before any matplotlib import, inherited by the workers
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import matplotlib.pylab as plt
+import dpsd_run, dpsd_output, dpsd_hist, plot_dpsd
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDrep')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+dpsd_dir = os.path.dirname(os.path.realpath(__file__))
+
+figures = {'pha': plot_dpsd.fig_pha, 'phs': plot_dpsd.fig_phs, 'cnt': plot_dpsd.fig_cnt, \
+    'pmg': plot_dpsd.fig_pmg, 'win': plot_dpsd.fig_win}
+
+
+class RESULT:
+# What the plot_dpsd figure builders need, from DPSD.results() or a saved npz:
+# histograms and rates only, no event arrays
+
+
+    def __init__(self, res):
+
+        for key, val in res.items():
+            if val is not None:
+                setattr(self, key, val)
+        nxCh = self.setup['separation']['#bins Pulse Height']
+        nyCh = self.setup['separation']['#bins Pulse Shape']
+        self.hpha_pyr = dpsd_hist.HIST2D_PYRAMID(np.asarray(self.hpha), [-0.5, nxCh + 0.5], [-0.5, nyCh + 0.5])
+
+
+def summary(res):
+
+    tstep = res['setup']['setup']['Time step']
+    time_cnt = np.asarray(res['time_cnt'])
+    neut = np.asarray(res['cnt']['neut1'])
+    jmax = np.argmax(neut)
+    summ = {'nshot': res.get('nshot'), 'HAfile': res.get('HAfile'), 'dt': float(res['dt']), \
+        't_start': float(time_cnt[0]), 't_end': float(time_cnt[-1]), \
+        'n_events': {spec: int(n) for spec, n in res['n_events'].items()}, \
+        'counts': {spec: float(np.sum(cnt)*tstep) for spec, cnt in res['cnt'].items()}, \
+        'mean_rate': {spec: float(np.sum(cnt)*tstep/res['dt']) for spec, cnt in res['cnt'].items()}, \
+        'peak_rate_neut1': float(neut[jmax]), 'peak_time_neut1': float(time_cnt[jmax]), \
+        'mean_pmgain': float(np.mean(res['pmgain'])/res['setup']['led']['LED reference bin']) if len(res['pmgain']) > 0 else None}
+    return summ
+
+
+def run_shot(setup_d, nshot):
+
+    setup = copy.deepcopy(setup_d)
+    setup['io'].update({'Shots': nshot, 'HA*.dat file': '', 'Write shotfiles': False, \
+        'Prefetch': False, 'Pulse retention': 'none'})
+    dp = dpsd_run.DPSD(setup)
+    if not dp.status:
+        return None
+    return dp.results()
+
+
+def report_item(item, setup_d, out_dir, formats=('png', )):
+# item: shot number (run DPSD first) or a npz written by the npz output backend
+
+    if isinstance(item, str) and item.endswith('.npz'):
+        res = dpsd_output.load_npz(item)
+    else:
+        res = run_shot(setup_d, int(item))
+        if res is None:
+            logger.error('No result for %s', item)
+            return None
+    lbl = dpsd_output.label(res)
+    res_obj = RESULT(res)
+    os.makedirs(out_dir, exist_ok=True)
+    for name, fig_func in figures.items():
+        fig = fig_func(res_obj)
+        for fmt_out in formats:
+            fig.savefig('%s/%s_%s.%s' %(out_dir, lbl, name, fmt_out))
+        plt.close(fig)
+    summ = summary(res)
+    with open('%s/%s_summary.json' %(out_dir, lbl), 'w') as fjson:
+        json.dump(summ, fjson, indent=1)
+    logger.info('Report for %s done', lbl)
+    return summ
+
+
+def report(items, setup_d, out_dir, n_workers=None, formats=('png', )):
+# One process per shot; a failing shot is logged and skipped
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(report_item, item, setup_d, out_dir, formats): item for item in items}
+        for fut in as_completed(futures):
+            try:
+                summ = fut.result()
+            except Exception as err:
+                logger.exception('Report for %s failed: %s', futures[fut], err)
+                continue
+            if summ is not None:
+                summaries.append(summ)
+    summaries.sort(key=lambda summ: (summ['nshot'] is None, summ['nshot'], summ['HAfile']))
+    with open('%s/summary.json' %out_dir, 'w') as fjson:
+        json.dump(summaries, fjson, indent=1)
+    return summaries
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='DPSD quick-look reports')
+    parser.add_argument('items', nargs='+', help='shot numbers, shot ranges first:last, or dpsd_*.npz files')
+    parser.add_argument('-s', '--settings', default='%s/settings/default.json' %dpsd_dir)
+    parser.add_argument('-o', '--out-dir', default='.')
+    parser.add_argument('-n', '--workers', type=int, default=None)
+    parser.add_argument('-f', '--formats', default='png', help='comma separated, e.g. png,pdf')
+    args = parser.parse_args()
+
+    with open(args.settings) as fjson:
+        setup_d = json.load(fjson)
+    items = []
+    for item in args.items:
+        if item.endswith('.npz'):
+            items.append(item)
+        elif ':' in item:
+            first, last = item.split(':')
+            items += list(range(int(first), int(last) + 1))
+        else:
+            items.append(int(item))
+    report(items, setup_d, args.out_dir, n_workers=args.workers, formats=args.formats.split(','))
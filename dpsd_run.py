@@ -1,8 +1,7 @@
-import sys, os, logging, time
+import sys, os, logging, time, copy
 
 import numpy as np
-import numba as nb
-import read_ha
+import read_ha, kernels, dpsd_output, dpsd_prefetch, dpsd_index, dpsd_hist, dpsd_gates, dpsd_lut, dpsd_flags
 
 
 fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
@@ -12,166 +11,195 @@ hnd.setFormatter(fmt)
 logger.addHandler(hnd)
 logger.setLevel(logging.DEBUG)
 
-sig1d = ['neut1', 'neut2', 'gamma1', 'gamma2', 'led', 'pileup']
 dpsd_dir = os.path.dirname(os.path.realpath(__file__))
 
-@nb.njit
-def slice_trapz(a, bnd_l, bnd_r):
-    b = np.empty(a.shape[0])
-    for j in range(a.shape[0]):
-        b[j] = np.sum(a[j, bnd_l[j]+1: bnd_r[j]-1])
-        b[j] += 0.5*(a[j, bnd_l[j]] + a[j, bnd_r[j]-1])
-    return b
-
-@nb.njit
-def led_correction(dtled, dxCh, led_ref, time, totalintegral, flg_led):
-
-    jled_old = 0
-    jtmark = 0
-    LEDsumm = 0
-    LEDamount = 0
-    LEDcoeff = 0
-    tled = ((time - time[0])/dtled).astype(np.int32)
-    n_pulses = len(time)
-    n_led = int((time[-1] - time[0])/dtled)
-    pulseheight = dxCh*totalintegral
-    pmgain = np.zeros(n_led, dtype=np.float32)
-
-    for jpul in range(n_pulses):
-        jled = tled[jpul]
-        if jled > jled_old:
-            if LEDamount > 0:
-                pmgain[jled] = dxCh*np.float32(LEDsumm)/np.float32(LEDamount)
-                if LEDsumm > 0:
-                    LEDcoeff = np.float32(led_ref)/pmgain[jled]
-            pulseheight[jtmark: jpul] *= LEDcoeff
-            jtmark = jpul
-            LEDsumm = 0
-            LEDamount = 0
-            LEDcoeff = 0
-        if flg_led[jpul]: # LED single pulse
-            LEDsumm += totalintegral[jpul]
-            LEDamount += 1
-        jled_old = jled
-
-    return pmgain, pulseheight
-
-@nb.njit
-def BaselineCond2(bl_start, max_diff, pulses, pulse_len, maxpos, max_lg):
-
-    n_pulses = maxpos.shape[0]
-    pulse_basestart = pulse_len - bl_start
-    blstart_h = bl_start//2
-    totalintegral = np.zeros(n_pulses, dtype=np.float32)
-
-    for jpul in range(n_pulses):
-        newpulse_len = 0
-        pulse = pulses[jpul]
-        if pulse_basestart[jpul] >= maxpos[jpul]:
-            newpulse_len = pulse_len[jpul] - blstart_h
-        else:
-            aver1 = np.mean(pulse[:bl_start])
-            for j in range(maxpos[jpul], pulse_basestart[jpul]):
-                aver2 = np.mean(pulse[j: j+bl_start])
-                if np.abs(aver2 - aver1) < max_diff:
-                    if max_lg[jpul] > j + blstart_h:
-                        newpulse_len = max_lg[jpul]
-                    else:
-                        newpulse_len = j + blstart_h
-                    break
-                if (j == pulse_basestart[jpul] - 1) :
-                    newpulse_len = pulse_len[jpul] - blstart_h
-        for j in range(1, newpulse_len-1):
-            totalintegral[jpul] += pulse[j]
-        totalintegral[jpul] += 0.5*(pulse[0] + pulse[newpulse_len-1])
-
-    return totalintegral
-
-
-@nb.njit
-def Baseline(basestart, baseend, pulse_len, pulses):
-    n_pulses = pulses.shape[0]
-    pulse_baseend = pulse_len - baseend
-    baseline = np.sum(pulses[:, :basestart], axis=1)
-    for jpul in range(n_pulses):
-        nind = basestart
-        for j in range(pulse_baseend[jpul], pulse_len[jpul]):
-            if j >= basestart:
-                baseline[jpul] += pulses[jpul, j]
-                nind += 1
-        baseline[jpul] /= float(nind)
-    return baseline
-
-@nb.njit
-def PileUpDet(nfront, ntail, nthres, front_led, tail_led, flags, pulses):
-    n_pulses, pulse_len = pulses.shape
-    flg_peaks = np.zeros(n_pulses, dtype=np.int32)
-    for jpul, flg in enumerate(flags):
-        pulse = pulses[jpul]
-        if flg:
-            pulse_width = front_led + tail_led
-            pulse_front = pulse[front_led : -tail_led] - nthres
+
+def bin_index(x, nbins, xmin, xmax):
+# Bin of each value as in np.histogram(x, bins=nbins, range=[xmin, xmax]), -1 outside:
+# float64 estimate from the bin width, then corrected against the bin edges as np.histogram
+# does, so that values rounded onto an edge (e.g. float32 times) fall in the same bin
+
+    bin_type = np.result_type(xmin, xmax, x)
+    if not np.issubdtype(bin_type, np.inexact):
+        bin_type = np.result_type(bin_type, float)
+    edges = np.linspace(xmin, xmax, nbins + 1, dtype=bin_type)
+    x = np.asarray(x, dtype=bin_type)
+    ind = np.full(len(x), -1, dtype=np.int32)
+    (jin, ) = np.where((x >= edges[0]) & (x <= edges[-1]))
+    xin = x[jin]
+    jbin = ((xin.astype(np.float64) - float(xmin))*(nbins/(float(xmax) - float(xmin)))).astype(np.int64)
+    jbin = np.clip(jbin, 0, nbins - 1)
+    jbin[xin < edges[jbin]] -= 1
+    jbin[(xin >= edges[jbin + 1]) & (jbin != nbins - 1)] += 1
+    ind[jin] = jbin
+    return ind
+
+
+def preview_select(mode, fraction, t_step):
+# Deterministic subsample for a quick look: every k-th window ('k-th') or a fixed
+# fraction of each time step, evenly spread ('stratified'); the weights restore the rates
+
+    def select(t_events):
+        n_events = len(t_events)
+        if mode == 'stratified':
+            jstrat = ((t_events - t_events[0])/t_step).astype(np.int64)
+            n_strat = np.bincount(jstrat)
+            n_take = np.ceil(fraction*n_strat).astype(np.int64)
+            rank = np.arange(n_events) - np.append(0, np.cumsum(n_strat)[:-1])[jstrat]
+# Random (seeded) phase per time step: a fixed one would skip the same positions
+# within every step, e.g. the LED pulse at its start
+            phase = np.random.default_rng(0).integers(0, np.maximum(n_strat, 1))
+            (ind, ) = np.where((rank*n_take[jstrat] + phase[jstrat]) %n_strat[jstrat] < n_take[jstrat])
+            weight = (n_strat/np.maximum(n_take, 1))[jstrat[ind]]
         else:
-            pulse_width = nfront + ntail
-            pulse_front = pulse[nfront : -ntail] - nthres
+            k = max(int(round(1./fraction)), 1)
+            ind = np.arange(0, n_events, k)
+            weight = np.full(len(ind), n_events/float(len(ind)))
+        return ind, weight.astype(np.float32)
+
+    return select
+
+
+class Cancelled(Exception):
+    pass
+
 
-        pulse_max = np.maximum(pulse[:-pulse_width], pulse[pulse_width:])
-        flg_peaks[jpul] = 0
-        jt = 0
-        while jt < pulse_len-pulse_width:
-            if pulse_front[jt] > pulse_max[jt]:
-                flg_peaks[jpul] += 1
-                jt += pulse_width
-            jt += 1
-    return flg_peaks
+chunk_rows = 1 << 16 # pulses per chunk of the float32 feature pass
+
+
+# Analysis stages of a shot, reported as markers: the kernels do not report within a stage
+stages = ('Baseline', 'Integrals', 'Pile-up', 'LED correction', 'Classification')
 
 
 class DPSD:
 
 
-    def __init__(self, dic_in, t_ranges=None):
+    def __init__(self, dic_in, t_ranges=None, progress=None, cancel=None, on_shot=None):
+# progress(stage, done, total) is called at each stage: shots done of all shots, decoded
+# bytes, then the analysis stages of a shot as (stage, stages done, len(stages)).
+# cancel is a threading.Event checked at the same points, on_shot(dpsd) receives a
+# snapshot after each shot
 
         self.status = True
+        self.progress = progress
+        self.cancel = cancel
 
         self.setup = dic_in
         io_d = dic_in['io']
-        HAfile = io_d['HA*.dat file'].strip()
-        if HAfile != '':
-            self.HAfile = HAfile
-            self.run(HAfile, t_ranges=t_ranges)
-        else:
-            n_shots = np.atleast_1d(eval(str(io_d['Shots'])))
-            for nshot in n_shots:
-                logger.info(nshot)
-                self.nshot = int(nshot)
-                shot100 = self.nshot//100
-                filepath = '/shares/experiments/aug-rawfiles/NSP/%d/%d' %(shot100, self.nshot)
-                if not os.path.exists(filepath):
-                    filepath = '/shares/experiments/aug-rawfiles/NSP/%d' %shot100
-                HAfile = '%s/HA_%d.dat' %(filepath, self.nshot)
+        writer = None
+        prefetch = None
+        self.written = {} # label -> result of the output write, see ASYNC_WRITER
+        if io_d.get('Write shotfiles', False):
+            writer = dpsd_output.ASYNC_WRITER(dpsd_output.get_backend(io_d))
+        try:
+            HAfile = io_d['HA*.dat file'].strip()
+            if HAfile != '':
                 self.HAfile = HAfile
-                self.run(HAfile, t_ranges=t_ranges, check_md5=True)
-                if 'Write shotfiles' in io_d.keys():
-                    if self.status and io_d['Write shotfiles']:
-                        self.sfwrite(exp=io_d['Shotfile exp'], force=io_d['Force SF write'])
+                self.run(HAfile, t_ranges=t_ranges)
+                if writer is not None and self.status and not self.preview and io_d.get('Output backend', 'shotfile') != 'shotfile':
+                    writer.submit(self.results())
+                if on_shot is not None and self.status:
+                    on_shot(self.snapshot())
+            else:
+                n_shots = [int(nshot) for nshot in np.atleast_1d(eval(str(io_d['Shots'])))]
+                f_index = io_d.get('HA index', '').strip()
+                if f_index:
+                    index = dpsd_index.HA_INDEX(f_index)
+                    HAfiles = [index.path(nshot) for nshot in n_shots]
+                    for nshot, HAfile in zip(n_shots, HAfiles):
+                        if HAfile is None:
+                            logger.warning('No HA file for #%d in %s, skipping', nshot, f_index)
+                    n_shots = [nshot for nshot, HAfile in zip(n_shots, HAfiles) if HAfile is not None]
+                    HAfiles = [HAfile for HAfile in HAfiles if HAfile is not None]
+                else:
+                    HAfiles = [read_ha.ha_file(nshot) for nshot in n_shots]
+                if io_d.get('Prefetch', True) and len(n_shots) > 1:
+                    scratch = io_d.get('Scratch dir', '').strip() or None
+                    prefetch = dpsd_prefetch.PREFETCH(HAfiles, scratch=scratch, t_range=self.read_range(t_ranges))
+                for jshot, (nshot, HAfile) in enumerate(zip(n_shots, HAfiles)):
+                    self.report('Shots', jshot, len(n_shots))
+                    logger.info(nshot)
+                    self.nshot = nshot
+                    self.HAfile = HAfile
+                    if prefetch is None:
+                        self.run(HAfile, t_ranges=t_ranges, check_md5=True)
+                    else:
+                        fin, data, t_offset = prefetch.get(HAfile)
+                        self.run(fin or HAfile, t_ranges=t_ranges, check_md5=True, data=data, t_offset=t_offset)
+                        prefetch.release(HAfile)
+                    if writer is not None and self.status and not self.preview:
+                        writer.submit(self.results())
+                    if on_shot is not None and self.status:
+                        on_shot(self.snapshot())
+                self.report('Shots', len(n_shots), len(n_shots))
+        except Cancelled:
+            logger.warning('Run cancelled')
+            self.status = False
+        finally:
+            if prefetch is not None:
+                prefetch.close()
+            if writer is not None:
+                writer.close()
+                self.written = dict(writer.written)
+
+
+    def snapshot(self):
+# Shallow copy with its own setup and flags: the receiver (e.g. the separation editor)
+# may change and reclassify it while this object goes on with the next shot
+
+        snap = copy.copy(self)
+        snap.setup = copy.deepcopy(self.setup)
+        snap.flg = copy.deepcopy(self.flg)
+        return snap
 
 
-    def run(self, HAfile, t_ranges=None, check_md5=False):
+    def stage(self, name):
+
+        self.report(name, stages.index(name), len(stages))
+
+
+    def report(self, stage, done, total):
+
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled(stage)
+        if self.progress is not None:
+            self.progress(stage, done, total)
+
+
+    def read_range(self, t_ranges=None):
+# Time range to read from the HA file, None for all
+
+        if t_ranges is not None:
+            return [np.min(t_ranges), np.max(t_ranges)]
+        if self.setup['setup']['End time'] > 0:
+            return [self.setup['setup']['Start time'], self.setup['setup']['End time']]
+        return None
+
+
+    def run(self, HAfile, t_ranges=None, check_md5=False, data=None, t_offset=0):
 
         nxCh = self.setup['separation']['#bins Pulse Height']
         nyCh = self.setup['separation']['#bins Pulse Shape']
         dxCh = np.float32(nxCh)/np.float32(self.setup['separation']['Marker'])
 
         min_winlen = max(self.setup['peak']['Baseline start'], self.setup['peak']['Baseline end'])
+        t_range = self.read_range(t_ranges)
+        fraction = self.setup['setup'].get('Preview fraction', 1.)
+        self.preview = (0 < fraction < 1)
+        select = None
+        if self.preview:
+            logger.info('Preview of %4.1f%% of the pulses', 100*fraction)
+            select = preview_select(self.setup['io'].get('Preview mode', 'k-th'), fraction, self.setup['setup']['Time step'])
         print(type(min_winlen), type(self.setup['setup']['#samples for analysis']))
-        ha = read_ha.READ_HA(HAfile, check_md5=check_md5, min_winlen=min_winlen, max_winlen=self.setup['setup']['#samples for analysis'])
+        ha = read_ha.READ_HA(HAfile, check_md5=check_md5, min_winlen=min_winlen, max_winlen=self.setup['setup']['#samples for analysis'], data=data, t_range=t_range, select=select, t_offset=t_offset)
         self.status = ha.status
         if not self.status:
             return
+        self.report('Decoded bytes', ha.nbytes, ha.nbytes)
 
         if t_ranges is None:
             if self.setup['setup']['End time'] <= 0:
-                self.setup['setup']['End time'] = ha.t_events[-1] # Take all time events
+                self.setup['setup']['End time'] = float(ha.t_events[-1]) # Take all time events
             (tind, ) = np.where((ha.t_events >= self.setup['setup']['Start time']) & (ha.t_events <= self.setup['setup']['End time']))
             self.dt = self.setup['setup']['End time'] - self.setup['setup']['Start time']
         else: # Force time ranges (make sure they don't overlap!)
@@ -196,10 +224,17 @@ class DPSD:
         self.time_led = self.time[0] + self.setup['led']['LED time sampling']*(0.5 + np.arange(n_led))
 
         self.winlen = ha.winlen[tind]
-        pulses = ha.pulses[tind]
+        self.hwin = np.bincount(self.winlen)
+        self.weight = None if ha.weight is None else ha.weight[tind]
+        if n_pulses == len(ha.pulses) and np.array_equal(tind, np.arange(n_pulses)):
+            pulses = ha.pulses # whole file: no copy
+        else:
+            pulses = ha.pulses[tind]
 
 # Initialise
-        self.flg_peaks = np.zeros(n_pulses)
+        self.flg = dpsd_flags.FLAGS(n_pulses)
+        self.flg['adc_fixed'] = ha.adc_fixed[tind]
+        del ha # release the decoded matrix of the whole file
 
 # =========== 
 # Time loop
@@ -220,24 +255,66 @@ class DPSD:
         pulse_len = np.minimum(self.winlen, tof_win_len)
         pulse_baseend = pulse_len - self.setup['peak']['Baseline end']
 
-        logger.info('Baseline subtraction')
-        self.pulses = pulses.astype(np.float32)
-        baseline = Baseline(self.setup['peak']['Baseline start'], self.setup['peak']['Baseline end'], pulse_len, self.pulses)
-        self.pulses -= baseline[:, None]
-
-# Saturation detection
-        logger.info('Saturation detection')
-        (ind_sat_high, ) = np.where(np.max(self.pulses, axis=1) > sat_high)
-        (ind_sat_low, )  = np.where(np.min(self.pulses, axis=1) < sat_low )
-        flg_sat   = np.zeros(n_pulses)
-        flg_sat[ind_sat_high] = 1
-        flg_sat[ind_sat_low]  = 2
-
-        logger.info('Baseline conditioned 2') 
-
-        self.TotalIntegral = BaselineCond2(self.setup['peak']['Baseline start'], self.setup['peak']['Maximum difference'], self.pulses, pulse_len, maxpos, max_LG)
-        self.ShortIntegral = slice_trapz(self.pulses, maxpos, max_SG)
-        self.LongIntegral  = slice_trapz(self.pulses, maxpos, max_LG)
+        self.stage('Baseline')
+        bl_start = self.setup['peak']['Baseline start']
+        bl_end = self.setup['peak']['Baseline end']
+        prefix = self.setup['peak'].get('Prefix integrals', False) # any gate integral is then two lookups, see gate_scan
+# Only the raw int16 samples and the baselines are kept, see pulse_rows
+        self.pulses = pulses
+        self.maxpos = maxpos
+        self.pulse_csum = None
+        if self.setup['peak'].get('Integer samples', False):
+# Baselines and integrals are summed in int64 and the baseline enters the integrals
+# analytically, as baseline times the trapezoid weight
+            logger.info('Baseline, integer samples')
+            self.pulse_baseline = kernels.int_baseline(bl_start, bl_end, pulse_len, pulses)
+
+            logger.info('Saturation detection')
+            self.flg['sat_low'] = (np.min(pulses, axis=1) - self.pulse_baseline < sat_low)
+            self.flg['sat'] = (pulse_max - self.pulse_baseline > sat_high) | self.flg['sat_low']
+
+            self.stage('Integrals')
+# BaselineCond2 reduces to a trapezoid over [0, pulse_len - bl_start//2), see np_BaselineCond2
+            newpulse_len = np.where(pulse_len - bl_start >= maxpos, pulse_len - bl_start//2, 0)
+            self.TotalIntegral = self.int_integral(np.zeros_like(maxpos), newpulse_len).astype(np.float32)
+            if prefix:
+                self.pulse_csum = dpsd_gates.prefix_sum(pulses, self.pulse_baseline)
+                self.ShortIntegral = dpsd_gates.trapz(self.pulse_csum, maxpos, max_SG)
+                self.LongIntegral  = dpsd_gates.trapz(self.pulse_csum, maxpos, max_LG)
+            else:
+                self.ShortIntegral = self.int_integral(maxpos, max_SG)
+                self.LongIntegral  = self.int_integral(maxpos, max_LG)
+        else:
+# Baseline-subtracted float32 pulses, chunk by chunk: the full float32 matrix never exists
+            logger.info('Baseline subtraction, saturation, integrals')
+            self.stage('Integrals')
+            self.pulse_baseline = np.zeros(n_pulses, dtype=np.float32)
+            self.TotalIntegral = np.zeros(n_pulses, dtype=np.float32)
+            self.ShortIntegral = np.zeros(n_pulses)
+            self.LongIntegral  = np.zeros(n_pulses)
+            sat_lo = np.zeros(n_pulses, dtype=bool)
+            sat_hi = np.zeros(n_pulses, dtype=bool)
+            if prefix:
+                self.pulse_csum = np.zeros((n_pulses, pulses.shape[1] + 1))
+            for j0 in range(0, n_pulses, chunk_rows):
+                rows = slice(j0, j0 + chunk_rows)
+                pul = pulses[rows].astype(np.float32)
+                baseline = kernels.Baseline(bl_start, bl_end, pulse_len[rows], pul)
+                pul -= baseline[:, None]
+                self.pulse_baseline[rows] = baseline
+                sat_lo[rows] = (np.min(pul, axis=1) < sat_low)
+                sat_hi[rows] = (np.max(pul, axis=1) > sat_high)
+                self.TotalIntegral[rows] = kernels.BaselineCond2(bl_start, self.setup['peak']['Maximum difference'], pul, pulse_len[rows], maxpos[rows], max_LG[rows])
+                if prefix:
+                    self.pulse_csum[rows] = dpsd_gates.prefix_sum(pul)
+                else:
+                    self.ShortIntegral[rows] = kernels.slice_trapz(pul, maxpos[rows], max_SG[rows])
+                    self.LongIntegral[rows]  = kernels.slice_trapz(pul, maxpos[rows], max_LG[rows])
+            self.flg['sat_low'] = sat_lo
+            self.flg['sat'] = sat_hi | sat_lo
+            if prefix:
+                self.ShortIntegral = dpsd_gates.trapz(self.pulse_csum, maxpos, max_SG)
+                self.LongIntegral  = dpsd_gates.trapz(self.pulse_csum, maxpos, max_LG)
         ind3 = np.where(self.LongIntegral > 0)[0]
 
         self.PulseHeight = dxCh*self.TotalIntegral
@@ -246,101 +323,374 @@ class DPSD:
 
 # LED evaluation
 
-        self.flg = {}
-
         self.flg['led'] =  \
             (self.PulseHeight > float(self.setup['led']['Min PH bin for LED detection'])) & \
             (self.PulseHeight < float(self.setup['led']['Max PH bin for LED detection'])) & \
             (self.PulseShape  > float(self.setup['led']['Min PS bin for LED detection'])) & \
             (self.PulseShape  < float(self.setup['led']['Max PS bin for LED detection']))
 
+        self.stage('Pile-up')
         logger.info('Pile-up detection')
 
-        self.flg_peaks = PileUpDet(self.setup['peak']['Front'], self.setup['peak']['Tail'], self.setup['peak']['Threshold'], self.setup['led']['LED front'], self.setup['led']['LED tail'], self.flg['led'], pulses)
+        self.flg_peaks = kernels.PileUpDet(self.setup['peak']['Front'], self.setup['peak']['Tail'], self.setup['peak']['Threshold'], self.setup['led']['LED front'], self.setup['led']['LED tail'], self.flg['led'], pulses).astype(np.uint8)
+        del pulses
 
 # LED correction
 
+        self.stage('LED correction')
         logger.info('LED correction')
 
-        self.pmgain, self.PulseHeight = led_correction(self.setup['led']['LED time sampling'], dxCh, self.setup['led']['LED reference bin'], self.time, self.TotalIntegral, self.flg['led'])
+        self.pmgain, self.PulseHeight = kernels.led_correction(self.setup['led']['LED time sampling'], dxCh, self.setup['led']['LED reference bin'], self.time, self.TotalIntegral, self.flg['led'])
 
+        self.TotalIntegral_raw = self.TotalIntegral # before LED correction, for parameter sweeps
         self.TotalIntegral = self.PulseHeight/dxCh
 
-        flg_slope1 = (self.PulseHeight <= self.setup['separation']['Bin line1 -> line2'])
-        flg1n = (self.PulseShape <= self.setup['separation']['Offset of 1st sep.line'] + self.setup['separation']['Slope of 1st sep.line']*self.PulseHeight)
-        offset2 = self.setup['separation']['Offset of 1st sep.line'] + self.setup['separation']['Slope of 1st sep.line']*self.setup['separation']['Bin line1 -> line2']
-        flg2n = (self.PulseShape <= offset2 + self.setup['separation']['Slope of 2nd sep.line']*(self.PulseHeight-self.setup['separation']['Bin line1 -> line2']))
-
-        flg1  =   flg_slope1  & flg1n
-        flg2  = (~flg_slope1) & flg2n
-        flg1g =   flg_slope1  & (~flg1n)
-        flg2g = (~flg_slope1) & (~flg2n)
-        self.flg['sat'] = (flg_sat > 0)
         self.flg['pileup'] = (self.flg_peaks > 1)
-        self.flg['phys'] =  (~self.flg['sat']) & (~self.flg['led']) & (~self.flg['pileup'])
-        self.flg['neut1']  = (flg1  + flg2 ) & (self.flg['phys'])
-        self.flg['gamma1'] = (flg1g + flg2g) & (self.flg['phys'])
-        self.flg['DD'] = self.flg['neut1'] & \
-            (self.PulseHeight >= self.setup['separation']['Lower PH-limit for DD']) & \
-            (self.PulseHeight <= self.setup['separation']['Upper PH-limit for DD'])
-        self.flg['DT'] = self.flg['neut1'] & \
-            (self.PulseHeight >= self.setup['separation']['Lower PH-limit for DT']) & \
-            (self.PulseHeight <= self.setup['separation']['Upper PH-limit for DT'])
-
-        self.event_type = np.zeros(n_pulses, dtype=np.int32) - 1
-        self.event_type[self.flg['neut1']]  = 0
-        self.event_type[self.flg['gamma1']] = 1
-        self.event_type[self.flg['pileup']] = 2
-        self.event_type[self.flg['led']]    = 3
+        self.flg['phys'] = self.flg.select(none_of=('sat', 'led', 'pileup'))
+
+# Histogram bins do not depend on the separation, compute them once
+        tstep = self.setup['setup']['Time step']
+        self.jbin_cnt = bin_index(self.time, n_timebins, self.time_cnt[0] - 0.5*tstep, self.time_cnt[-1] + 0.5*tstep)
+        self.dt_fine = min(self.setup['setup'].get('Finest time step', 1e-5), tstep)
+        self.n_fine = int(np.ceil((self.time[-1] - self.time[0])/self.dt_fine)) + 1
+        self.jbin_fine = bin_index(self.time, self.n_fine, self.time[0], self.time[0] + self.n_fine*self.dt_fine)
+        self.jbin_ph = bin_index(self.PulseHeight, nxCh, -0.5, nxCh + 0.5)
+        self.jbin_ps = bin_index(self.PulseShape, nyCh, -0.5, nyCh + 0.5)
+
+# PH-PS histogram (all events) with a multi-resolution pyramid for plotting
+        self.hpha = dpsd_hist.hist2d(self.jbin_ph, self.jbin_ps, nxCh, nyCh)
+        self.hpha_pyr = dpsd_hist.HIST2D_PYRAMID(self.hpha, [-0.5, nxCh + 0.5], [-0.5, nyCh + 0.5])
+
+        self.stage('Classification')
+        self.classify()
+
+        self.retain_pulses(self.setup['io'].get('Pulse retention', 'all'), \
+            self.setup['io'].get('Reservoir size', self.setup['setup'].get('Reservoir size', 1000)))
+        self.report('Pulses', len(stages), len(stages))
+
+
+    def int_integral(self, bnd_l, bnd_r):
+# slice_trapz of the baseline-subtracted pulses, from the integer pulses: the
+# baseline contributes baseline*(number of trapezoid intervals)
+
+        twice = kernels.int_trapz(self.pulses, bnd_l, bnd_r)
+        weight = np.maximum(bnd_r - bnd_l - 2, 0) + 1
+        return 0.5*twice - self.pulse_baseline*weight
+
+
+    def pulse_rows(self, rows):
+# Baseline-subtracted float32 pulses of the given rows of self.pulses (raw int16)
+
+        return self.pulses[rows].astype(np.float32) - self.pulse_baseline[rows, None]
+
+
+    def classify(self, pulse_stats=True):
+# Separation lines and PH limits only: reuses PulseHeight, PulseShape and the
+# sat/led/pile-up flags, so it can be rerun cheaply when the separation changes;
+# pulse_stats=False skips the pass over the pulses
+
+        sep_d = self.setup['separation']
+        phys = self.flg['phys']
+        if sep_d.get('Classifier', 'lines').strip().lower() != 'lines':
+# Any geometry (lut = the two lines, curve, polygon) as a class table over the PH-PS bins
+            code = dpsd_lut.lookup(dpsd_lut.build(sep_d), self.jbin_ph, self.jbin_ps, ph=self.PulseHeight, ps=self.PulseShape)
+            self.flg['neut1']  = ((code & dpsd_lut.NEUT)  > 0) & phys
+            self.flg['gamma1'] = ((code & dpsd_lut.GAMMA) > 0) & phys
+            self.flg['DD'] = ((code & dpsd_lut.DD) > 0) & phys
+            self.flg['DT'] = ((code & dpsd_lut.DT) > 0) & phys
+        else:
+            flg_slope1 = (self.PulseHeight <= sep_d['Bin line1 -> line2'])
+            flg1n = (self.PulseShape <= sep_d['Offset of 1st sep.line'] + sep_d['Slope of 1st sep.line']*self.PulseHeight)
+            offset2 = sep_d['Offset of 1st sep.line'] + sep_d['Slope of 1st sep.line']*sep_d['Bin line1 -> line2']
+            flg2n = (self.PulseShape <= offset2 + sep_d['Slope of 2nd sep.line']*(self.PulseHeight-sep_d['Bin line1 -> line2']))
+
+            flg1  =   flg_slope1  & flg1n
+            flg2  = (~flg_slope1) & flg2n
+            flg1g =   flg_slope1  & (~flg1n)
+            flg2g = (~flg_slope1) & (~flg2n)
+            neut = (flg1  + flg2 ) & phys
+            self.flg['neut1']  = neut
+            self.flg['gamma1'] = (flg1g + flg2g) & phys
+            self.flg['DD'] = neut & \
+                (self.PulseHeight >= sep_d['Lower PH-limit for DD']) & \
+                (self.PulseHeight <= sep_d['Upper PH-limit for DD'])
+            self.flg['DT'] = neut & \
+                (self.PulseHeight >= sep_d['Lower PH-limit for DT']) & \
+                (self.PulseHeight <= sep_d['Upper PH-limit for DT'])
+
+        self.event_type = self.flg.event_type()
+        all_pulses = (self.pulses.shape[0] == len(self.time))
+
+# Average pulse, variance and persistence per class: one more pass over all pulses,
+# repeated at each classification so that the statistics follow the separation
+        if pulse_stats and all_pulses:
+            self.pulse_statistics()
+        elif pulse_stats:
+            logger.warning('Pulses not retained, keeping the pulse statistics of the previous separation')
+
+        if self.setup['peak'].get('Pile-up decomposition', False):
+            if all_pulses:
+                self.decompose_pileup()
+            else:
+                logger.warning('Pulses not retained, keeping the previous pile-up decomposition')
+        else:
+            self.pileup_fit = None
+
+        self.histograms()
+
+
+    def pulse_templates(self, n_pre, n_post, n_max=10000):
+# Mean neutron and gamma pulse, aligned at the maximum and normalised to 1 there
+
+        n_samp = self.pulses.shape[1]
+        jrel = np.arange(-n_pre, n_post)
+        templates = np.zeros((2, n_pre + n_post))
+        for jc, spec in enumerate(('neut1', 'gamma1')):
+            (ind, ) = np.where(self.flg[spec])
+            ind = ind[:n_max]
+            jsamp = self.maxpos[ind, None] + jrel
+            ok = (jsamp >= 0) & (jsamp < np.minimum(self.winlen[ind], n_samp)[:, None])
+            pulses = self.pulse_rows(ind)
+            jrow = np.arange(len(ind))
+            peak = pulses[jrow, self.maxpos[ind]].astype(np.float64)
+            ok &= (peak[:, None] > 0)
+            sub = np.where(ok, pulses[jrow[:, None], np.clip(jsamp, 0, n_samp - 1)]/np.where(peak > 0, peak, 1)[:, None], 0)
+            templates[jc] = np.sum(sub, axis=0)/np.maximum(np.sum(ok, axis=0), 1)
+        return templates
+
+
+    def decompose_pileup(self):
+# High-rate mode: windows with pile-up are split into single pulses by template
+# fitting, each recovered pulse is classified by its best-matching template.
+# The templates cover the whole window after the peak, so that no tail of a
+# subtracted pulse is left in the residual
+
+        peak_d = self.setup['peak']
+        n_pre = peak_d['Front']
+        n_post = self.pulses.shape[1]
+        templates = self.pulse_templates(n_pre, n_post)
+        fit_args = (templates, n_pre, peak_d['Front'], peak_d['Tail'], float(peak_d['Threshold']), \
+            peak_d.get('Pile-up min fraction', 0.05), peak_d.get('Max pulses per window', 4))
+        if not self.check_pileup_fit(fit_args):
+            logger.warning('Pile-up decomposition disabled, neut2/gamma2 from the pile-up fraction')
+            self.pileup_fit = None
+            return
+        ind = self.flg.where(all_of=('pileup', ), none_of=('sat', 'led'))
+        pulse_len = np.minimum(self.winlen[ind], self.pulses.shape[1])
+        n_found, pos, amp, cls = kernels.pileup_fit(self.pulse_rows(ind), pulse_len, *fit_args)
+        found = (np.arange(pos.shape[1]) < n_found[:, None])
+        jwin = np.repeat(ind, n_found)
+# PH of a recovered pulse: template integral over the long gate, with the LED gain of its window
+        dxCh = np.float32(self.setup['separation']['#bins Pulse Height'])/np.float32(self.setup['separation']['Marker'])
+        tmpl_int = np.sum(templates[:, n_pre: n_pre + peak_d['Long gate']], axis=1)
+        raw = dxCh*self.TotalIntegral_raw[jwin]
+        gain = np.where(raw != 0, self.PulseHeight[jwin]/np.where(raw != 0, raw, 1), 0)
+        self.pileup_fit = {'event': jwin, 'cls': cls[found], 'pos': pos[found], 'amp': amp[found], \
+            'PulseHeight': (gain*dxCh*amp[found]*tmpl_int[cls[found]]).astype(np.float32), 'templates': templates}
+        logger.info('Pile-up decomposition: %d pulses in %d windows', len(jwin), len(ind))
+
+
+    def check_pileup_fit(self, fit_args, n_win=300, min_ok=0.8, max_over=0.05, seed=0):
+# Decomposition of synthetic windows with 1, 2 and 3 pulses, each a sum of single
+# physical pulses of this shot at random offsets: the fit is used for the counts
+# only if it finds the right number of pulses in at least min_ok of the windows and
+# too many in at most max_over
+
+        n_samp = self.pulses.shape[1]
+        nfront, ntail = fit_args[2], fit_args[3]
+        ind = self.flg.where(all_of=('phys', ), none_of=('pileup', ))
+        ind = ind[self.winlen[ind] >= n_samp]
+        if len(ind) == 0:
+            logger.warning('No single full-length pulses to check the pile-up decomposition')
+            return False
+        jpeak = np.bincount(self.maxpos[ind]).argmax()
+        ind = ind[self.maxpos[ind] == jpeak]
+        rng = np.random.default_rng(seed)
+        single = self.pulse_rows(rng.choice(ind, min(len(ind), 10*n_win), replace=False)).astype(np.float64)
+        self.pileup_check = {}
+        ok = True
+        for n_true in (1, 2, 3):
+            win = single[rng.integers(len(single), size=n_win)]
+            shift = 0
+            hi = (n_samp - jpeak - ntail)//max(n_true - 1, 1)
+            for k in range(1, n_true):
+                shift = shift + rng.integers(nfront + ntail, max(hi, nfront + ntail + 1), size=n_win)
+                src = single[rng.integers(len(single), size=n_win)]
+                jsamp = np.arange(n_samp) - shift[:, None]
+                win += np.where(jsamp >= 0, src[np.arange(n_win)[:, None], np.clip(jsamp, 0, n_samp - 1)], 0)
+            n_found = kernels.pileup_fit(win.astype(np.float32), np.full(n_win, n_samp), *fit_args)[0]
+            hist = np.bincount(n_found, minlength=fit_args[-1] + 1)
+            self.pileup_check[n_true] = hist
+            frac_ok = hist[n_true]/float(n_win)
+            frac_over = np.sum(hist[n_true + 1:])/float(n_win)
+            logger.info('Pile-up check, %d pulses: %.3f found, %.3f too many', n_true, frac_ok, frac_over)
+            ok &= (frac_ok >= min_ok) & (frac_over <= max_over)
+        return bool(ok)
+
+
+    def gate_scan(self, short_gates, long_gates, spec='phys', ph_range=None):
+# PS distribution and FOM for each short/long gate pair, events of class spec within ph_range
+
+        if len(self.pulse_index) == 0:
+            logger.error('Gate scan needs retained pulses, set "Pulse retention" to all or reservoir')
+            return None
+        if len(self.pulse_index) < len(self.time):
+            logger.warning('Gate scan over the %d retained pulses only', len(self.pulse_index))
+# Rows of the prefix sums are the retained pulses; without "Prefix integrals" they
+# are computed per call and not kept
+        csum = self.pulse_csum
+        if csum is None:
+            csum = dpsd_gates.prefix_sum(self.pulses, self.pulse_baseline)
+        ind = self.pulse_index
+        mask = self.flg[spec][ind]
+        if ph_range is not None:
+            mask &= (self.PulseHeight[ind] >= ph_range[0]) & (self.PulseHeight[ind] <= ph_range[1])
+        return dpsd_gates.gate_scan(csum, self.maxpos[ind], self.winlen[ind], short_gates, long_gates, \
+            self.setup['separation']['#bins Pulse Shape'], mask=mask)
+
+
+    def pulse_statistics(self, n_amp=256):
+# Persistence between the saturation limits
+
+        pulse_len = np.minimum(self.winlen, self.pulses.shape[1])
+        amp_min = float(self.setup['peak']['Saturation lower limit'])
+        amp_max = float(self.setup['peak']['Saturation upper limit'])
+        stat_list = ('neut1', 'gamma1', 'pileup', 'led', 'sat') # later classes override earlier ones
+        jcls = np.zeros(len(self.time), dtype=np.int32) - 1
+        for jc, spec in enumerate(stat_list):
+            jcls[self.flg[spec]] = jc
+        n_sum, s1, s2, persist = kernels.pulse_stats(self.pulses, self.pulse_baseline, pulse_len, jcls, len(stat_list), amp_min, amp_max, n_amp)
+        self.persist_amp = np.linspace(amp_min, amp_max, n_amp + 1)
+        self.pulse_stats = {}
+        for jc, spec in enumerate(stat_list):
+            n = np.maximum(n_sum[jc], 1)
+            mean = s1[jc]/n
+            self.pulse_stats[spec] = {'n_pulses': np.sum(jcls == jc), 'n_samples': n_sum[jc], \
+                'mean': mean.astype(np.float32), 'var': np.maximum(s2[jc]/n - mean**2, 0).astype(np.float32), \
+                'persist': persist[jc]}
+
+
+    def retain_pulses(self, policy='all', n_keep=1000, seed=0):
+# all, none, or a uniform sample of at most n_keep pulses per event type;
+# pulse_index maps the rows of self.pulses to the event arrays
+
+        if policy == 'all':
+            self.pulse_index = np.arange(len(self.time))
+            return
+        if policy == 'none':
+            self.pulse_index = np.zeros(0, dtype=np.int64)
+            self.pulses = np.zeros((0, self.pulses.shape[1]), dtype=self.pulses.dtype)
+            self.pulse_baseline = np.zeros(0, dtype=np.float32)
+            self.pulse_csum = None
+            return
+        rng = np.random.default_rng(seed)
+        sel = []
+        for jtype in np.unique(self.event_type):
+            (ind, ) = np.where(self.event_type == jtype)
+            if len(ind) > n_keep:
+                ind = rng.choice(ind, n_keep, replace=False)
+            sel.append(ind)
+        self.pulse_index = np.sort(np.concatenate(sel))
+        self.pulses = self.pulses[self.pulse_index]
+        self.pulse_baseline = self.pulse_baseline[self.pulse_index]
+        if self.pulse_csum is not None: # float64: gate integrals are differences of large prefix sums
+            self.pulse_csum = self.pulse_csum[self.pulse_index]
+        logger.info('Keeping %d of %d pulses', len(self.pulse_index), len(self.time))
+
+
+    def histograms(self):
 
         cnt_list = ('neut1', 'gamma1', 'led', 'pileup', 'sat', 'phys', 'DD', 'DT')
         nxCh = self.setup['separation']['#bins Pulse Height']
+        n_timebins = len(self.time_cnt)
 
         self.cnt = {}
         self.phs = {}
 
+        self.cnt_err = {}
+        self.phs_err = {}
+        self.n_events = {}
+
+# Poisson uncertainties; in preview mode each event counts with its sampling weight
         for spec in cnt_list:
-            cnt, tedges = np.histogram(self.time[self.flg[spec]], bins=n_timebins, range=[self.time_cnt[0]-0.5*self.setup['setup']['Time step'], self.time_cnt[-1]+0.5*self.setup['setup']['Time step']])
-            phs, edges = np.histogram(np.float32(nxCh)/np.float32(self.setup['separation']['Marker'])*self.TotalIntegral[self.flg[spec]], bins=nxCh, range=[-0.5, nxCh + 0.5])
+            mask = self.flg[spec]
+            jcnt = self.jbin_cnt[mask]
+            jphs = self.jbin_ph[mask]
+            if self.weight is None:
+                cnt = np.bincount(jcnt[jcnt >= 0], minlength=n_timebins)
+                phs = np.bincount(jphs[jphs >= 0], minlength=nxCh)
+                cnt_var, phs_var = cnt, phs
+            else:
+                wcnt = self.weight[mask][jcnt >= 0]
+                wphs = self.weight[mask][jphs >= 0]
+                cnt = np.bincount(jcnt[jcnt >= 0], weights=wcnt, minlength=n_timebins)
+                phs = np.bincount(jphs[jphs >= 0], weights=wphs, minlength=nxCh)
+                cnt_var = np.bincount(jcnt[jcnt >= 0], weights=wcnt**2, minlength=n_timebins)
+                phs_var = np.bincount(jphs[jphs >= 0], weights=wphs**2, minlength=nxCh)
             self.cnt[spec] = cnt.astype(np.float32)
             self.phs[spec] = phs.astype(np.float32)/self.dt
-            logger.info('%s %d', spec, np.sum(self.flg[spec]))
+            self.cnt_err[spec] = np.sqrt(cnt_var).astype(np.float32)
+            self.phs_err[spec] = np.sqrt(phs_var).astype(np.float32)/self.dt
+            self.n_events[spec] = int(np.count_nonzero(mask))
+            logger.debug('%s %d', spec, self.n_events[spec])
+
+        if self.setup['separation'].get('PH-PS histogram per class', False):
+            nyCh = self.setup['separation']['#bins Pulse Shape']
+            self.hpha_cls = {}
+            for spec in ('neut1', 'gamma1', 'led', 'pileup'):
+                self.hpha_cls[spec] = dpsd_hist.hist2d(self.jbin_ph, self.jbin_ps, nxCh, nyCh, mask=self.flg[spec])
+
+# Sparse time x PH spectrograms
+        tstep = self.setup['setup']['Time step']
+        t_edges = self.time_cnt[0] - 0.5*tstep + tstep*np.arange(n_timebins + 1)
+        self.spgram = {}
+        for spec in self.setup['setup'].get('Spectrogram classes', 'neut1').split(','):
+            spec = spec.strip()
+            if spec in self.flg:
+                self.spgram[spec] = dpsd_hist.spectrogram(self.jbin_cnt, self.jbin_ph, n_timebins, nxCh, t_edges, mask=self.flg[spec], weight=self.weight)
+
+# Count-rate pyramid for zoomable plots
+        masks = {spec: self.flg[spec] for spec in ('neut1', 'gamma1', 'led', 'pileup', 'DD', 'DT')}
+        self.cnt_pyr = dpsd_hist.RATE_PYRAMID(self.jbin_fine, masks, self.time[0], self.dt_fine, self.n_fine, \
+            weight=self.weight)
 
 # Move to 1/s units
         for spec in self.cnt.keys():
             self.cnt[spec] /= self.setup['setup']['Time step']
+            self.cnt_err[spec] /= self.setup['setup']['Time step']
+
+        if getattr(self, 'pileup_fit', None) is not None:
+# Single events plus the pulses recovered from the pile-up windows
+            for jc, spec in enumerate(('neut', 'gamma')):
+                jwin = self.pileup_fit['event'][self.pileup_fit['cls'] == jc]
+                jcnt = self.jbin_cnt[jwin]
+                wgt = None if self.weight is None else self.weight[jwin][jcnt >= 0]
+                extra = np.bincount(jcnt[jcnt >= 0], weights=wgt, minlength=n_timebins)
+                extra_var = extra if wgt is None else np.bincount(jcnt[jcnt >= 0], weights=wgt**2, minlength=n_timebins)
+                self.cnt['%s2' %spec] = (self.cnt['%s1' %spec] + extra/tstep).astype(np.float32)
+                self.cnt_err['%s2' %spec] = np.sqrt(self.cnt_err['%s1' %spec]**2 + extra_var/tstep**2).astype(np.float32)
+            return
 
         total = self.cnt['neut1'] + self.cnt['gamma1'] + self.cnt['led']
 # Assuming pile-ups are all 2 events per window
         pup_frac = 1 + 2.*self.cnt['pileup']/total
         self.cnt['neut2' ] = pup_frac*self.cnt['neut1'] 
         self.cnt['gamma2'] = pup_frac*self.cnt['gamma1']
+        self.cnt_err['neut2' ] = pup_frac*self.cnt_err['neut1']
+        self.cnt_err['gamma2'] = pup_frac*self.cnt_err['gamma1']
 
 
-    def sfwrite(self, fsfh='%s/NSP00000.sfh' %dpsd_dir, exp='AUGD', force=False):
+    def results(self):
+# Snapshot of the output signals, safe to hand over to a writer thread
 
-        import aug_sfutils as sf
-        from aug_sfutils import sfhmod
-
-        ww = sf.WW()
-
-        diag = 'NSP'
-        nsp = sf.SFREAD('NSP', self.nshot, exp=exp)
-        if nsp.status and not force:
-            logger.error('NSP shotfile for #%d exists already' %self.nshot)
-            return
+        res = {'HAfile': self.HAfile, 'nshot': getattr(self, 'nshot', None), 'setup': copy.deepcopy(self.setup), \
+            'dt': self.dt, 'time_cnt': self.time_cnt, 'time_led': self.time_led, 'pmgain': self.pmgain, \
+            'cnt': dict(self.cnt), 'phs': dict(self.phs), 'cnt_err': dict(self.cnt_err), 'phs_err': dict(self.phs_err), \
+            'n_events': dict(self.n_events), 'hwin': self.hwin, 'hpha': self.hpha, \
+            'spgram': {'%s_%s' %(spec, key): arr for spec, spg in self.spgram.items() for key, arr in spg.arrays().items()}}
+        return res
 
-        nt = len(self.time_cnt)
-        ftemp = '%s/NSP00000.sfh.temp' %dpsd_dir
-        sfh = sfhmod.SFHMOD(fin=ftemp)
-        for lbl in ['time'] + sig1d:
-            sfh.modtime(lbl, nt)
-        sfh.write(fout=fsfh)
 
-        os.chdir(dpsd_dir)
+    def sfwrite(self, exp='AUGD', force=False):
 
-        if ww.Open(exp, diag, self.nshot):
-            status = ww.SetSignal('time', np.array(self.time_cnt, dtype=np.float32))
-            for lbl in sig1d:
-                status = ww.SetSignal(lbl, np.array(self.cnt[lbl], dtype=np.float32))
-            ww.Close()
+        return dpsd_output.SF_BACKEND(exp=exp, force=force).write(self.results())
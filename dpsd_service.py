@@ -0,0 +1,262 @@
+import os, re, time, json, copy, logging, queue, tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import dpsd_run, dpsd_output, read_ha
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDsrv')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+dpsd_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def fake_shot(fout, n_pulses=4000, winlen=50, seed=0):
+# Synthetic HA file: neutrons, gammas and one LED pulse per ms
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(winlen, dtype=np.float64) - 8.
+    tdiff = rng.exponential(1000., n_pulses).astype(np.int64) + 10
+    t_events = 1e-8*np.cumsum(tdiff)
+    (ind_led, ) = np.where(np.diff(np.floor(1e3*t_events), prepend=-1) > 0)
+    slow = np.where(rng.random(n_pulses) < 0.5, 0.3, 0.05)
+    ampl = rng.uniform(50, 2000, n_pulses)
+    tpos = np.maximum(t, 0)
+    shape = (1. - slow[:, None])*np.exp(-tpos/1.5) + slow[:, None]*np.exp(-tpos/12.)
+    shape[:, t < 0] = np.maximum(1. + t[t < 0]/2., 0)
+    pulses = ampl[:, None]*shape
+    pulses[ind_led] = 2000.*np.clip(1. + t/2., 0, 1)*(t < 20)
+    pulses += 20. + rng.normal(0, 2., pulses.shape)
+    read_ha.write_ha(fout, pulses, tdiff)
+    open(fout + '.md5', 'w').close()
+
+
+def warmup(setup_d):
+# Compile (or load from cache) all numba kernels with the production dtypes;
+# nothing of the fake shot is written
+
+    setup = copy.deepcopy(setup_d)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fha = '%s/HA_0.dat' %tmpdir
+        fake_shot(fha)
+        setup['io']['HA*.dat file'] = fha
+        setup['io']['Write shotfiles'] = False
+        setup['setup']['Start time'] = 0.
+        setup['setup']['End time'] = -1
+        dpsd_run.DPSD(setup)
+    logger.info('Worker %d ready', os.getpid())
+
+
+def process_shot(setup_d, nshot, HAfile=None):
+# True if the analysis and the writes of its outputs succeeded: DPSD waits for its
+# writer, a failed write is then retried like a failed analysis
+
+    setup = copy.deepcopy(setup_d)
+    setup['io']['Shots'] = nshot
+    if HAfile is None:
+        setup['io']['HA*.dat file'] = ''
+    else:
+        setup['io']['HA*.dat file'] = HAfile
+    dp = dpsd_run.DPSD(setup)
+    for lbl, ok in dp.written.items():
+        if not ok:
+            logger.error('Writing the output %s failed', lbl)
+    return dp.status and all(dp.written.values())
+
+
+class STUB_TRIGGER:
+# Shots pushed by hand, for local testing
+
+
+    def __init__(self):
+
+        self.queue = queue.Queue()
+
+
+    def push(self, nshot, HAfile=None):
+
+        self.queue.put((nshot, HAfile))
+
+
+    def poll(self, timeout=1.):
+
+        try:
+            return [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+
+class DIR_TRIGGER:
+# Watches the newest shot100 directories of the raw archive.
+# A HA file is considered closed once its *.md5 is written and its size is stable.
+# With skip_existing, the files already there at start-up never fire
+
+
+    def __init__(self, raw_dir=read_ha.raw_dir, interval=1., n_dirs=2, skip_existing=True):
+
+        self.raw_dir = raw_dir
+        self.interval = interval
+        self.n_dirs = n_dirs
+        self.sizes = {}
+        self.fired = set()
+        if skip_existing:
+            try:
+                self.fired = set(nshot for nshot, fha in self.ha_files())
+            except OSError as err:
+                logger.error('Cannot scan %s: %s', self.raw_dir, err)
+            logger.info('Ignoring %d HA files present at start', len(self.fired))
+
+
+    def ha_files(self):
+
+        dirs = [d for d in os.listdir(self.raw_dir) if d.isdigit()]
+        dirs = sorted(dirs, key=int)[-self.n_dirs:]
+        files = []
+        for d in dirs:
+            for root in ['%s/%s' %(self.raw_dir, d)] + ['%s/%s/%s' %(self.raw_dir, d, s) for s in os.listdir('%s/%s' %(self.raw_dir, d)) if s.isdigit()]:
+                if not os.path.isdir(root):
+                    continue
+                for fname in os.listdir(root):
+                    m = re.match(r'HA_(\d+)\.dat$', fname)
+                    if m:
+                        files.append((int(m.group(1)), '%s/%s' %(root, fname)))
+        return files
+
+
+    def poll(self, timeout=None):
+
+        new = []
+        try:
+            files = self.ha_files()
+        except OSError as err:
+            logger.error('Cannot scan %s: %s', self.raw_dir, err)
+            files = []
+        for nshot, fha in files:
+            if nshot in self.fired or not os.path.isfile(fha + '.md5'):
+                continue
+            size = os.path.getsize(fha)
+            if self.sizes.get(nshot) == size:
+                self.fired.add(nshot)
+                new.append((nshot, None))
+            self.sizes[nshot] = size
+        if not new:
+            time.sleep(self.interval)
+        return new
+
+
+class SHOT_SERVICE:
+
+
+    def __init__(self, setup_d, trigger, n_workers=2, max_retries=3, retry_delay=30., state_file=None):
+
+        self.setup = setup_d
+        self.trigger = trigger
+        self.n_workers = n_workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.state_file = state_file
+        self.done = set() # output labels, see key
+        if state_file is not None and os.path.isfile(state_file):
+            with open(state_file) as fjson:
+                self.done = set(str(lbl) for lbl in json.load(fjson))
+        self.running = {}  # future -> (nshot, HAfile, attempt)
+        self.retry = []    # (t_due, nshot, HAfile, attempt)
+        self.stop = False
+        io_d = setup_d['io']
+        self.backend = None
+        if io_d.get('Write shotfiles', False) and not io_d.get('Force SF write', False):
+            self.backend = dpsd_output.get_backend(io_d)
+
+
+    def save_state(self):
+
+        if self.state_file is not None:
+            with open(self.state_file, 'w') as fjson:
+                json.dump(sorted(self.done), fjson)
+
+
+    @staticmethod
+    def result_id(nshot, HAfile):
+# Shot number and HA file as in DPSD.results(): a run on a given HA file has no shot
+# number, see process_shot
+
+        if HAfile is None:
+            return {'nshot': nshot, 'HAfile': None}
+        return {'nshot': None, 'HAfile': HAfile}
+
+
+    def key(self, nshot, HAfile):
+# The output label, the same for the done set and the output backends
+
+        return dpsd_output.label(self.result_id(nshot, HAfile))
+
+
+    def output_exists(self, nshot, HAfile):
+# Checked before computing, the backend would refuse to overwrite anyway
+
+        if self.backend is None:
+            return False
+        try:
+            return self.backend.exists(self.result_id(nshot, HAfile))
+        except Exception as err:
+            logger.warning('Cannot check the output of %s: %s', self.key(nshot, HAfile), err)
+            return False
+
+
+    def submit(self, pool, nshot, HAfile, attempt=0):
+
+        key = self.key(nshot, HAfile)
+        in_flight = [self.key(*job[:2]) for job in self.running.values()] + [self.key(*job[1:3]) for job in self.retry]
+        if key in self.done or (attempt == 0 and key in in_flight):
+            logger.debug('%s already processed or queued', key)
+            return
+        if self.output_exists(nshot, HAfile):
+            logger.info('Output %s exists already, skipping', key)
+            self.done.add(key)
+            self.save_state()
+            return
+        logger.info('Processing %s, attempt %d', key, attempt + 1)
+        fut = pool.submit(process_shot, self.setup, nshot, HAfile)
+        self.running[fut] = (nshot, HAfile, attempt)
+
+
+    def collect(self):
+
+        for fut in [f for f in self.running if f.done()]:
+            nshot, HAfile, attempt = self.running.pop(fut)
+            try:
+                status = fut.result()
+            except Exception as err:
+                logger.exception('Shot %d failed: %s', nshot, err)
+                status = False
+            if status:
+                logger.info('Shot %d done', nshot)
+                self.done.add(self.key(nshot, HAfile))
+                self.save_state()
+            elif attempt + 1 < self.max_retries:
+                logger.warning('Shot %d failed, retrying in %d s', nshot, self.retry_delay)
+                self.retry.append((time.time() + self.retry_delay, nshot, HAfile, attempt + 1))
+            else:
+                logger.error('Shot %d failed %d times, giving up', nshot, self.max_retries)
+
+
+    def run(self, stop_hour=None):
+
+        logger.info('ctrl+c to terminate the service')
+        with ProcessPoolExecutor(max_workers=self.n_workers, initializer=warmup, initargs=(self.setup, )) as pool:
+            while not self.stop:
+                if stop_hour is not None and time.localtime().tm_hour >= stop_hour:
+                    break
+                for nshot, HAfile in self.trigger.poll():
+                    self.submit(pool, nshot, HAfile)
+                now = time.time()
+                for job in [j for j in self.retry if j[0] <= now]:
+                    self.retry.remove(job)
+                    self.submit(pool, *job[1:])
+                self.collect()
+            for fut in list(self.running):
+                fut.result()
+            self.collect()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+import os, json, time, logging, argparse
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import dpsd_hist
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDshm')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+dpsd_dir = os.path.dirname(os.path.realpath(__file__))
+
+# Live results in a shared-memory ring of fixed-size records, one writer, any number
+# of readers. Each record is a time chunk of a shot: rates per class, the LED gain
+# and the PH spectra of that chunk. The record seq is odd while being written and
+# 2*(k+1) once record k is complete (seqlock): readers never block the writer,
+# they detect and skip records overwritten while reading
+
+magic = 0x44505344 # 'DPSD'
+cnt_list = ('neut1', 'gamma1', 'led', 'pileup', 'neut2', 'gamma2', 'DD', 'DT')
+spec_list = ('neut1', 'gamma1')
+published = set() # segments created by this process
+
+hdr_dtype = np.dtype([('magic', np.int64), ('n_slots', np.int64), ('max_bins', np.int64), \
+    ('max_led', np.int64), ('n_ph', np.int64), ('head', np.int64)])
+
+
+def rec_dtype(max_bins, max_led, n_ph):
+
+    return np.dtype([('seq', np.int64), ('nshot', np.int64), ('t0', np.float64), ('tstep', np.float64), \
+        ('n_bins', np.int32), ('n_led', np.int32), ('t0_led', np.float64), ('dt_led', np.float64), \
+        ('cnt', np.float32, (len(cnt_list), max_bins)), ('pmgain', np.float32, (max_led, )), \
+        ('phs', np.float32, (len(spec_list), n_ph))])
+
+
+def layout(buf):
+# Header and record array as views on the shared buffer
+
+    hdr = np.ndarray((1, ), dtype=hdr_dtype, buffer=buf)[0]
+    dtype = rec_dtype(hdr['max_bins'], hdr['max_led'], hdr['n_ph'])
+    recs = np.ndarray((hdr['n_slots'], ), dtype=dtype, buffer=buf, offset=hdr_dtype.itemsize)
+    return hdr, recs
+
+
+class PUBLISHER:
+
+
+    def __init__(self, name='dpsd_live', n_slots=64, max_bins=1000, max_led=100, n_ph=4096):
+
+        dtype = rec_dtype(max_bins, max_led, n_ph)
+        size = hdr_dtype.itemsize + n_slots*dtype.itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError: # left over by a crashed publisher
+            old = shared_memory.SharedMemory(name=name)
+            old.close()
+            old.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        published.add(name)
+        hdr = np.ndarray((1, ), dtype=hdr_dtype, buffer=self.shm.buf)
+        hdr[0] = (0, n_slots, max_bins, max_led, n_ph, 0)
+        self.hdr, self.recs = layout(self.shm.buf)
+        self.hdr['magic'] = magic
+        logger.info('Publishing on shared memory %s, %d slots of %d bytes', name, n_slots, dtype.itemsize)
+
+
+    def write(self, nshot, t0, tstep, cnt, t0_led, dt_led, pmgain, phs):
+# One record; cnt {spec: rates}, phs {spec: PH spectrum}
+
+        k = int(self.hdr['head'])
+        rec = self.recs[k %len(self.recs)]
+        rec['seq'] = 2*k + 1
+        n_bins = min(len(cnt[cnt_list[0]]), self.hdr['max_bins'])
+        n_led = min(len(pmgain), self.hdr['max_led'])
+        rec['nshot'] = -1 if nshot is None else nshot
+        rec['t0'] = t0
+        rec['tstep'] = tstep
+        rec['n_bins'] = n_bins
+        rec['n_led'] = n_led
+        rec['t0_led'] = t0_led
+        rec['dt_led'] = dt_led
+        for jc, spec in enumerate(cnt_list):
+            if spec in cnt:
+                rec['cnt'][jc, :n_bins] = cnt[spec][:n_bins]
+            else:
+                rec['cnt'][jc, :n_bins] = np.nan
+        rec['pmgain'][:n_led] = pmgain[:n_led]
+        for js, spec in enumerate(spec_list):
+            rec['phs'][js] = phs.get(spec, 0)
+        rec['seq'] = 2*k + 2
+        self.hdr['head'] = k + 1
+
+
+    def publish(self, res):
+# Splits the results of a shot (DPSD.results()) into records of max_bins time bins
+
+        tstep = res['setup']['setup']['Time step']
+        dt_led = res['setup']['led']['LED time sampling']
+        max_bins = int(self.hdr['max_bins'])
+        time_cnt = np.asarray(res['time_cnt'])
+        time_led = np.asarray(res['time_led'])
+        spgram = dpsd_hist.load_spectrograms(res['spgram'], int(self.hdr['n_ph'])) if 'spgram' in res else {}
+        for j0 in range(0, len(time_cnt), max_bins):
+            j1 = min(j0 + max_bins, len(time_cnt))
+            t0 = time_cnt[j0] - 0.5*tstep
+            t1 = time_cnt[j1 - 1] + 0.5*tstep
+            jled = np.where((time_led >= t0) & (time_led < t1))[0]
+            phs = {}
+            for spec, spg in spgram.items():
+                jnz = slice(spg.indptr[j0], spg.indptr[j1])
+                phs[spec] = np.bincount(spg.jph[jnz], weights=spg.counts[jnz], minlength=spg.n_ph)/(t1 - t0)
+            self.write(res.get('nshot'), t0, tstep, {spec: cnt[j0: j1] for spec, cnt in res['cnt'].items()}, \
+                time_led[jled[0]] - 0.5*dt_led if len(jled) > 0 else t0, dt_led, np.asarray(res['pmgain'])[jled], phs)
+
+
+    def on_shot(self, dp):
+# To be passed as DPSD(..., on_shot=publisher.on_shot)
+
+        self.publish(dp.results())
+
+
+    def close(self):
+
+        self.hdr = None
+        self.recs = None
+        self.shm.close()
+        self.shm.unlink()
+        published.discard(self.shm.name)
+
+
+class READER:
+
+
+    def __init__(self, name='dpsd_live'):
+
+        self.shm = shared_memory.SharedMemory(name=name)
+# Python < 3.13 registers attached segments too and would unlink them at exit
+        if name not in published:
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.hdr, self.recs = layout(self.shm.buf)
+        if self.hdr['magic'] != magic:
+            raise ValueError('%s is not a DPSD live buffer' %name)
+        self.next = max(int(self.hdr['head']) - len(self.recs), 0)
+
+
+    def view(self, k):
+# Zero-copy view of record k, valid while valid(k, seq) holds
+
+        return self.recs[k %len(self.recs)]
+
+
+    def valid(self, k, seq):
+
+        return seq == 2*k + 2 and self.recs[k %len(self.recs)]['seq'] == seq
+
+
+    def read(self, k):
+# Consistent copy of record k as a dict, None if not yet written or overwritten
+
+        rec = self.view(k)
+        seq = int(rec['seq'])
+        if seq != 2*k + 2:
+            return None
+        n_bins = int(rec['n_bins'])
+        n_led = int(rec['n_led'])
+        out = {'nshot': int(rec['nshot']), 'time': rec['t0'] + rec['tstep']*(0.5 + np.arange(n_bins)), \
+            'cnt': {spec: rec['cnt'][jc, :n_bins].copy() for jc, spec in enumerate(cnt_list)}, \
+            'time_led': rec['t0_led'] + rec['dt_led']*(0.5 + np.arange(n_led)), 'pmgain': rec['pmgain'][:n_led].copy(), \
+            'phs': {spec: rec['phs'][js].copy() for js, spec in enumerate(spec_list)}}
+        if not self.valid(k, seq):
+            return None
+        return out
+
+
+    def poll(self):
+# New records since the last call; records overwritten before being read are skipped
+
+        head = int(self.hdr['head'])
+        if head - self.next > len(self.recs):
+            logger.warning('Reader too slow, skipped %d records', head - self.next - len(self.recs))
+            self.next = head - len(self.recs)
+        out = []
+        for k in range(self.next, head):
+            rec = self.read(k)
+            if rec is not None:
+                out.append(rec)
+        self.next = head
+        return out
+
+
+    def wait(self, timeout=None, interval=0.01):
+# Blocks until new records arrive (or timeout), checking the head counter only
+
+        t_end = None if timeout is None else time.time() + timeout
+        while int(self.hdr['head']) == self.next:
+            if t_end is not None and time.time() > t_end:
+                return []
+            time.sleep(interval)
+        return self.poll()
+
+
+    def close(self):
+
+        self.hdr = None
+        self.recs = None
+        self.shm.close()
+
+
+if __name__ == '__main__':
+# Stand-in client: python dpsd_shm.py watch, or publish the analysis of a HA file
+
+    parser = argparse.ArgumentParser(description='DPSD live shared-memory buffer')
+    parser.add_argument('mode', choices=('watch', 'publish'))
+    parser.add_argument('HAfile', nargs='?', default='')
+    parser.add_argument('--name', default='dpsd_live')
+    parser.add_argument('-s', '--settings', default='%s/settings/default.json' %dpsd_dir)
+    args = parser.parse_args()
+
+    if args.mode == 'watch':
+        reader = READER(args.name)
+        try:
+            while True:
+                for rec in reader.wait():
+                    rate = {spec: np.mean(cnt) for spec, cnt in rec['cnt'].items()}
+                    print('#%d %7.3f-%7.3f s  neut1 %10.3e  gamma1 %10.3e  pmgain %8.1f' %(rec['nshot'], \
+                        rec['time'][0], rec['time'][-1], rate['neut1'], rate['gamma1'], \
+                        np.mean(rec['pmgain']) if len(rec['pmgain']) > 0 else np.nan))
+        except KeyboardInterrupt:
+            reader.close()
+    else:
+        import dpsd_run
+        with open(args.settings) as fjson:
+            setup_d = json.load(fjson)
+        setup_d['io'].update({'HA*.dat file': args.HAfile, 'Write shotfiles': False})
+        pub = PUBLISHER(args.name, n_ph=setup_d['separation']['#bins Pulse Height'])
+        try:
+            dpsd_run.DPSD(setup_d, on_shot=pub.on_shot)
+            input('Published, press return to remove the buffer')
+        finally:
+            pub.close()
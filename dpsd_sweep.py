@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import os, json, copy, logging, itertools, argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import dpsd_run, dpsd_hist, dpsd_lut, dpsd_gates, kernels
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDsweep')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+dpsd_dir = os.path.dirname(os.path.realpath(__file__))
+
+metrics = ('neut', 'gamma', 'ng_ratio', 'DD', 'DT', 'led', 'pileup', 'fom')
+
+
+def split_grid(grid, setup_d):
+# Grid keys are setup entries of the 'separation' or 'led' section, e.g.
+# {'Slope of 1st sep.line': [0.13, 0.15, 0.17], 'Min PS bin for LED detection': [80, 85]}
+
+    sep_keys = []
+    led_keys = []
+    for key in grid:
+        if key in setup_d['led']:
+            led_keys.append(key)
+        elif key in setup_d['separation']:
+            sep_keys.append(key)
+        else:
+            raise KeyError('Sweep parameter "%s" is neither a separation nor a LED entry' %key)
+    return sep_keys, led_keys
+
+
+class SWEEP:
+# Features (integrals, PS, flags) of one DPSD run; each LED setting reruns the LED
+# flags and correction, each separation setting is evaluated on the PH-PS histogram
+# of the physical events (bin resolution, no event loop)
+
+
+    def __init__(self, dp):
+
+        self.setup = dp.setup
+        self.time = dp.time
+        self.TotalIntegral = dp.TotalIntegral_raw
+        self.PulseShape = dp.PulseShape
+        self.flg_sat = dp.flg['sat']
+        self.weight = dp.weight
+        self.dt = dp.dt
+        nxCh = self.setup['separation']['#bins Pulse Height']
+        nyCh = self.setup['separation']['#bins Pulse Shape']
+        self.dxCh = np.float32(nxCh)/np.float32(self.setup['separation']['Marker'])
+        self.jbin_ps = dpsd_lut.edge_bins(dp.jbin_ps, dp.PulseShape, nyCh)
+        self.ph_centre = dpsd_lut.bin_centres(nxCh)
+        self.ps_centre = dpsd_lut.bin_centres(nyCh)
+
+# Pile-up depends on the LED flags only through the window widths
+        peak_d = self.setup['peak']
+        led_d = self.setup['led']
+        if (peak_d['Front'], peak_d['Tail']) == (led_d['LED front'], led_d['LED tail']):
+            self.peaks = (dp.flg_peaks, dp.flg_peaks)
+        elif len(dp.pulse_index) == len(dp.time):
+            n_pulses = len(dp.time)
+            self.peaks = tuple(kernels.PileUpDet(peak_d['Front'], peak_d['Tail'], peak_d['Threshold'], \
+                led_d['LED front'], led_d['LED tail'], np.full(n_pulses, flag), dp.pulses) for flag in (False, True))
+        else:
+            logger.warning('Pulses not retained, pile-up flags kept from the LED setting of the run')
+            self.peaks = (dp.flg_peaks, dp.flg_peaks)
+
+
+    def led(self, led_d):
+# LED flags, corrected PH and physical-event mask for one LED setting
+
+        ph_raw = self.dxCh*self.TotalIntegral
+        flg_led = \
+            (ph_raw > float(led_d['Min PH bin for LED detection'])) & \
+            (ph_raw < float(led_d['Max PH bin for LED detection'])) & \
+            (self.PulseShape > float(led_d['Min PS bin for LED detection'])) & \
+            (self.PulseShape < float(led_d['Max PS bin for LED detection']))
+        flg_pileup = np.where(flg_led, self.peaks[1], self.peaks[0]) > 1
+        pmgain, pulse_height = kernels.led_correction(led_d['LED time sampling'], self.dxCh, led_d['LED reference bin'], self.time, self.TotalIntegral, flg_led)
+        flg_phys = (~self.flg_sat) & (~flg_led) & (~flg_pileup)
+        return pulse_height, flg_led, flg_pileup, flg_phys
+
+
+    def histogram(self, pulse_height, flg_phys):
+# PH-PS histogram of the physical events, events outside the table in its edge bins as in dpsd_lut.lookup
+
+        nxCh = len(self.ph_centre)
+        nyCh = len(self.ps_centre)
+        jbin_ph = dpsd_lut.edge_bins(dpsd_run.bin_index(pulse_height, nxCh, -0.5, nxCh + 0.5), pulse_height, nxCh)
+        if self.weight is None:
+            return dpsd_hist.hist2d(jbin_ph, self.jbin_ps, nxCh, nyCh, mask=flg_phys).astype(np.float64)
+        ok = (jbin_ph >= 0) & (self.jbin_ps >= 0) & flg_phys
+        return np.bincount(jbin_ph[ok].astype(np.int64)*nyCh + self.jbin_ps[ok], weights=self.weight[ok], minlength=nxCh*nyCh).reshape(nxCh, nyCh)
+
+
+    def separation(self, sep_d, hist):
+# Class counts from the class table of DPSD.classify ('Classifier' geometry);
+# FOM of dpsd_gates on the PS distance (in bins) from the lower edge of the gamma
+# region of each PH column, split at the separation
+
+        nyCh = len(self.ps_centre)
+        lut = dpsd_lut.build(sep_d)
+        res = {}
+        for key, code in (('neut', dpsd_lut.NEUT), ('gamma', dpsd_lut.GAMMA), ('DD', dpsd_lut.DD), ('DT', dpsd_lut.DT)):
+            res[key] = np.sum(hist[(lut & code) > 0])
+        res['ng_ratio'] = res['neut']/res['gamma'] if res['gamma'] > 0 else np.nan
+        gamma = (lut & dpsd_lut.GAMMA) > 0
+        jcut = np.where(np.any(gamma, axis=1), np.argmax(gamma, axis=1), nyCh)
+        dist = np.arange(nyCh)[None, :] - jcut[:, None] + nyCh
+        hdist = np.bincount(dist.ravel(), weights=hist.ravel(), minlength=2*nyCh + 1)
+        res['fom'] = dpsd_gates.fom(hdist, np.arange(-nyCh, nyCh + 1, dtype=np.float64), jcut=nyCh - 1)[0]
+        return res
+
+
+    def run(self, grid):
+# Returns a table {column: array}, one row per grid point (parameters + metrics)
+
+        sep_keys, led_keys = split_grid(grid, self.setup)
+        led_points = list(itertools.product(*[grid[key] for key in led_keys]))
+        sep_points = list(itertools.product(*[grid[key] for key in sep_keys]))
+        logger.info('Sweeping %d LED x %d separation settings', len(led_points), len(sep_points))
+        rows = []
+        for led_val in led_points:
+            led_d = dict(self.setup['led'], **dict(zip(led_keys, led_val)))
+            pulse_height, flg_led, flg_pileup, flg_phys = self.led(led_d)
+            hist = self.histogram(pulse_height, flg_phys)
+            if self.weight is None:
+                n_led, n_pileup = np.sum(flg_led), np.sum(flg_pileup)
+            else:
+                n_led, n_pileup = np.sum(self.weight[flg_led]), np.sum(self.weight[flg_pileup])
+            for sep_val in sep_points:
+                sep_d = dict(self.setup['separation'], **dict(zip(sep_keys, sep_val)))
+                res = self.separation(sep_d, hist)
+                res['led'] = n_led
+                res['pileup'] = n_pileup
+                rows.append(list(led_val) + list(sep_val) + [res[key] for key in metrics])
+        rows = np.array(rows, dtype=np.float64).reshape(-1, len(led_keys) + len(sep_keys) + len(metrics))
+        return {key: rows[:, jcol] for jcol, key in enumerate(led_keys + sep_keys + list(metrics))}
+
+
+def features(setup_d, item):
+# One DPSD run without output, item is a shot number or a HA file
+
+    setup = copy.deepcopy(setup_d)
+    setup['io'].update({'Write shotfiles': False, 'Prefetch': False})
+    if isinstance(item, str):
+        setup['io']['HA*.dat file'] = item
+    else:
+        setup['io'].update({'Shots': item, 'HA*.dat file': ''})
+    led_d = setup['led']
+    peak_d = setup['peak']
+    if (peak_d['Front'], peak_d['Tail']) == (led_d['LED front'], led_d['LED tail']):
+        setup['io']['Pulse retention'] = 'none'
+    else:
+        setup['io']['Pulse retention'] = 'all'
+    dp = dpsd_run.DPSD(setup)
+    if not dp.status:
+        return None
+    return SWEEP(dp)
+
+
+def sweep_item(item, setup_d, grid):
+
+    sw = features(setup_d, item)
+    if sw is None:
+        return None
+    return sw.run(grid)
+
+
+def sweep(items, setup_d, grid, n_workers=None):
+# One process per shot/file, returns {item: table}
+
+    tables = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {item: pool.submit(sweep_item, item, setup_d, grid) for item in items}
+        for item, fut in futures.items():
+            try:
+                tables[item] = fut.result()
+            except Exception as err:
+                logger.exception('Sweep for %s failed: %s', item, err)
+                tables[item] = None
+    return tables
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='DPSD separation/LED parameter sweep')
+    parser.add_argument('items', nargs='+', help='shot numbers or HA*.dat files')
+    parser.add_argument('-g', '--grid', required=True, help='json file {setup entry: [values]}')
+    parser.add_argument('-s', '--settings', default='%s/settings/default.json' %dpsd_dir)
+    parser.add_argument('-n', '--workers', type=int, default=None)
+    parser.add_argument('-o', '--out', default='', help='npz file for the tables')
+    args = parser.parse_args()
+
+    with open(args.settings) as fjson:
+        setup_d = json.load(fjson)
+    with open(args.grid) as fjson:
+        grid = json.load(fjson)
+    items = [int(item) if item.isdigit() else item for item in args.items]
+    tables = sweep(items, setup_d, grid, n_workers=args.workers)
+    out = {}
+    for item, table in tables.items():
+        if table is None:
+            continue
+        jbest = np.nanargmax(table['fom']) if np.any(np.isfinite(table['fom'])) else 0
+        logger.info('%s: best FOM %6.3f at %s', item, table['fom'][jbest], \
+            ', '.join('%s=%g' %(key, val[jbest]) for key, val in table.items() if key not in metrics))
+        for key, val in table.items():
+            out['%s/%s' %(item, key)] = val
+    if args.out:
+        np.savez(args.out, **out)
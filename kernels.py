@@ -0,0 +1,612 @@
+import os, logging
+import numpy as np
+
+fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
+logger = logging.getLogger('DPSDker')
+hnd = logging.StreamHandler()
+hnd.setFormatter(fmt)
+logger.addHandler(hnd)
+logger.setLevel(logging.INFO)
+
+# Compute kernels with interchangeable backends:
+#   numpy          vectorized reference, no compiler needed
+#   numba          the loops below, compiled
+#   numba-parallel same loops, pulses distributed over threads (prange)
+# The backend is chosen at import (env DPSD_KERNELS overrides), or with use().
+# DPSD_KERNELS_CHECK=1 (or use(..., check=True)) runs the numpy reference
+# alongside each call and logs any difference
+
+try:
+    import numba as nb
+    prange = nb.prange
+except ImportError:
+    nb = None
+    prange = range
+
+names = ('minTension', 'raw2pulse', 'Baseline', 'BaselineCond2', 'slice_trapz', \
+    'PileUpDet', 'led_correction', 'pulse_stats', 'pileup_fit', 'int_baseline', 'int_trapz')
+
+
+#-------------------------------------------
+# Loops, compiled by the numba backends
+#-------------------------------------------
+
+def _minTension(pulse_in):
+    pulse_even = np.ascontiguousarray(pulse_in[:-1:2])
+    pulse_odd  = np.ascontiguousarray(pulse_in[1::2])
+    len0 = len(pulse_odd)
+    min_tens = 1e8
+    pulse_ok = np.empty(0, dtype=pulse_in.dtype)
+    jmin = -1
+    for j in range(3):
+        N = len0 - j
+        pulse2 = np.empty(2 * N, dtype=pulse_in.dtype)
+        pulse2[0::2] = pulse_odd[j:]
+        pulse2[1::2] = pulse_even[:N]
+        tension = np.sum((pulse2[1:] - pulse2[:-1])**2)
+        if tension < min_tens:
+            pulse_ok = pulse2
+            min_tens = tension
+            jmin = j
+    return jmin, pulse_ok
+
+def _raw2pulse(max_winlen, win_start, pulse_len, rawdata):
+    win_end = win_start + pulse_len
+    n_pulses = win_start.shape[0]
+    pulses = np.zeros((n_pulses, max_winlen), dtype=rawdata.dtype)
+    bad = np.zeros(n_pulses, dtype=np.bool_)
+# Determine shift using a minimum-derivative**2 approach, pulse by pulse
+    for jwin in prange(n_pulses):
+        jpos = win_start[jwin]
+        pulse = rawdata[jpos : win_end[jwin]]
+        jmin, pulse_ok = minTension_jit(pulse)
+        bad[jwin] = (jmin > 0)
+        len_pul = len(pulse_ok)
+        pulses[jwin, : len_pul] = pulse_ok
+    return bad, pulses
+
+def _slice_trapz(a, bnd_l, bnd_r):
+    b = np.empty(a.shape[0])
+    for j in prange(a.shape[0]):
+        b[j] = np.sum(a[j, bnd_l[j]+1: bnd_r[j]-1])
+        b[j] += 0.5*(a[j, bnd_l[j]] + a[j, bnd_r[j]-1])
+    return b
+
+def _led_correction(dtled, dxCh, led_ref, time, totalintegral, flg_led):
+
+    jled_old = 0
+    jtmark = 0
+    LEDsumm = 0
+    LEDamount = 0
+    LEDcoeff = 0
+    tled = ((time - time[0])/dtled).astype(np.int32)
+    n_pulses = len(time)
+    n_led = int((time[-1] - time[0])/dtled)
+    pulseheight = dxCh*totalintegral
+    pmgain = np.zeros(n_led, dtype=np.float32)
+
+    for jpul in range(n_pulses):
+        jled = tled[jpul]
+        if jled > jled_old:
+            if LEDamount > 0:
+                pmgain[jled] = dxCh*np.float32(LEDsumm)/np.float32(LEDamount)
+                if LEDsumm > 0:
+                    LEDcoeff = np.float32(led_ref)/pmgain[jled]
+            pulseheight[jtmark: jpul] *= LEDcoeff
+            jtmark = jpul
+            LEDsumm = 0
+            LEDamount = 0
+            LEDcoeff = 0
+        if flg_led[jpul]: # LED single pulse
+            LEDsumm += totalintegral[jpul]
+            LEDamount += 1
+        jled_old = jled
+
+    return pmgain, pulseheight
+
+def _BaselineCond2(bl_start, max_diff, pulses, pulse_len, maxpos, max_lg):
+
+    n_pulses = maxpos.shape[0]
+    pulse_basestart = pulse_len - bl_start
+    blstart_h = bl_start//2
+    totalintegral = np.zeros(n_pulses, dtype=np.float32)
+
+    for jpul in prange(n_pulses):
+        newpulse_len = 0
+        pulse = pulses[jpul]
+        if pulse_basestart[jpul] >= maxpos[jpul]:
+            newpulse_len = pulse_len[jpul] - blstart_h
+        else:
+            aver1 = np.mean(pulse[:bl_start])
+            for j in range(maxpos[jpul], pulse_basestart[jpul]):
+                aver2 = np.mean(pulse[j: j+bl_start])
+                if np.abs(aver2 - aver1) < max_diff:
+                    if max_lg[jpul] > j + blstart_h:
+                        newpulse_len = max_lg[jpul]
+                    else:
+                        newpulse_len = j + blstart_h
+                    break
+                if (j == pulse_basestart[jpul] - 1) :
+                    newpulse_len = pulse_len[jpul] - blstart_h
+        for j in range(1, newpulse_len-1):
+            totalintegral[jpul] += pulse[j]
+        totalintegral[jpul] += 0.5*(pulse[0] + pulse[newpulse_len-1])
+
+    return totalintegral
+
+def _Baseline(basestart, baseend, pulse_len, pulses):
+    n_pulses = pulses.shape[0]
+    pulse_baseend = pulse_len - baseend
+    baseline = np.sum(pulses[:, :basestart], axis=1)
+    for jpul in prange(n_pulses):
+        nind = basestart
+        for j in range(pulse_baseend[jpul], pulse_len[jpul]):
+            if j >= basestart:
+                baseline[jpul] += pulses[jpul, j]
+                nind += 1
+        baseline[jpul] /= float(nind)
+    return baseline
+
+def _PileUpDet(nfront, ntail, nthres, front_led, tail_led, flags, pulses):
+    n_pulses, pulse_len = pulses.shape
+    flg_peaks = np.zeros(n_pulses, dtype=np.int32)
+    for jpul in prange(n_pulses):
+        pulse = pulses[jpul]
+        if flags[jpul]:
+            pulse_width = front_led + tail_led
+            pulse_front = pulse[front_led : -tail_led] - nthres
+        else:
+            pulse_width = nfront + ntail
+            pulse_front = pulse[nfront : -ntail] - nthres
+
+        pulse_max = np.maximum(pulse[:-pulse_width], pulse[pulse_width:])
+        flg_peaks[jpul] = 0
+        jt = 0
+        while jt < pulse_len-pulse_width:
+            if pulse_front[jt] > pulse_max[jt]:
+                flg_peaks[jpul] += 1
+                jt += pulse_width
+            jt += 1
+    return flg_peaks
+
+def _pulse_stats(pulses, baseline, pulse_len, jcls, n_cls, amp_min, amp_max, n_amp):
+# Per class and sample: number of samples, sum, sum of squares and amplitude histogram
+# of pulses - baseline
+    n_pulses, n_samp = pulses.shape
+    n_sum = np.zeros((n_cls, n_samp), dtype=np.int64)
+    s1 = np.zeros((n_cls, n_samp))
+    s2 = np.zeros((n_cls, n_samp))
+    persist = np.zeros((n_cls, n_samp, n_amp), dtype=np.int32)
+    damp = n_amp/(amp_max - amp_min)
+    for jpul in range(n_pulses):
+        jc = jcls[jpul]
+        if jc < 0:
+            continue
+        for j in range(min(pulse_len[jpul], n_samp)):
+            x = pulses[jpul, j] - baseline[jpul]
+            n_sum[jc, j] += 1
+            s1[jc, j] += x
+            s2[jc, j] += x*x
+            jamp = int((x - amp_min)*damp)
+            if jamp >= 0 and jamp < n_amp:
+                persist[jc, j, jamp] += 1
+    return n_sum, s1, s2, persist
+
+def _solve(G, b):
+# G a = b for a small symmetric positive definite G, Gaussian elimination
+    m = len(b)
+    A = G.copy()
+    a = b.copy()
+    for i in range(m):
+        for k in range(i + 1, m):
+            f = A[k, i]/A[i, i]
+            for j in range(i, m):
+                A[k, j] -= f*A[i, j]
+            a[k] -= f*a[i]
+    for i in range(m - 1, -1, -1):
+        for j in range(i + 1, m):
+            a[i] -= A[i, j]*a[j]
+        a[i] /= A[i, i]
+    return a
+
+def _pileup_fit(pulses, pulse_len, templates, n_pre, nfront, ntail, nthres, rel_thres, max_pulses):
+# Greedy decomposition: the highest residual peak (PileUpDet criterion) is a candidate
+# pulse with the best class template, then all amplitudes are refitted by least squares
+# against the full templates. The candidate is kept if its amplitude is above the
+# threshold thres = max(nthres, rel_thres*first amplitude) and chi2 drops at least by
+# as much as an isolated pulse of height thres would remove
+    n_pulses = pulses.shape[0]
+    n_cls, n_tmpl = templates.shape
+    n_found = np.zeros(n_pulses, dtype=np.int32)
+    pos = np.zeros((n_pulses, max_pulses), dtype=np.int32)
+    amp = np.zeros((n_pulses, max_pulses), dtype=np.float32)
+    cls = np.zeros((n_pulses, max_pulses), dtype=np.int32)
+    for jpul in prange(n_pulses):
+        n_samp = pulse_len[jpul]
+        x = pulses[jpul, :n_samp].astype(np.float64)
+        res = x.copy()
+        chi2 = np.sum(x*x)
+        basis = np.zeros((max_pulses, n_samp))
+        a_fit = np.zeros(max_pulses)
+        for k in range(max_pulses):
+            jmax = np.argmax(res)
+            peak = res[jmax]
+            side = -np.inf
+            if jmax >= nfront:
+                side = res[jmax - nfront]
+            if jmax + ntail < n_samp:
+                side = max(side, res[jmax + ntail])
+            if peak - nthres <= side or peak <= nthres:
+                break
+            if k > 0 and np.any(pos[jpul, :k] == jmax):
+                break
+            j0 = max(jmax - n_pre, 0)
+            j1 = min(jmax - n_pre + n_tmpl, n_samp)
+            best = -1
+            best_gain = 0.
+            for jc in range(n_cls):
+                st = 0.
+                tt = 0.
+                for j in range(j0, j1):
+                    t = templates[jc, j - jmax + n_pre]
+                    st += res[j]*t
+                    tt += t*t
+                if st > 0 and st*st > best_gain*tt:
+                    best_gain = st*st/tt
+                    best = jc
+            if best < 0:
+                break
+            basis[k, :] = 0.
+            for j in range(j0, j1):
+                basis[k, j] = templates[best, j - jmax + n_pre]
+            m = k + 1
+            G = np.zeros((m, m))
+            b = np.zeros(m)
+            for i in range(m):
+                b[i] = np.sum(basis[i]*x)
+                for i2 in range(i + 1):
+                    G[i, i2] = np.sum(basis[i]*basis[i2])
+                    G[i2, i] = G[i, i2]
+            a = solve_jit(G, b)
+            model = np.zeros(n_samp)
+            for i in range(m):
+                model += a[i]*basis[i]
+            chi2_new = np.sum((x - model)**2)
+            thres = max(nthres, rel_thres*a[0])
+            if not (np.min(a) > 0 and a[k] > thres and chi2 - chi2_new > thres*thres*G[k, k]):
+                break
+            chi2 = chi2_new
+            res = x - model
+            a_fit[:m] = a
+            pos[jpul, k] = jmax
+            cls[jpul, k] = best
+            n_found[jpul] = m
+        for k in range(n_found[jpul]):
+            amp[jpul, k] = a_fit[k]
+    return n_found, pos, amp, cls
+
+def _int_baseline(basestart, baseend, pulse_len, pulses):
+# Baseline of raw integer pulses, summed in int64
+    n_pulses = pulses.shape[0]
+    baseline = np.empty(n_pulses, dtype=np.float32)
+    for jpul in prange(n_pulses):
+        bsum = np.int64(0)
+        for j in range(basestart):
+            bsum += pulses[jpul, j]
+        nind = basestart
+        for j in range(pulse_len[jpul] - baseend, pulse_len[jpul]):
+            if j >= basestart:
+                bsum += pulses[jpul, j]
+                nind += 1
+        baseline[jpul] = bsum/nind
+    return baseline
+
+def _int_trapz(a, bnd_l, bnd_r):
+# Twice slice_trapz of integer pulses, exact in int64
+    b = np.empty(a.shape[0], dtype=np.int64)
+    for j in prange(a.shape[0]):
+        bsum = np.int64(0)
+        for k in range(bnd_l[j]+1, bnd_r[j]-1):
+            bsum += a[j, k]
+        b[j] = 2*bsum + a[j, bnd_l[j]] + a[j, bnd_r[j]-1]
+    return b
+
+
+
+#-------------------------------------------
+# NumPy reference, vectorized over pulses
+#-------------------------------------------
+
+def np_minTension(pulse_in):
+
+    jmin, pulses = np_interleave(pulse_in[None, :])
+    if jmin[0] < 0:
+        return -1, np.empty(0, dtype=pulse_in.dtype)
+    return jmin[0], pulses[0, : 2*(len(pulse_in)//2 - jmin[0])]
+
+def np_interleave(win):
+# minTension for equal-length windows (rows of win): best shift and re-ordered samples
+
+    n_win, len_win = win.shape
+    even = win[:, :-1:2]
+    odd  = win[:, 1::2]
+    len0 = odd.shape[1]
+    tension = np.full((n_win, 3), np.inf)
+    for j in range(3):
+        N = len0 - j
+        if N < 0:
+            break
+        pulse2 = np.empty((n_win, 2*N), dtype=win.dtype)
+        pulse2[:, 0::2] = odd[:, j:]
+        pulse2[:, 1::2] = even[:, :N]
+        tension[:, j] = np.sum((pulse2[:, 1:] - pulse2[:, :-1]).astype(np.int64)**2, axis=1)
+    tension[tension >= 1e8] = np.inf
+    jmin = np.argmin(tension, axis=1)
+    jmin[np.isinf(tension[np.arange(n_win), jmin])] = -1
+    out = np.zeros((n_win, 2*len0), dtype=win.dtype)
+    for j in range(3):
+        (ind, ) = np.where(jmin == j)
+        N = len0 - j
+        out[ind, 0: 2*N: 2] = odd[ind, j:]
+        out[ind, 1: 2*N: 2] = even[ind, :N]
+    return jmin, out
+
+def np_raw2pulse(max_winlen, win_start, pulse_len, rawdata):
+
+    n_pulses = win_start.shape[0]
+    pulses = np.zeros((n_pulses, max_winlen), dtype=rawdata.dtype)
+    bad = np.zeros(n_pulses, dtype=np.bool_)
+    for len_win in np.unique(pulse_len):
+        (ind, ) = np.where(pulse_len == len_win)
+        win = rawdata[win_start[ind, None] + np.arange(len_win)]
+        jmin, out = np_interleave(win)
+        bad[ind] = (jmin > 0)
+        for j in range(3):
+            jsel = ind[jmin == j]
+            n_ok = 2*(len_win//2 - j)
+            pulses[jsel, :n_ok] = out[jmin == j, :n_ok]
+    return bad, pulses
+
+def np_window_sum(a, j0, j1, dtype=None):
+# Row sums of a[j, j0[j]: j1[j]], accumulated in dtype (default a.dtype)
+
+    jcol = np.arange(a.shape[1])
+    mask = (jcol >= j0[:, None]) & (jcol < j1[:, None])
+    return np.sum(np.where(mask, a, 0), axis=1, dtype=a.dtype if dtype is None else dtype)
+
+def np_slice_trapz(a, bnd_l, bnd_r):
+
+    jrow = np.arange(a.shape[0])
+    b = np_window_sum(a, bnd_l + 1, bnd_r - 1).astype(np.float64)
+    b += 0.5*(a[jrow, bnd_l] + a[jrow, (bnd_r - 1) %a.shape[1]])
+    return b
+
+def np_led_correction(dtled, dxCh, led_ref, time, totalintegral, flg_led):
+
+    tled = ((time - time[0])/dtled).astype(np.int32)
+    n_led = int((time[-1] - time[0])/dtled)
+    pulseheight = dxCh*totalintegral
+    pmgain = np.zeros(n_led, dtype=np.float32)
+
+# Groups of pulses with the same LED time bin; all but the last one are rescaled
+    jstart = np.append(0, np.where(np.diff(tled) > 0)[0] + 1)
+    led_sum = np.add.reduceat(np.where(flg_led, totalintegral, 0).astype(np.float64), jstart)
+    led_amount = np.add.reduceat(flg_led.astype(np.int64), jstart)
+    for jgrp in range(len(jstart) - 1):
+        jled = tled[jstart[jgrp + 1]]
+        coeff = np.float32(0)
+        if led_amount[jgrp] > 0:
+            gain = dxCh*np.float32(led_sum[jgrp])/np.float32(led_amount[jgrp])
+            if jled < n_led:
+                pmgain[jled] = gain
+            if led_sum[jgrp] > 0:
+                coeff = np.float32(led_ref)/gain
+        pulseheight[jstart[jgrp]: jstart[jgrp + 1]] *= coeff
+    return pmgain, pulseheight
+
+def np_BaselineCond2(bl_start, max_diff, pulses, pulse_len, maxpos, max_lg):
+# The search for the baseline return only runs over range(maxpos, pulse_len - bl_start),
+# which is empty whenever it is entered: the length is pulse_len - bl_start//2 or 0
+
+    n_pulses, n_samp = pulses.shape
+    jrow = np.arange(n_pulses)
+    newpulse_len = np.where(pulse_len - bl_start >= maxpos, pulse_len - bl_start//2, 0)
+    totalintegral = np_window_sum(pulses, np.ones(n_pulses, dtype=np.int64), newpulse_len - 1)
+    totalintegral += 0.5*(pulses[:, 0] + pulses[jrow, (newpulse_len - 1) %n_samp])
+    return totalintegral.astype(np.float32)
+
+def np_Baseline(basestart, baseend, pulse_len, pulses):
+
+    j0 = np.maximum(pulse_len - baseend, basestart)
+    baseline = np.sum(pulses[:, :basestart], axis=1)
+    baseline += np_window_sum(pulses, j0, pulse_len)
+    nind = basestart + np.maximum(pulse_len - j0, 0)
+    return (baseline/nind.astype(np.float64)).astype(baseline.dtype)
+
+def np_PileUpDet(nfront, ntail, nthres, front_led, tail_led, flags, pulses):
+# Scans all pulses in parallel; after a peak the next nfront + ntail samples are skipped
+
+    n_pulses, pulse_len = pulses.shape
+    flg_peaks = np.zeros(n_pulses, dtype=np.int32)
+    for flg, front, tail in ((False, nfront, ntail), (True, front_led, tail_led)):
+        (ind, ) = np.where(flags == flg)
+        pulse_width = front + tail
+        if len(ind) == 0 or pulse_len <= pulse_width:
+            continue
+        sub = pulses[ind]
+        pulse_front = sub[:, front: pulse_len - tail] - nthres
+        pulse_max = np.maximum(sub[:, :-pulse_width], sub[:, pulse_width:])
+        jnext = np.zeros(len(ind), dtype=np.int64)
+        for jt in range(pulse_len - pulse_width):
+            peak = (jt >= jnext) & (pulse_front[:, jt] > pulse_max[:, jt])
+            flg_peaks[ind[peak]] += 1
+            jnext[peak] = jt + pulse_width + 1
+    return flg_peaks
+
+def np_pulse_stats(pulses, baseline, pulse_len, jcls, n_cls, amp_min, amp_max, n_amp):
+
+    n_pulses, n_samp = pulses.shape
+    n_sum = np.zeros((n_cls, n_samp), dtype=np.int64)
+    s1 = np.zeros((n_cls, n_samp))
+    s2 = np.zeros((n_cls, n_samp))
+    persist = np.zeros((n_cls, n_samp, n_amp), dtype=np.int32)
+    jsamp = np.arange(n_samp)
+    damp = n_amp/(amp_max - amp_min)
+    for jc in range(n_cls):
+        sub = (pulses[jcls == jc].astype(np.float32) - baseline[jcls == jc, None]).astype(np.float64) # as pulse_rows
+        ok = (jsamp < np.minimum(pulse_len[jcls == jc], n_samp)[:, None])
+        n_sum[jc] = np.sum(ok, axis=0)
+        s1[jc] = np.sum(np.where(ok, sub, 0), axis=0)
+        s2[jc] = np.sum(np.where(ok, sub**2, 0), axis=0)
+        jamp = np.trunc((sub - amp_min)*damp).astype(np.int64)
+        ok &= (jamp >= 0) & (jamp < n_amp)
+        jbin = (np.broadcast_to(jsamp, sub.shape)*n_amp + jamp)[ok]
+        persist[jc] = np.bincount(jbin, minlength=n_samp*n_amp).reshape(n_samp, n_amp)
+    return n_sum, s1, s2, persist
+
+def np_pileup_fit(pulses, pulse_len, templates, n_pre, nfront, ntail, nthres, rel_thres, max_pulses):
+# Same greedy steps for all windows at once
+
+    n_pulses, n_samp = pulses.shape
+    n_cls, n_tmpl = templates.shape
+    jrow = np.arange(n_pulses)
+    jsamp = np.arange(n_samp)
+    valid = (jsamp < pulse_len[:, None])
+    x = np.where(valid, pulses, 0).astype(np.float64)
+    res = x.copy()
+    chi2 = np.sum(x**2, axis=1)
+    basis = np.zeros((n_pulses, max_pulses, n_samp))
+    a_fit = np.zeros((n_pulses, max_pulses))
+    n_found = np.zeros(n_pulses, dtype=np.int32)
+    pos = np.zeros((n_pulses, max_pulses), dtype=np.int32)
+    cls = np.zeros((n_pulses, max_pulses), dtype=np.int32)
+    active = np.ones(n_pulses, dtype=bool)
+    for k in range(max_pulses):
+        jmax = np.argmax(np.where(valid, res, -np.inf), axis=1)
+        peak = res[jrow, jmax]
+        side = np.full(n_pulses, -np.inf)
+        ok = (jmax >= nfront)
+        side[ok] = res[jrow[ok], jmax[ok] - nfront]
+        ok = (jmax + ntail < pulse_len)
+        side[ok] = np.maximum(side[ok], res[jrow[ok], jmax[ok] + ntail])
+        active &= (peak > nthres) & (peak - nthres > side) & np.all(pos[:, :k] != jmax[:, None], axis=1)
+        if not np.any(active):
+            break
+        jt = jsamp - jmax[:, None] + n_pre
+        inside = valid & (jt >= 0) & (jt < n_tmpl)
+        jt = np.clip(jt, 0, n_tmpl - 1)
+        tmpl = np.where(inside[None], templates[:, jt], 0) # (n_cls, n_pulses, n_samp)
+        st = np.sum(tmpl*res, axis=2)
+        tt = np.sum(tmpl**2, axis=2)
+        gain = np.where(st > 0, st**2/np.where(tt > 0, tt, 1), 0)
+        best = np.argmax(gain, axis=0)
+        active &= (gain[best, jrow] > 0)
+        ind = np.where(active)[0]
+        basis[ind, k] = tmpl[best[ind], ind]
+        B = basis[ind, :k + 1]
+        G = np.einsum('nis,njs->nij', B, B)
+        a = np.linalg.solve(G, np.einsum('nis,ns->ni', B, x[ind])[..., None])[..., 0]
+        model = np.einsum('ni,nis->ns', a, B)
+        chi2_new = np.sum((x[ind] - model)**2, axis=1)
+        thres = np.maximum(nthres, rel_thres*a[:, 0])
+        ok = (np.min(a, axis=1) > 0) & (a[:, k] > thres) & (chi2[ind] - chi2_new > thres**2*G[:, k, k])
+        active[ind[~ok]] = False
+        ind = ind[ok]
+        chi2[ind] = chi2_new[ok]
+        res[ind] = x[ind] - model[ok]
+        a_fit[ind, :k + 1] = a[ok]
+        pos[ind, k] = jmax[ind]
+        cls[ind, k] = best[ind]
+        n_found[ind] = k + 1
+    amp = np.where(np.arange(max_pulses) < n_found[:, None], a_fit, 0).astype(np.float32)
+    return n_found, pos, amp, cls
+
+def np_int_baseline(basestart, baseend, pulse_len, pulses):
+
+    j0 = np.maximum(pulse_len - baseend, basestart)
+    bsum = np.sum(pulses[:, :basestart], axis=1, dtype=np.int64) + np_window_sum(pulses, j0, pulse_len, dtype=np.int64)
+    nind = basestart + np.maximum(pulse_len - j0, 0)
+    return (bsum/nind).astype(np.float32)
+
+def np_int_trapz(a, bnd_l, bnd_r):
+
+    jrow = np.arange(a.shape[0])
+    b = 2*np_window_sum(a, bnd_l + 1, bnd_r - 1, dtype=np.int64)
+    b += a[jrow, bnd_l].astype(np.int64) + a[jrow, (bnd_r - 1) %a.shape[1]]
+    return b
+
+
+
+#-------------------------------------------
+# Registry
+#-------------------------------------------
+
+backends = {'numpy': {name: globals()['np_%s' %name] for name in names}}
+
+# Sequential by nature: identical in the numba and numba-parallel backends
+serial_only = ('minTension', 'led_correction', 'pulse_stats')
+
+if nb is not None:
+    minTension_jit = nb.njit(cache=True, nogil=True)(_minTension)
+    solve_jit = nb.njit(cache=True, nogil=True)(_solve)
+    backends['numba'] = {}
+    backends['numba-parallel'] = {}
+    for name in names:
+        func = globals()['_%s' %name]
+        if name == 'minTension':
+            jit = minTension_jit
+        else:
+            jit = nb.njit(cache=True, nogil=True)(func)
+        backends['numba'][name] = jit
+        if name in serial_only:
+            backends['numba-parallel'][name] = jit
+        else:
+            backends['numba-parallel'][name] = nb.njit(cache=True, nogil=True, parallel=True)(func)
+
+
+def default_backend():
+
+    if 'numba' not in backends:
+        return 'numpy'
+    if (os.cpu_count() or 1) > 1:
+        return 'numba-parallel'
+    return 'numba'
+
+
+def same(res, ref, rtol=1e-4, atol=1e-3):
+
+    if isinstance(res, tuple):
+        return all(same(r1, r2, rtol=rtol, atol=atol) for r1, r2 in zip(res, ref))
+    res = np.asarray(res)
+    ref = np.asarray(ref)
+    return res.shape == ref.shape and np.allclose(res, ref, rtol=rtol, atol=atol)
+
+
+def checked(name, func):
+# Runs the numpy reference after each call and logs differences
+
+    def wrapper(*args):
+        res = func(*args)
+        ref = backends['numpy'][name](*args)
+        if not same(res, ref):
+            logger.warning('Kernel %s (%s) differs from the numpy reference', name, backend)
+        return res
+
+    return wrapper
+
+
+def use(name=None, check=False):
+
+    global backend
+    if name is None:
+        name = default_backend()
+    if name not in backends:
+        logger.error('Kernel backend %s not available, using %s', name, default_backend())
+        name = default_backend()
+    backend = name
+    for kname, func in backends[name].items():
+        globals()[kname] = checked(kname, func) if check else func
+    logger.info('Kernel backend: %s%s', name, ' (checked against numpy)' if check else '')
+
+
+use(os.getenv('DPSD_KERNELS') or None, check=(os.getenv('DPSD_KERNELS_CHECK', '0') == '1'))
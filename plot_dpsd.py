@@ -1,22 +1,28 @@
-import sys
+import os, sys
 import matplotlib
 import numpy as np
 
-try:
-    from PyQt5.QtWidgets import QWidget, QTabWidget, QVBoxLayout
-    from PyQt5.QtCore import QRect
-    matplotlib.use('Qt5Agg')
-    from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-    from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
-except:
-    from PyQt4.QtGui import QWidget, QTabWidget, QVBoxLayout
-    from PyQt4.QtCore import QRect
-    matplotlib.use('Qt4Agg')
-    from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
-    from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
+# MPLBACKEND=Agg: figure builders only, no Qt (batch reports)
+headless = (os.getenv('MPLBACKEND', '').lower() == 'agg')
+if headless:
+    QWidget = object
+else:
+    try:
+        from PyQt5.QtWidgets import QWidget, QTabWidget, QVBoxLayout
+        from PyQt5.QtCore import QRect
+        matplotlib.use('Qt5Agg')
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+    except:
+        from PyQt4.QtGui import QWidget, QTabWidget, QVBoxLayout
+        from PyQt4.QtCore import QRect
+        matplotlib.use('Qt4Agg')
+        from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
 
 import matplotlib.pylab as plt
 from matplotlib.patches import Rectangle
+import dpsd_lut
 
 fsize   = 8
 titsize = 10
@@ -62,27 +68,22 @@ def fig_pha(dpsd, color='#c00000'):
         fig_pha.text(.5, .95, '#%d' %dpsd.nshot, ha='center')
 
     nbins = [sep_d['#bins Pulse Height'], sep_d['#bins Pulse Shape']]
-    ranges = [[-0.5, nbins[0]+0.5], [-0.5, nbins[1]+0.5]]
-    hpha, xedges, yedges = np.histogram2d(dpsd.PulseHeight, dpsd.PulseShape, bins=nbins, range=ranges)
-    hpha = np.flipud(np.rot90(hpha))
-    hpha[hpha == 0] = np.nan
+    pyr = dpsd.hpha_pyr
+    dens, extent = pyr.density(0)
+    img = plt.imshow(log_density(dens), origin='lower', extent=extent, aspect='auto', \
+        interpolation='nearest', cmap=matplotlib.cm.jet, vmin=0, vmax=np.log10(max(np.max(dens), 1)))
     plt.xlim([0, nbins[0]])
     plt.ylim([0, nbins[1]])
-    plt.pcolormesh(xedges, yedges, np.log10(hpha), cmap=matplotlib.cm.jet)
     cbar = plt.colorbar()
+    fig_pha.lod = pha_lod(plt.gca(), img, pyr)
 
-    xknot = sep_d['Bin line1 -> line2']
-    xline1 = [0, xknot]
-    yknot = sep_d['Offset of 1st sep.line'] + sep_d['Slope of 1st sep.line'] * (sep_d['Bin line1 -> line2'] + 1)
-    yline1 = [sep_d['Offset of 1st sep.line'], yknot]
-    xline2 = [xknot, nbins[0]]
-    yline2 = [yknot, yknot + sep_d['Slope of 2nd sep.line'] * (nbins[0] - xknot + 1)]
-    plt.plot(xline1, yline1, 'r-')
-    plt.plot(xline2, yline2, 'r-')
+    fig_pha.lines_d = {}
+    fig_pha.lines_d['sep'], = plt.plot(*sep_line(sep_d, nbins[0]), 'r-', marker='o')
     for lbl in ('Lower PH-limit for DD', 'Upper PH-limit for DD'):
-        plt.plot([sep_d[lbl], sep_d[lbl]], [0, nbins[1]], 'g-')
+        fig_pha.lines_d[lbl], = plt.plot([sep_d[lbl], sep_d[lbl]], [0, nbins[1]], 'g-')
     for lbl in ('Lower PH-limit for DT', 'Upper PH-limit for DT'):
-        plt.plot([sep_d[lbl], sep_d[lbl]], [0, nbins[1]], 'm-')
+        fig_pha.lines_d[lbl], = plt.plot([sep_d[lbl], sep_d[lbl]], [0, nbins[1]], 'm-')
+    fig_pha.cnt_text = fig_pha.text(0.98, 0.95, cnt_label(dpsd), ha='right', fontsize=fsize)
 
     xy = [led_d['Min PH bin for LED detection'], led_d['Min PS bin for LED detection']]
     width  = led_d['Max PH bin for LED detection'] - led_d['Min PH bin for LED detection']
@@ -95,6 +96,214 @@ def fig_pha(dpsd, color='#c00000'):
     return fig_pha
 
 
+def log_density(dens):
+
+    with np.errstate(divide='ignore'):
+        return np.where(dens > 0, np.log10(dens), np.nan).T
+
+
+def pha_lod(ax, img, pyr):
+# Re-render the PH-PS image at the pyramid level matching the zoom
+
+    def update(ax):
+        xlim, ylim = sorted(ax.get_xlim()), sorted(ax.get_ylim())
+        bbox = ax.get_window_extent()
+        level = pyr.level_for(xlim, ylim, bbox.width, bbox.height)
+        dens, extent = pyr.density(level, xlim, ylim)
+        img.set_data(log_density(dens))
+        img.set_extent(extent)
+
+    update(ax)
+    ax.callbacks.connect('xlim_changed', update)
+    ax.callbacks.connect('ylim_changed', update)
+    return update
+
+
+def cnt_lod(ax, lines_d, dpsd):
+# Re-sample the count rates at the pyramid level matching the zoom,
+# min/max decimated to the axes width so that short bursts stay visible
+
+    def update(ax):
+        tlim = sorted(ax.get_xlim())
+        npix = max(int(ax.get_window_extent().width), 1)
+        for spec, line in lines_d.items():
+            line.set_data(*dpsd.cnt_pyr.trace(spec, tlim, npix))
+
+    update(ax)
+    ax.callbacks.connect('xlim_changed', update)
+    return update
+
+
+def sep_line(sep_d, nxCh):
+# Knots of the separation line: offset, line1 -> line2, end;
+# or the points of a curve / closed polygon
+
+    if dpsd_lut.free_form(sep_d):
+        pts = dpsd_lut.parse_points(sep_d['Separation points'])
+        if sep_d['Classifier'].strip().lower() == 'polygon' and len(pts) > 0:
+            pts = np.vstack((pts, pts[:1]))
+        return list(pts[:, 0]), list(pts[:, 1])
+    xknot = sep_d['Bin line1 -> line2']
+    yknot = sep_d['Offset of 1st sep.line'] + sep_d['Slope of 1st sep.line']*xknot
+    yend  = yknot + sep_d['Slope of 2nd sep.line']*(nxCh - xknot)
+    return [0, xknot, nxCh], [sep_d['Offset of 1st sep.line'], yknot, yend]
+
+
+def cnt_label(dpsd):
+
+    return '  '.join(['%s: %d' %(spec, dpsd.n_events[spec]) for spec in ('neut1', 'gamma1', 'DD', 'DT')])
+
+
+class SEP_EDITOR:
+# Drag the knots of the separation line and the DD/DT PH limits in fig_pha.
+# While dragging only the lines are redrawn, at most every redraw_ms; the release
+# reclassifies the cached events and calls on_change(dpsd).
+# For a curve or polygon classifier the points are dragged, shift+click adds one
+
+    int_keys = ('Offset of 1st sep.line', 'Bin line1 -> line2', \
+        'Lower PH-limit for DD', 'Upper PH-limit for DD', 'Lower PH-limit for DT', 'Upper PH-limit for DT')
+
+
+    def __init__(self, fig, dpsd, on_change=None, tol=8, redraw_ms=50):
+
+        self.fig = fig
+        self.dp = dpsd
+        self.on_change = on_change
+        self.tol = tol
+        self.ax = fig.axes[0]
+        self.nxCh = dpsd.setup['separation']['#bins Pulse Height']
+        self.active = None
+        canvas = fig.canvas
+        self.timer = canvas.new_timer(interval=redraw_ms)
+        self.timer.single_shot = True
+        self.timer.add_callback(self.redraw)
+        self.pending = False
+        canvas.mpl_connect('button_press_event', self.press)
+        canvas.mpl_connect('motion_notify_event', self.motion)
+        canvas.mpl_connect('button_release_event', self.release)
+
+
+    def press(self, event):
+
+        if event.inaxes != self.ax or event.button != 1:
+            return
+        toolbar = self.fig.canvas.toolbar
+        if toolbar is not None and toolbar.mode:
+            return
+        sep_d = self.dp.setup['separation']
+        trans = self.ax.transData
+        if dpsd_lut.free_form(sep_d):
+            pts = dpsd_lut.parse_points(sep_d['Separation points'])
+            if event.key == 'shift':
+                pts = np.vstack((pts, [[event.xdata, event.ydata]]))
+                sep_d['Separation points'] = dpsd_lut.format_points(pts)
+                self.active = len(pts) - 1
+                self.update()
+                return
+            cands = [(jpt, x, y) for jpt, (x, y) in enumerate(pts)]
+        else:
+            xk, yk = sep_line(sep_d, self.nxCh)
+            cands = [('offset', xk[0], yk[0]), ('knot', xk[1], yk[1]), ('end', xk[2], yk[2])]
+        for lbl in self.int_keys[2:]:
+            cands.append((lbl, sep_d[lbl], event.ydata))
+        dist = [np.hypot(*(trans.transform((x, y)) - (event.x, event.y))) for _, x, y in cands]
+        jmin = np.argmin(dist)
+        if dist[jmin] < self.tol:
+            self.active = cands[jmin][0]
+
+
+    def motion(self, event):
+
+        if self.active is None or event.inaxes != self.ax:
+            return
+        sep_d = self.dp.setup['separation']
+        x, y = event.xdata, event.ydata
+        if not isinstance(self.active, str):
+            pts = dpsd_lut.parse_points(sep_d['Separation points'])
+            pts[self.active] = [round(x), round(y)]
+            sep_d['Separation points'] = dpsd_lut.format_points(pts)
+            self.schedule()
+            return
+        xknot = sep_d['Bin line1 -> line2']
+        yknot = sep_d['Offset of 1st sep.line'] + sep_d['Slope of 1st sep.line']*xknot
+        yend  = yknot + sep_d['Slope of 2nd sep.line']*(self.nxCh - xknot)
+        if self.active == 'offset':
+            sep_d['Offset of 1st sep.line'] = int(round(y))
+            sep_d['Slope of 1st sep.line'] = (yknot - sep_d['Offset of 1st sep.line'])/float(xknot)
+        elif self.active == 'knot':
+            xknot = int(round(min(max(x, 1), self.nxCh - 1)))
+            sep_d['Bin line1 -> line2'] = xknot
+            sep_d['Slope of 1st sep.line'] = (y - sep_d['Offset of 1st sep.line'])/float(xknot)
+            sep_d['Slope of 2nd sep.line'] = (yend - y)/float(self.nxCh - xknot)
+        elif self.active == 'end':
+            sep_d['Slope of 2nd sep.line'] = (y - yknot)/float(self.nxCh - xknot)
+        else:
+            sep_d[self.active] = int(round(x))
+        self.schedule()
+
+
+    def release(self, event):
+# Classification, histograms and pulse statistics follow the separation once the drag ends
+
+        if self.active is not None:
+            self.active = None
+            self.timer.stop()
+            self.pending = False
+            self.update()
+
+
+    def schedule(self):
+# Throttled redraw of the lines while dragging
+
+        if not self.pending:
+            self.pending = True
+            self.timer.start()
+
+
+    def redraw(self):
+
+        self.pending = False
+        self.draw_lines()
+        self.fig.canvas.draw_idle()
+
+
+    def draw_lines(self):
+
+        sep_d = self.dp.setup['separation']
+        lines_d = self.fig.lines_d
+        lines_d['sep'].set_data(*sep_line(sep_d, self.nxCh))
+        for lbl in self.int_keys[2:]:
+            lines_d[lbl].set_xdata([sep_d[lbl], sep_d[lbl]])
+
+
+    def update(self, pulse_stats=True):
+
+        self.draw_lines()
+        self.dp.classify(pulse_stats=pulse_stats)
+        self.fig.cnt_text.set_text(cnt_label(self.dp))
+        self.fig.canvas.draw_idle()
+        if self.on_change is not None:
+            self.on_change(self.dp)
+
+
+def update_phs(fig, dpsd):
+
+    for spec, line in fig.lines_d.items():
+        line.set_ydata(dpsd.phs[spec])
+    fig.canvas.draw_idle()
+
+
+def update_cnt(fig, dpsd):
+# The zoom-dependent lines are re-sampled from the new rate pyramid of dpsd
+
+    for spec, line in fig.lines_d.items():
+        if spec not in fig.lod_d:
+            line.set_ydata(dpsd.cnt[spec])
+    if fig.lod_d:
+        fig.lod(fig.lod_ax)
+    fig.canvas.draw_idle()
+
+
 def fig_phs(dpsd, color='#c00000', ymax=2, titles=None):
 
     fig_phs = plt.figure(figsize=fig_size, dpi=100)
@@ -104,8 +313,9 @@ def fig_phs(dpsd, color='#c00000', ymax=2, titles=None):
         fig_phs.text(.5, .95, '#%d' %dpsd.nshot, ha='center')
 
     ymax = 0
+    fig_phs.lines_d = {}
     for spec in ['neut1', 'gamma1', 'led', 'DT']:
-        plt.plot(dpsd.phs[spec], label=spec)
+        fig_phs.lines_d[spec], = plt.plot(dpsd.phs[spec], label=spec)
         ymax = max(ymax, np.max(dpsd.phs[spec][1:]))
     plt.xlim([0, dpsd.setup['separation']['#bins Pulse Height']])
     plt.ylim([0, ymax])
@@ -125,10 +335,17 @@ def fig_cnt(dpsd, color='#c00000', ymax=2, titles=None):
         fig_cnt.text(.5, .95, '#%d' %dpsd.nshot, ha='center')
 
     ymax = 0
+    fig_cnt.lines_d = {}
+    fig_cnt.lod_d = {}
     for spec in ['neut1', 'neut2', 'gamma1', 'gamma2', 'led', 'pileup', 'DD', 'DT']:
-        plt.plot(dpsd.time_cnt, dpsd.cnt[spec], label=spec)
+        fig_cnt.lines_d[spec], = plt.plot(dpsd.time_cnt, dpsd.cnt[spec], label=spec)
+        if hasattr(dpsd, 'cnt_pyr') and spec in dpsd.cnt_pyr.levels[0]:
+            fig_cnt.lod_d[spec] = fig_cnt.lines_d[spec]
         ymax = max(ymax, np.max(dpsd.cnt[spec]))
     plt.xlim([dpsd.time_cnt[0], dpsd.time_cnt[-1]])
+    if fig_cnt.lod_d:
+        fig_cnt.lod_ax = plt.gca()
+        fig_cnt.lod = cnt_lod(fig_cnt.lod_ax, fig_cnt.lod_d, dpsd)
     plt.ylim([0, ymax])
     plt.xlabel('Time [s]')
     plt.ylabel('Count rate [1/s]')
@@ -137,6 +354,37 @@ def fig_cnt(dpsd, color='#c00000', ymax=2, titles=None):
     return fig_cnt
 
 
+def fig_pulse_stats(dpsd):
+# Mean +- standard deviation (top) and persistence (bottom) of the pulses of each class
+
+    fig_pst = plt.figure(figsize=fig_size, dpi=100)
+
+    fig_pst.subplots_adjust(left=0.08, bottom=0.1, right=0.98, top=0.92, hspace=0.1, wspace=0.1)
+    if hasattr(dpsd, 'nshot'):
+        fig_pst.text(.5, .95, '#%d' %dpsd.nshot, ha='center')
+
+    titles = {'neut1': 'Neutrons', 'gamma1': 'Gamma', 'led': 'LED', 'pileup': 'Pile-up', 'sat': 'Saturated'}
+    amp = dpsd.persist_amp
+    for jc, (spec, stat) in enumerate(dpsd.pulse_stats.items()):
+        n_samp = len(stat['mean'])
+        samp = np.arange(n_samp)
+        std = np.sqrt(stat['var'])
+        ax = fig_pst.add_subplot(2, len(dpsd.pulse_stats), jc + 1)
+        ax.set_title('%s (%d)' %(titles[spec], stat['n_pulses']), fontsize=titsize)
+        ax.fill_between(samp, stat['mean'] - std, stat['mean'] + std, color='#a0c0ff')
+        ax.plot(samp, stat['mean'], 'b-')
+        ax.set_xlim([0, n_samp - 1])
+        ax.tick_params(labelsize=fsize, labelbottom=False)
+        ax = fig_pst.add_subplot(2, len(dpsd.pulse_stats), len(dpsd.pulse_stats) + jc + 1)
+        ax.imshow(np.log10(1 + stat['persist'].T), origin='lower', aspect='auto', \
+            extent=[-0.5, n_samp - 0.5, amp[0], amp[-1]], cmap='gnuplot2_r')
+        ax.set_xlabel('Sample', fontsize=lblsize)
+        ax.tick_params(labelsize=fsize, labelleft=(jc == 0))
+        if jc == 0:
+            ax.set_ylabel('Amplitude', fontsize=lblsize)
+    return fig_pst
+
+
 def fig_pmg(dpsd):
 
     fig_pmg = plt.figure(figsize=fig_size, dpi=100)
@@ -161,10 +409,9 @@ def fig_win(dpsd):
     if hasattr(dpsd, 'nshot'):
         fig_win.text(.5, .95, '#%d' %dpsd.nshot, ha='center')
 
-    win_min = np.min(dpsd.winlen)
-    win_max = np.max(dpsd.winlen)
-    plt.hist(dpsd.winlen, bins=win_max)
-    plt.xlim([win_min, win_max])
+    (ind, ) = np.where(dpsd.hwin > 0)
+    plt.bar(np.arange(len(dpsd.hwin)), dpsd.hwin, width=1)
+    plt.xlim([ind[0] - 0.5, ind[-1] + 0.5])
     plt.xlabel('Window length [#samples]')
     plt.ylabel('Occurrences')
     return fig_win
@@ -3,15 +3,15 @@ import matplotlib
 import numpy as np
 
 try:
-    from PyQt5.QtWidgets import QWidget, QTabWidget, QVBoxLayout, QGridLayout, QPushButton, QLabel, QProgressBar, QSlider
+    from PyQt5.QtWidgets import QWidget, QTabWidget, QVBoxLayout, QGridLayout, QPushButton, QLabel, QProgressBar, QSlider, QComboBox, QSpinBox
     from PyQt5.QtGui import QPixmap, QIcon
-    from PyQt5.QtCore import Qt, QRect, QSize
+    from PyQt5.QtCore import Qt, QRect, QSize, QTimer
     matplotlib.use('Qt5Agg')
     from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
     from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 except:
-    from PyQt4.QtGui import QPixmap, QIcon, QWidget, QTabWidget, QVBoxLayout, QGridLayout, QPushButton, QLabel, QProgressBar, QSlider
-    from PyQt4.QtCore import Qt, QRect, QSize
+    from PyQt4.QtGui import QPixmap, QIcon, QWidget, QTabWidget, QVBoxLayout, QGridLayout, QPushButton, QLabel, QProgressBar, QSlider, QComboBox, QSpinBox
+    from PyQt4.QtCore import Qt, QRect, QSize, QTimer
     matplotlib.use('Qt4Agg')
     from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
     from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
@@ -28,10 +28,17 @@ dpsd_dir = os.path.dirname(os.path.realpath(__file__))
 
 
 
+# event_type of each subplot, None = all classified events
+classes = {'All': None, 'Neutrons': 0, 'Gamma': 1, 'Pile-up': 2, 'LED': 3}
+
+
 class plotWindow(QWidget):
+# Steps through the pulses of one class via per-class index arrays.
+# Only the line artists and the time label are redrawn (blitting),
+# playback is driven by a QTimer at the chosen frame rate
 
 
-    def __init__(self, dpsd):
+    def __init__(self, dpsd, fps=25):
 
         self.dp = dpsd
 
@@ -41,7 +48,6 @@ class plotWindow(QWidget):
             super(QWidget, self).__init__()
         xwin = 900
         ywin = 710
-        self.timeout = 1.e-10
         xicon = 40
         yicon = 50
         ybar = 20
@@ -63,7 +69,7 @@ class plotWindow(QWidget):
         self.progress.setAlignment(Qt.AlignCenter)
         self.progress.setFixedHeight(ybar)
         self.slider = QSlider(Qt.Horizontal)
-        self.slider.sliderReleased.connect(self.get_slvalue)
+        self.slider.valueChanged.connect(self.get_slvalue)
         slider_layout.addWidget(self.progress)
         slider_layout.addWidget(self.slider)
 
@@ -81,75 +87,161 @@ class plotWindow(QWidget):
             self.but[lbl].setIconSize(QSize(xicon, yicon))
             self.but[lbl].clicked.connect(fmap[lbl])
             tbar_grid.addWidget(self.but[lbl], 0, jpos)
-        tbar_grid.addWidget(dum_lbl, 0, jpos+1)
+        self.cls_box = QComboBox()
+        self.cls_box.addItems(list(classes.keys()))
+        self.cls_box.currentIndexChanged.connect(self.set_class)
+        tbar_grid.addWidget(self.cls_box, 0, jpos+1)
+        self.fps_box = QSpinBox()
+        self.fps_box.setRange(1, 200)
+        self.fps_box.setValue(fps)
+        self.fps_box.setSuffix(' fps')
+        self.fps_box.valueChanged.connect(self.set_fps)
+        tbar_grid.addWidget(self.fps_box, 0, jpos+2)
+        tbar_grid.addWidget(dum_lbl, 0, jpos+3)
 
         layout.addWidget(self.canvas)
         layout.addLayout(slider_layout)
         layout.addWidget(tbar)
         layout.addWidget(new_toolbar)
 
-#        self.canvas.mpl_connect('button_press_event', self.pause)
+# Per-class indices of the retained pulses (rows of dpsd.pulses)
+        event_type = self.dp.event_type[self.dp.pulse_index]
+        self.ind = {}
+        for lbl, jcls in classes.items():
+            if jcls is None:
+                (self.ind[lbl], ) = np.where(event_type >= 0)
+            else:
+                (self.ind[lbl], ) = np.where(event_type == jcls)
+# Pulse maxima from the raw int16 rows, minus the baseline in set_class: no float copy
+        self.row_max = np.max(self.dp.pulses, axis=1)
+
         self.ax = {}
         self.line = {}
-        self.nt, self.xlen = self.dp.pulses.shape
-        self.slider.setMaximum(self.nt)
+        self.nt = len(self.dp.time)
+        self.xlen = self.dp.pulses.shape[1]
         for j in range(4):
             self.ax[j] = self.fig_pul.add_subplot(2, 2, j + 1)
             self.ax[j].set_xlim([0, self.xlen])
-            self.line[j], = self.ax[j].plot(np.arange(self.xlen), np.zeros(self.xlen))
+            self.ax[j].set_ylim([0, 1])
+            self.line[j], = self.ax[j].plot(np.arange(self.xlen), np.zeros(self.xlen), animated=True)
         self.ax[0].set_title('Neutrons')
         self.ax[1].set_title('Gamma')
         self.ax[2].set_title('Pile-up')
         self.ax[3].set_title('LED')
 
-        self.ftext = self.fig_pul.text(0.5, 0.95, 'Time: %7.5f' %self.dp.time[0], ha='center')
+        self.ftext = self.fig_pul.text(0.5, 0.95, 'Time: %7.5f' %self.dp.time[0], ha='center', animated=True)
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.next_frame)
+        self.set_fps(fps)
+
+        self.cls = 'All'
+        self.jpos = 0
+        self.set_class()
+
 
-        self.jt = 0
-        self.stop = True
+    def on_draw(self, event):
+# Full redraw (resize, zoom, rescale): store the static background
+
+        self.background = self.canvas.copy_from_bbox(self.fig_pul.bbox)
+        self.blit()
+
+
+    def blit(self):
+
+        if self.background is None:
+            return
+        self.canvas.restore_region(self.background)
+        for line in self.line.values():
+            self.fig_pul.draw_artist(line)
+        self.fig_pul.draw_artist(self.ftext)
+        self.canvas.blit(self.fig_pul.bbox)
+
+
+    def set_class(self, *args):
+
+        self.cls = self.cls_box.currentText()
+        self.jpos = 0
+# Common y range for the class, so that most frames need no rescaling
+        ind = self.ind[self.cls]
+        if len(ind) > 0:
+            ymax = self.row_max[ind] - self.dp.pulse_baseline[ind]
+            event_type = self.dp.event_type[self.dp.pulse_index[ind]]
+            for jplot in range(4):
+                ymax_plot = ymax[event_type == jplot]
+                if len(ymax_plot) > 0:
+                    self.ax[jplot].set_ylim([0, max(np.percentile(ymax_plot, 99.9), 1)])
+        self.background = None
+        self.slider.blockSignals(True)
+        self.slider.setMaximum(max(len(self.ind[self.cls]) - 1, 0))
+        self.slider.blockSignals(False)
         self.update_plot()
 
 
+    def set_fps(self, fps):
+
+        self.timer.setInterval(int(1000./fps))
+
+
     def pause(self):
         self.but['play'].setIcon(QIcon('%s/play.gif' %dpsd_dir))
         self.but['play'].disconnect()
         self.but['play'].clicked.connect(self.play)
-        self.stop = True
+        self.timer.stop()
 
     def play(self):
-        self.stop = False
         self.but['play'].setIcon(QIcon('%s/pause.gif' %dpsd_dir))
         self.but['play'].disconnect()
         self.but['play'].clicked.connect(self.pause)
-        while self.jt < self.nt-1 and not self.stop:
-            self.jt += 1
-            self.update_plot()
-            self.canvas.start_event_loop(self.timeout)
+        self.timer.start()
 
-    def forward(self):
-        self.jt += 1
-        self.jt = self.jt%self.nt
+    def next_frame(self):
+        if self.jpos >= len(self.ind[self.cls]) - 1:
+            self.pause()
+            return
+        self.jpos += 1
         self.update_plot()
-        self.pause()
+
+    def forward(self):
+        self.step(1)
 
     def backward(self):
-        self.jt -= 1
-        self.jt = self.jt%self.nt
+        self.step(-1)
+
+    def step(self, djpos):
+        n_ind = len(self.ind[self.cls])
+        if n_ind > 0:
+            self.jpos = (self.jpos + djpos)%n_ind
         self.update_plot()
         self.pause()
 
     def update_plot(self):
-        jplot = self.dp.event_type[self.jt]
-        if jplot < 0:
+        ind = self.ind[self.cls]
+        if len(ind) == 0:
+            self.progress.setText('No events')
             return
-        self.progress.setText('%d%%' %((self.jt*100)//self.nt))
-        self.slider.setValue(self.jt)
-        pulse = self.dp.pulses[self.jt]
+        jt = self.dp.pulse_index[ind[self.jpos]]
+        jplot = self.dp.event_type[jt]
+        self.progress.setText('%d/%d  %d%%' %(self.jpos + 1, len(ind), (jt*100)//self.nt))
+        self.slider.blockSignals(True)
+        self.slider.setValue(self.jpos)
+        self.slider.blockSignals(False)
+        pulse = self.dp.pulse_rows(ind[self.jpos])
         self.line[jplot].set_ydata(pulse)
-        self.ax[jplot].set_ylim([0, np.max(pulse)])
-        self.ftext.set_text('Time=%7.5f' %self.dp.time[self.jt])
-        self.canvas.draw()
+        self.ftext.set_text('Time=%7.5f' %self.dp.time[jt])
+# Rescale (full redraw) only for pulses exceeding the class y range
+        ymax = np.max(pulse)
+        if ymax > self.ax[jplot].get_ylim()[1]:
+            self.ax[jplot].set_ylim([0, ymax])
+            self.canvas.draw()
+        elif self.background is None:
+            self.canvas.draw()
+        else:
+            self.blit()
 
     def get_slvalue(self):
-        self.jt = self.slider.value()
+        self.jpos = self.slider.value()
         self.update_plot()
         self.pause()
@@ -1,7 +1,6 @@
 import os, logging
 import numpy as np
-import numba as nb
-from numba.typed import List
+import kernels
 
 fmt = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s: %(message)s', '%H:%M:%S')
 logger = logging.getLogger('read_HA')
@@ -10,73 +9,156 @@ hnd.setFormatter(fmt)
 logger.addHandler(hnd)
 logger.setLevel(logging.INFO)
 
+raw_dir = '/shares/experiments/aug-rawfiles/NSP'
 
-@nb.njit
-def minTension(pulse_in):
-    pulse_even = np.ascontiguousarray(pulse_in[:-1:2])
-    pulse_odd  = np.ascontiguousarray(pulse_in[1::2])
-    len0 = len(pulse_odd)
-    min_tens = 1e8
-    pulse_ok = np.empty(0, dtype=pulse_in.dtype)
-    jmin = -1
-    for j in range(3):
-        N = len0 - j
-        pulse2 = np.empty(2 * N, dtype=pulse_in.dtype)
-        pulse2[0::2] = pulse_odd[j:]
-        pulse2[1::2] = pulse_even[:N]
-        tension = np.sum((pulse2[1:] - pulse2[:-1])**2)
-        if tension < min_tens:
-            pulse_ok = pulse2
-            min_tens = tension
-            jmin = j
-    return jmin, pulse_ok
-
-@nb.njit
-def raw2pulse(max_winlen, win_start, pulse_len, rawdata):
-    win_end = win_start + pulse_len
-    n_pulses = win_start.shape[0]
-    pulses = np.zeros((n_pulses, max_winlen))
-    indBad = List()
-# Determine shift using a minimum-derivative**2 approach, pulse by pulse
-    for jwin in range(n_pulses):
-        jpos = win_start[jwin]
-        pulse = rawdata[jpos : win_end[jwin]]
-        jmin, pulse_ok = minTension(pulse)
-        if jmin > 0:
-            indBad.append(jwin)
-        len_pul = len(pulse_ok)
-        pulses[jwin, : len_pul] = pulse_ok
-    return indBad, pulses
 
+def ha_file(nshot):
 
-class READ_HA:
+    shot100 = nshot//100
+    filepath = '%s/%d/%d' %(raw_dir, shot100, nshot)
+    if not os.path.exists(filepath):
+        filepath = '%s/%d' %(raw_dir, shot100)
+    fin = '%s/HA_%d.dat' %(filepath, nshot)
+    if not os.path.exists(fin) and os.path.exists(fin[:-4] + '.hac'):
+        return fin[:-4] + '.hac'
+    return fin
+
+
+def scan_header(data):
+# Window boundaries and time differences [1e-8 s] from the 4-word window headers
+
+    data1 = data + 1
+    (boundaries, ) = np.where(
+        np.isin(data[ :-3], [0, 1, 2]) & \
+        np.isin(data[2:-1], [0, 1, 2]) & \
+        (data1[1:-2] == data[3:]) )
+
+    data32 = data.astype(np.uint32)
+    tdiff = data32[boundaries + 3] + data32[boundaries]*32768
+    return boundaries, tdiff
+
+
+def gather_windows(data, win_start, pulse_len):
+# Copy only the samples of the given windows, returns their new start positions
+
+    offsets = np.append(0, np.cumsum(pulse_len)[:-1])
+    ind = np.repeat(win_start - offsets, pulse_len) + np.arange(np.sum(pulse_len))
+    return offsets, data[ind]
+
+
+def write_ha(fout, pulses, tdiff):
+# Inverse of READ_HA: 4-word header + ADC-interleaved samples per window
+
+    n_pulses, winlen = pulses.shape
+    tdiff = np.asarray(tdiff, dtype=np.int64)
+    tlow = tdiff %32768
+    data = np.empty((n_pulses, winlen + 4), dtype=np.uint16)
+    data[:, 0] = tdiff//32768
+    data[:, 1] = (tlow - 1) %65536
+    data[:, 2] = 0
+    data[:, 3] = tlow
+    samples = 32768 - np.round(pulses).astype(np.int64)
+    data[:, 4::2] = samples[:, 1::2]
+    data[:, 5::2] = samples[:, 0::2]
+    data.tofile(fout)
 
 
-    def __init__(self, fin, check_md5=False, min_winlen=0, max_winlen=None):
+def has_md5(fin):
+# *.hac archives carry the md5 of their source in the index, HA*.dat a *.md5 sidecar
+
+    if fin.endswith('.hac'):
+        import dpsd_archive
+        return dpsd_archive.HA_ARCHIVE(fin).md5 is not None
+    return os.path.isfile(fin + '.md5')
+
+
+def load_raw(fin, check_md5=False, t_range=None):
+# uint16 words of a HA*.dat file, or of the chunks of a *.hac archive within t_range;
+# returns (data, time offset [1e-8 s]), data is None on failure
+
+    logger.info('Reading binary %s', fin)
+    if not os.path.isfile(fin):
+        logger.error('File %s not found', fin)
+        return None, 0
+    if fin.endswith('.hac'): # compressed archive, only chunks within t_range
+        import dpsd_archive
+        arch = dpsd_archive.HA_ARCHIVE(fin)
+        if check_md5 and arch.md5 is None:
+            logger.error('No md5 for %s', fin)
+            return None, 0
+        data, t_offset = arch.read(t_range=t_range)
+        if len(data) == 0:
+            logger.error('No data in time range %s', str(t_range))
+            return None, 0
+        return data, t_offset
+    if check_md5 and not os.path.isfile(fin + '.md5'): # ensures integrity of fin
+        logger.error('File %s not found', fin + '.md5')
+        return None, 0
+    return np.fromfile(fin, dtype=np.uint16), 0
+
+
+class RATES:
+# Rate-only path: window headers and time stamps, no sample decoding
+
+
+    def __init__(self, fin, tstep=1e-3, min_winlen=0, check_md5=False, data=None, t_range=None):
 
         self.status = True
-        logger.info('Reading binary %s', fin)
-        fmd5 = fin + '.md5'
-        if not os.path.isfile(fin):
-            logger.error('File %s not found', fin)
+        t_offset = 0
+        if data is None:
+            data, t_offset = load_raw(fin, check_md5=check_md5, t_range=t_range)
+            if data is None:
+                self.status = False
+                return
+        self.nbytes = data.nbytes
+        boundaries, tdiff = scan_header(data)
+        winlen = np.diff(np.append(boundaries, len(data))) - 4
+        t_events = 1e-8*(t_offset + np.cumsum(tdiff, dtype=np.int64))
+        ok = (winlen %2 == 0) & (winlen > min_winlen)
+        if t_range is not None:
+            sel = (t_events >= t_range[0]) & (t_events <= t_range[1])
+            t_events, winlen, ok = t_events[sel], winlen[sel], ok[sel]
+        if len(t_events) == 0:
+            logger.error('No events in %s', fin)
             self.status = False
             return
-        if check_md5:
-            if not os.path.isfile(fmd5): # ensures integrity of fin
-                logger.error('File %s not found', fmd5)
+        self.n_windows = len(t_events)
+        self.n_odd = int(np.count_nonzero(winlen %2 == 1))
+        self.n_neg = int(np.count_nonzero(winlen < 0))
+        self.hwin = np.bincount(winlen[ok])
+        self.tstep = tstep
+        k0 = int(np.floor(t_events[0]/tstep))
+        jbin = np.floor(t_events/tstep).astype(np.int64) - k0
+        n_bins = int(jbin[-1]) + 1
+        self.time_cnt = tstep*(k0 + 0.5 + np.arange(n_bins))
+        self.cnt = {'total': np.bincount(jbin, minlength=n_bins)/tstep, \
+            'valid': np.bincount(jbin[ok], minlength=n_bins)/tstep}
+        self.t_start = float(t_events[0])
+        self.t_end = float(t_events[-1])
+        logger.info('%d windows, %d valid, %d odd, %d <= 0 samples', self.n_windows, np.sum(self.hwin), self.n_odd, self.n_neg)
+
+
+class READ_HA:
+
+
+    def __init__(self, fin, check_md5=False, min_winlen=0, max_winlen=None, data=None, t_range=None, select=None, t_offset=0):
+# select(t_events) -> (indices, weights) decodes only a subsample of the windows;
+# data (e.g. prefetched) starts t_offset [1e-8 s] after the start of fin
+
+        self.status = True
+        if data is None:
+            data, t_offset = load_raw(fin, check_md5=check_md5, t_range=t_range)
+            if data is None:
                 self.status = False
                 return
-        data = np.fromfile(fin, dtype=np.uint16)
+        elif check_md5 and not has_md5(fin):
+            logger.error('No md5 for %s', fin)
+            self.status = False
+            return
+        self.nbytes = data.nbytes
 
         logger.info('Getting t_diff and win_len')
-        data1 = data + 1
-        (boundaries, ) = np.where(
-            np.isin(data[ :-3], [0, 1, 2]) & \
-            np.isin(data[2:-1], [0, 1, 2]) & \
-            (data1[1:-2] == data[3:]) )
-
-        data32 = data.astype(np.uint32)
-        tdiff = data32[boundaries + 3] + data32[boundaries]*32768
+        boundaries, tdiff = scan_header(data)
 
         self.boundaries = np.append(boundaries, len(data)) # Retain final pulse too, unlike *.bin
         winlen = np.diff(self.boundaries) - 4
@@ -87,16 +169,16 @@ class READ_HA:
         logger.info('Skipped %d pulses with window length <= 0', len(ind_wneg))
 
         (ind_ok, ) = np.where((winlen %2 == 0) & (winlen > min_winlen))
+        t_events = 1e-8*(t_offset + np.cumsum(tdiff, dtype=np.int64)) # exact ticks, whatever t_offset
+        self.weight = None
+        if select is not None:
+            jsel, self.weight = select(t_events[ind_ok])
+            logger.info('Decoding %d of %d windows', len(jsel), len(ind_ok))
+            ind_ok = ind_ok[jsel]
         self.winlen = winlen[ind_ok]
 
         win_start = boundaries[ind_ok] + 4
 
-        data = data.astype(np.int16)
-        data -= 32768
-        (ind_neg, ) = np.where(data > 8192)
-        data[ind_neg] -= 16384
-        data *= -1
-
         n_pulses = len(self.winlen)
 
         if max_winlen is None:
@@ -104,13 +186,22 @@ class READ_HA:
 
         pulse_len = np.minimum(self.winlen, max_winlen)
 
+        if select is not None:
+            win_start, data = gather_windows(data, win_start, pulse_len)
+
+        data = data.astype(np.int16)
+        data -= 32768
+        (ind_neg, ) = np.where(data > 8192)
+        data[ind_neg] -= 16384
+        data *= -1
+
 # Entry-inversion observed by Luca Giacomelli
         logger.info('Sorting faulty ADC synchronisation')
-        indBad, self.pulses = raw2pulse(max_winlen, win_start, pulse_len, data)
-        n_sorted = len(indBad)
+        self.adc_fixed, self.pulses = kernels.raw2pulse(max_winlen, win_start, pulse_len, data)
+        n_sorted = np.sum(self.adc_fixed)
         logger.info('Sorted ADC for %d points out of %d', n_sorted, win_start.shape[0])
 
-        self.t_events = 1e-8*(np.cumsum(tdiff, dtype=np.float32))[ind_ok]
+        self.t_events = t_events[ind_ok]
         logger.debug('Min winlen %d %d', np.min(winlen), np.min(self.winlen)) 
         logger.debug('%d', len(self.pulses))
 